@@ -5,4 +5,11 @@ __author__  = """Mauricio Cáceres Bravo"""
 __email__   = 'caceres@nber.org'
 __version__ = '0.9.15'
 
-from .tablefill import tablefill
+from .tablefill import tablefill, register_reader, tablefill_store
+from .tablefill import compile_outputs, tablefill_missing, tablefill_many
+from .tablefill import register_placeholder, tablefill_project, tablefill_metrics
+from .tablefill import register_hook, remove_hook
+
+from sys import version_info
+if version_info >= (3, 5):
+    from .afill import afill, afill_many, fill_result
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""asyncio interface to tablefill (python 3.5+)
+
+afill and afill_many run fills in an executor (the event loop's default
+thread pool unless another is given), so the event loop is never blocked
+by formatting or by reading inputs and writing outputs. tablefill does
+not replace sys.stdout, so fills can run in threads side by side.
+
+Usage
+-----
+
+>>> from tablefill import afill, afill_many
+>>> result = await afill('template.tex', 'tables.txt', 'filled.tex')
+>>> results = await afill_many('appendix.tex',
+...                            [('tables_us.txt', 'appendix_us.tex'),
+...                             ('tables_fr.txt', 'appendix_fr.tex')],
+...                            jobs = 2)
+
+Both return fill_result tuples of (output, exit, exit_msg).
+
+Cancelling afill or afill_many drops fills that have not started; a
+fill already running in a worker runs to completion, but its result is
+discarded.
+"""
+
+from collections import namedtuple
+from functools import partial
+import asyncio
+
+try:
+    from .tablefill import tablefill, fill_variant, open_text, tolist, binary_mode
+    from .tablefill import get_variant_metrics, record_variant_metrics
+except ImportError:
+    from tablefill import tablefill, fill_variant, open_text, tolist, binary_mode
+    from tablefill import get_variant_metrics, record_variant_metrics
+
+fill_result = namedtuple('fill_result', ['output', 'exit', 'exit_msg'])
+
+
+def read_lines(fname, binary = False):
+    with binary_mode(binary):
+        with open_text(fname) as fh:
+            return fh.readlines()
+
+
+async def afill(template, input, output, executor = None, **kwargs):
+    """
+    Fill 'template' with 'input' into 'output' in 'executor' (the
+    event loop's default executor if None). Other arguments are passed
+    on to tablefill. Returns a fill_result.
+    """
+    loop = asyncio.get_event_loop()
+    fill = partial(tablefill,
+                   template = template,
+                   input    = ' '.join(tolist(input)),
+                   output   = output,
+                   **kwargs)
+
+    exit, exit_msg = await loop.run_in_executor(executor, fill)
+    return fill_result(output, exit, exit_msg)
+
+
+async def afill_many(template, variants, jobs = None, executor = None, **kwargs):
+    """
+    Fill one template with several (input, output) pairs in 'variants',
+    as tablefill_many does, with at most 'jobs' fills running at once
+    (no limit other than the executor's if None). The template is read
+    once. Returns a list of fill_result in the order of 'variants'.
+    """
+    loop  = asyncio.get_event_loop()
+    limit = None if jobs is None else asyncio.Semaphore(jobs)
+    template_lines = await loop.run_in_executor(executor, read_lines, template,
+                                                kwargs.get('binary', False))
+
+    args = [(template, template_lines, ' '.join(tolist(input)), output, kwargs)
+            for (input, output) in variants]
+    args, metrics = get_variant_metrics(args)
+
+    async def fill(args):
+        if limit is None:
+            return await loop.run_in_executor(executor, fill_variant, args)
+
+        async with limit:
+            return await loop.run_in_executor(executor, fill_variant, args)
+
+    filled = await asyncio.gather(*[fill(a) for a in args])
+    record_variant_metrics(metrics, filled)
+    return [fill_result(*f[:3]) for f in filled]
@@ -34,7 +34,8 @@ optional arguments:
   -h, --help            show this help message and exit
   -v, --version         Show current version
   -i [INPUT [INPUT ...]], --input [INPUT [INPUT ...]]
-                        Input files with tables (default: TEMPLATE_table)
+                        Input files, folders, or globs with tables (default:
+                        TEMPLATE_table)
   -o OUTPUT, --output OUTPUT
                         Processed template file (default: TEMPLATE_filled)
   -t {auto,lyx,tex,md}, --type {auto,lyx,tex,md}
@@ -45,13 +46,41 @@ optional arguments:
                         Stars for sig thresholds (enclose each entry in quotes)
   --na-filters [FILTER [FILTER ...]]
                         Filters for missing values (enclose each entry in quotes)
+  --na-regex [REGEX [REGEX ...]]
+                        Regexes for missing values (enclose each in quotes)
+  --na-special [{nan,inf,stata} [{nan,inf,stata} ...]]
+                        Special missing values: any NaN, +/-Inf, or Stata
+                        missing values
   --xml-tables [INPUT [INPUT ...]]
                         Files with custom xml combinations.
+  --input-format {text,jsonl,csv,tsv,dta}
+                        Input file format (default: detected)
+  --store STORE         SQLite table store with inputs (see 'tablefill ingest')
+  --query [TAG [TAG ...]]
+                        Report tables, placeholders, and matching tags (only
+                        TAG, if given) instead of filling
+  --each VALUE [VALUE ...]
+                        Fill once per VALUE, replacing {} in INPUT and OUTPUT
+                        with it
+  --jobs N              Parallel jobs for --each
+  --plan-cache DIR      Folder to cache compiled templates in
+  --metrics FILE        Write fill statistics to FILE (Prometheus text format)
+  --xml-jobs N          Evaluate custom XML tables in N worker processes
+  --xml-timeout SECONDS
+                        Time limit for each custom XML table (with --xml-jobs)
+  --xml-memory MB       Memory limit for each custom XML table (with
+                        --xml-jobs)
+  --input-jobs N        Parse input files (e.g. the shards in a folder) in N
+                        processes
+  --root DIR            Folder to show paths relative to with --deterministic
+                        (default: the template's folder)
+  --compile-timeout SECONDS
+                        Time limit for each compile command
 
 flags:
   -f, --force           Name input/output automatically
   -c, --compile         Compile output
-  -b, --bibtex          Run bibtex on .aux file and re-compile
+  -b, --bibtex          Run bibtex on .aux file and re-compile as needed
   -fc, --fill-comments  Fill in commented out placeholders.
   -nc, --no-header      Supress header for filled template.
   --log-only            Print results to log file only.
@@ -59,9 +88,41 @@ flags:
   --numpy-syntax        Numpy syntax for custom XML tables.
   --use-floats          Force floats when passing objects to custom XML python.
   --ignore-xml          Ignore XML in template comments.
+  --json                Write the --query report as JSON
+  --incremental         Only refill tables whose tags changed since the last
+                        --incremental fill of OUTPUT
+  --binary              Pass the template's bytes (encoding, line endings)
+                        through untouched
+  --deterministic       Same output for the same template and tables on any
+                        machine: relative paths and a fingerprint in the header
+  --project             Fill TEMPLATE and every file it includes (\\input,
+                        \\include, or Markdown includes) into folder OUTPUT
   --verbose             Verbose printing (for debugging)
   --silent              Try to say nothing
 
+The template, one input, and the output can be '-' for stdin/stdout:
+
+$ gen | tablefill - --type tex -i tables.txt -o - | pandoc -o out.pdf
+
+One template can be filled for several inputs; {} is replaced by each
+value in the input and output names:
+
+$ tablefill appendix.tex -i tables_{}.txt -o appendix_{}.tex --each us fr de
+
+An input can be a folder, or a quoted glob, of shard files; a tag in
+several shards is taken from the last one by name:
+
+$ tablefill paper.tex -i 'results/*.txt' -o paper_filled.tex --input-jobs 8
+
+A master file and the files it includes can be filled into a folder:
+
+$ tablefill paper/master.tex -i tables.txt -o filled --project --jobs 4
+
+Inputs can also be loaded once into a SQLite table store, which only
+re-reads files that changed, and filled from there:
+
+tablefill ingest STORE INPUT [INPUT ...] [--input-format FMT] [--force]
+
 For details on the files and the replace engine, see the online documentation.
 
     https://mcaceresb.github.io/tablefill/getting-started.html
@@ -108,17 +169,33 @@ available to me come with python 2.6).
 # the future. You should do that also. Seriously (:
 
 from __future__ import division, print_function
-from os import linesep, path, access, W_OK, system, chdir, remove
+from os import linesep, path, access, W_OK, remove, rename, makedirs, fdopen
+from os import getcwd, listdir, chmod, umask
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, timedelta
 from traceback import format_exc
 from operator import itemgetter
+from collections import OrderedDict
+from bisect import bisect_right
 from sys import exit as sysexit
 from sys import version_info
-from tempfile import mktemp
+from tempfile import mktemp, mkstemp
+from array import array
 
 import xml.etree.ElementTree as xml
+import subprocess
 import argparse
+import hashlib
+import glob
+import gc
+import threading
+import multiprocessing
+import logging
+import signal
+import time
+import struct
+import json
+import csv
 import sys
 import re
 
@@ -135,6 +212,38 @@ try:
 except:
     numpyok = False
 
+try:
+    import sqlite3
+    sqliteok = True
+except:
+    sqliteok = False
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+try:
+    from os import fsencode
+except ImportError:
+    fsencode = None
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from subprocess import TimeoutExpired
+except ImportError:
+    class TimeoutExpired(Exception):
+        pass
+
 __program__   = "tablefill.py"
 __usage__     = """[-h] [-v] [FLAGS] [-i [INPUT [INPUT ...]]] [-o OUTPUT]
                     [--pvals [PVALS [PVALS ...]]] [--stars [STARS [STARS ...]]]
@@ -154,125 +263,1991 @@ except NameError:
     basestring = str
 
 
-def main():
+def main():
+    """
+    WARNING: This function expects command-line inputs to exist.
+    """
+
+    if sys.argv[1:2] == ['ingest']:
+        ingest = tablefill_internals_cliparse()
+        ingest.get_ingest_parser()
+        ingest.get_ingested(sys.argv[2:])
+        sysexit(0)
+
+    fill = tablefill_internals_cliparse()
+    fill.get_input_parser()
+    fill.get_parsed_arguments()
+
+    # With output to stdout, messages go to stderr
+    stdout = sys.stdout
+    if fill.args.output == ['-']:
+        sys.stdout = sys.stderr
+
+    fill.get_argument_strings()
+    fill.get_file_type()
+    sys.stdout = stdout
+
+    options = dict(filetype       = fill.ext,
+                   verbose        = fill.verbose,
+                   silent         = fill.silent,
+                   pvals          = fill.pvals,
+                   stars          = fill.stars,
+                   nafilters      = fill.nafilters,
+                   fillc          = fill.fillc,
+                   nohead         = fill.nohead,
+                   log_file       = fill.log_file,
+                   log_only       = fill.log_only,
+                   legacy_parsing = fill.legacy_parsing,
+                   numpy_syntax   = fill.numpy_syntax,
+                   use_floats     = fill.use_floats,
+                   ignore_xml     = fill.ignore_xml,
+                   xml_tables     = fill.xml_tables,
+                   input_format   = fill.input_format,
+                   store          = fill.store,
+                   naregex        = fill.naregex,
+                   naspecial      = fill.naspecial,
+                   plan_cache     = fill.plan_cache,
+                   query          = fill.query,
+                   query_json     = fill.query_json,
+                   incremental    = fill.incremental,
+                   binary         = fill.binary,
+                   metrics        = fill.metrics,
+                   xml_jobs       = fill.xml_jobs,
+                   xml_timeout    = fill.xml_timeout,
+                   xml_memory     = fill.xml_memory,
+                   deterministic  = fill.deterministic,
+                   root           = fill.root,
+                   input_jobs     = fill.input_jobs)
+
+    if fill.project:
+        exit, exit_msg = fill.get_filled_project(options)
+    elif fill.each is None:
+        exit, exit_msg = tablefill(template = fill.template,
+                                   input    = fill.input,
+                                   output   = fill.output,
+                                   **options)
+    else:
+        exit, exit_msg = fill.get_filled_each(options)
+
+    if fill.output == '-':
+        sys.stdout = sys.stderr
+
+    if exit == 'SUCCESS':
+        fill.get_compiled()
+        sysexit(0)
+    elif exit == 'WARNING':
+        print_silent(fill.silent, "Exit status came with a warning")
+        print_silent(fill.silent, "Output might not be as expected!")
+        print_silent(fill.silent, "Rerun program with --verbose option.")
+        fill.get_compiled()
+        sysexit(-1)
+    elif exit == 'ERROR':
+        fillerror_msg  = 'ERROR while filling table.'
+        fillerror_msg += ' Check function call.' + linesep
+        print_silent(fill.silent, fillerror_msg)
+        fill.parser.print_usage()
+        sysexit(1)
+
+
+# Backwards-compatible file concatenation
+def concat_files(flist):
+    return list(chain_files(flist))
+
+
+def chain_files(flist):
+    for fn in flist:
+        with open_text(fn) as fh:
+            for line in fh:
+                yield line
+
+
+# Backwards-compatible string formatting
+def compat_format(x):
+    if version_info >= (2, 7):
+        return format(x, ',d')
+    else:
+        import locale
+        locale.setlocale(locale.LC_ALL, 'en_US')
+        return locale.format("%d", x, grouping = True)
+
+
+# Backwards-compatible list flattening
+# http://stackoverflow.com/questions/2158395/
+def flatten(l):
+    if version_info >= (3, 0):
+        for el in l:
+            if isinstance(el, Iter) and not isinstance(el, (str, bytes)):
+                for sub in flatten(el):
+                    yield sub
+            else:
+                yield el
+    else:
+        for el in l:
+            if isinstance(el, Iter) and not isinstance(el, basestring):
+                for sub in flatten(el):
+                    yield sub
+            else:
+                yield el
+
+
+def tolist(anything):
+    return anything if isinstance(anything, list) else [anything]
+
+
+def tolist2(anything):
+    return list(anything) if hasattr(anything, '__iter__') else [anything]
+
+
+def print_verbose(prints, stuff):
+    if prints:
+        print(stuff)
+
+
+def print_silent(silence, stuff):
+    if not silence:
+        print(stuff)
+
+
+def custom_convert(x, func):
+    if isinstance(x, func):
+        return x
+    else:
+        try:
+            return func(x)
+        except:
+            return None
+
+
+def nested_convert(item, func):
+    if hasattr(item, '__iter__') and not isinstance(item, basestring):
+        return [nested_convert(x, func) for x in item]
+
+    return custom_convert(item, func)
+
+
+def numpy_matrix(table):
+    """
+    'table' as a numpy matrix, or as is if its rows have different
+    lengths (numpy no longer makes ragged arrays)
+    """
+    try:
+        return numpy.asmatrix(table)
+    except ValueError:
+        return table
+
+
+# Text files are decoded with the locale's encoding and newlines are
+# translated, except in binary mode (tablefill's 'binary' option, set
+# per thread): then files are read and written as latin-1 without
+# translating newlines. latin-1 maps each byte to one character, so
+# the template's encoding and line endings pass through untouched.
+binary_files = threading.local()
+
+
+class binary_mode(object):
+    def __init__(self, binary = True):
+        self.binary = binary
+
+    def __enter__(self):
+        self.previous   = getattr(binary_files, 'on', False)
+        binary_files.on = self.binary
+
+    def __exit__(self, *args):
+        binary_files.on = self.previous
+
+
+def fs_latin1(text):
+    """
+    Text with file names for a file written in binary mode: one
+    latin-1 character per byte of the file system's encoding, so the
+    names are written as they are on disk (escaped if they cannot be)
+    """
+    if fsencode is None:
+        return text
+
+    try:
+        return fsencode(text).decode('latin-1')
+    except UnicodeEncodeError:
+        return text.encode('ascii', 'backslashreplace').decode('ascii')
+
+
+def mkstemp_for(fname, prefix = 'tmp'):
+    """
+    Temporary file to write and then rename to 'fname', in its folder
+    and with the permissions open() would give it (mkstemp's are 0600)
+    """
+    fh, tmp = mkstemp(dir = path.dirname(path.abspath(fname)),
+                      prefix = prefix,
+                      suffix = '.tmp')
+    mask = umask(0)
+    umask(mask)
+    chmod(tmp, 0o666 & ~mask)
+    return fh, tmp
+
+
+def open_latin1(fn, mode):
+    if version_info >= (3, 0):
+        return open(fn, mode, encoding = 'latin-1', newline = '')
+    else:
+        return open(fn, mode + 'b')
+
+
+# Backwards-compatible file opening for text, csv, and binary input;
+# '-' is stdin (left open when done)
+class unclosed(object):
+    def __init__(self, fh):
+        self.fh = fh
+
+    def __enter__(self):
+        return self.fh
+
+    def __exit__(self, *args):
+        pass
+
+
+def open_text(fn):
+    if fn == '-':
+        return unclosed(sys.stdin)
+    elif getattr(binary_files, 'on', False):
+        return open_latin1(fn, 'r')
+    elif version_info >= (3, 0):
+        return open(fn, 'r', newline = None)
+    else:
+        return open(fn, 'rU')
+
+
+def open_csv(fn):
+    if fn == '-':
+        return unclosed(sys.stdin)
+    elif getattr(binary_files, 'on', False):
+        return open_latin1(fn, 'r')
+    elif version_info >= (3, 0):
+        return open(fn, 'r', newline = '')
+    else:
+        return open(fn, 'rb')
+
+
+def open_binary(fn):
+    if fn == '-':
+        return unclosed(getattr(sys.stdin, 'buffer', sys.stdin))
+    else:
+        return open(fn, 'rb')
+
+
+def abspath_stdio(fn):
+    return fn if fn == '-' else path.abspath(fn)
+
+
+# ---------------------------------------------------------------------
+# tablefill_readers
+#
+# Readers take a file name and lazily yield (tag, rows) pairs, where
+# rows is a list of lists of strings. A reader is chosen by sniffing
+# the first non-blank line of the file, then by file extension; the
+# <Tab:...> text format is the fallback.
+#
+# An input can also be a folder or a glob of shards, which stand for
+# the files in it (not in subfolders) or that match it, sorted by
+# name. If a tag is in several files, the last file (in the order
+# given, shards by name) wins.
+
+tablefill_readers = OrderedDict()
+re_tab_tag        = re.compile('^<Tab:(.+)>[\r\n' + linesep + ']',
+                               flags = re.IGNORECASE)
+
+
+def register_reader(name, reader, extensions = [], sniff = None):
+    """
+    Register an input reader. 'reader' takes a file name and yields
+    (tag, rows) pairs. 'extensions' lists the file extensions that
+    map to the reader and 'sniff', if given, takes the first non-blank
+    line of a file and returns True if the reader can parse it.
+    """
+    tablefill_readers[name] = {
+        'reader': reader,
+        'extensions': [e.lower().strip('. ') for e in extensions],
+        'sniff': sniff
+    }
+
+
+def get_reader(fname, input_format = None):
+    """
+    Get the reader for 'fname': Forced by 'input_format', sniffed from
+    the first non-blank line, or looked up by extension. stdin ('-')
+    cannot be sniffed and is read as text unless 'input_format' is set.
+    """
+    if input_format is not None:
+        if input_format not in tablefill_readers:
+            unknown_format  = "Input format '%s' not known. Expected one of: "
+            unknown_format += ', '.join(tablefill_readers.keys())
+            raise KeyError(unknown_format % input_format)
+        return tablefill_readers[input_format]['reader']
+    elif fname == '-':
+        return tablefill_readers['text']['reader']
+
+    # Sniff in binary mode (inputs like .dta are not text)
+    firstline = ''
+    with open(fname, 'rb') as fh:
+        for line in fh.read(4096).splitlines(True):
+            if line.strip() != b'':
+                firstline = line.decode('latin-1')
+                break
+
+    for name, entry in tablefill_readers.items():
+        if entry['sniff'] is not None and entry['sniff'](firstline):
+            return entry['reader']
+
+    ext = path.splitext(fname)[-1].lower().strip('. ')
+    for name, entry in tablefill_readers.items():
+        if ext in entry['extensions']:
+            return entry['reader']
+
+    return tablefill_readers['text']['reader']
+
+
+def read_tables(flist, input_format = None):
+    """
+    Lazily yield (tag, rows) pairs from each file in 'flist'
+    """
+    for fname in flist:
+        reader = get_reader(fname, input_format)
+        for tag, rows in reader(fname):
+            yield tag, rows
+
+
+class gc_paused(object):
+    """
+    Pause the garbage collector (process-wide) in a with block. Input
+    tables are millions of small lists that can't form cycles, and
+    collections over the growing heap can take longer than parsing
+    them; parse_tables' worker processes follow the caller's setting.
+    Only for scripts that own the process: not safe while other
+    threads are filling.
+    """
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *args):
+        if self.enabled:
+            gc.enable()
+
+
+def read_tables_file(args):
+    """
+    All the (tag, rows) pairs in one file, for parse_tables' workers
+    """
+    fname, input_format, paused = args
+    if not paused:
+        return list(read_tables([fname], input_format))
+
+    with gc_paused():
+        return list(read_tables([fname], input_format))
+
+
+def parse_tables(flist, input_format = None, ctables = None, jobs = None):
+    """
+    Read the tables in 'flist' into a dictionary with lower-case tags
+    as keys ('ctables', if given, is updated in place), with files
+    parsed in 'jobs' processes if given. See gc_paused to read large
+    inputs faster.
+    """
+    ctables = {} if ctables is None else ctables
+    if futures is None or jobs in [None, 1] or len(flist) < 2:
+        for tag, rows in read_tables(flist, input_format):
+            ctables[tag.lower()] = rows
+    else:
+        # Files are merged in order whichever is parsed first
+        paused = not gc.isenabled()
+        args   = [(fname, input_format, paused) for fname in flist]
+        with futures.ProcessPoolExecutor(max_workers = jobs) as pool:
+            for pairs in pool.map(read_tables_file, args):
+                for tag, rows in pairs:
+                    ctables[tag.lower()] = rows
+
+    return ctables
+
+
+def get_input_files(names):
+    """
+    Replace folders and globs in 'names' with the files they stand for,
+    sorted by name. Raises IOError if one stands for no files.
+    """
+    files = []
+    for name in names:
+        if name == '-' or path.isfile(name):
+            files += [name]
+            continue
+        elif path.isdir(name):
+            shards = [path.join(name, f) for f in listdir(name)
+                      if not f.startswith('.')]
+            shards = [f for f in shards if path.isfile(f)]
+        elif re.search('[*?[]', name):
+            shards = [f for f in glob.glob(name) if path.isfile(f)]
+        else:
+            files += [name]
+            continue
+
+        if shards == []:
+            raise IOError("No input files in '%s'" % name)
+
+        files += sorted(shards)
+
+    return files
+
+
+def read_tables_text(fname):
+    """
+    Tables are tab-delimited rows preceded by a <Tab:tag> line. Rows
+    are split by the csv module; only rows that start with '<tab:' are
+    checked against the tag regex.
+    """
+    tag  = None
+    rows = []
+    strip = str.strip
+    with open_csv(fname) as fh:
+        reader = csv.reader(fh, delimiter = '\t', quoting = csv.QUOTE_NONE)
+        for row in reader:
+            match = None
+            if len(row) == 1 and row[0][:5].lower() == '<tab:':
+                match = re_tab_tag.match(row[0] + '\n')
+
+            if match:
+                if tag is not None:
+                    yield tag, rows
+
+                tag  = match.group(1)
+                rows = []
+            elif tag is not None:
+                if row:
+                    rows.append(list(map(strip, row)))
+            elif ''.join(row).strip() != '':
+                no_tag_msg = "File '%s' has entries before any <Tab:...> line"
+                raise ValueError(no_tag_msg % fname)
+
+    if tag is not None:
+        yield tag, rows
+
+
+def read_tables_delimited(fname, delimiter = ','):
+    """
+    Tables are delimited rows whose first column is the tag. An optional
+    header row starting with 'tag' is skipped. Rows with the same tag
+    must be contiguous; a tag that shows up again replaces the table.
+    """
+    tag  = None
+    rows = []
+    with open_csv(fname) as fh:
+        for n, row in enumerate(csv.reader(fh, delimiter = delimiter)):
+            if row == [] or (n == 0 and row[0].strip().lower() == 'tag'):
+                continue
+
+            rowtag = row[0].strip()
+            match  = re_tab_tag.match(rowtag + linesep)
+            rowtag = match.group(1) if match else rowtag
+            if rowtag != tag:
+                if tag is not None:
+                    yield tag, rows
+
+                tag  = rowtag
+                rows = []
+
+            rows += [[e.strip() for e in row[1:]]]
+
+    if tag is not None:
+        yield tag, rows
+
+
+def read_tables_tsv(fname):
+    return read_tables_delimited(fname, delimiter = '\t')
+
+
+def read_tables_jsonl(fname):
+    """
+    Each line is one table: {"tag": "name", "data": [[1, 2], [3, 4]]}
+    """
+    def json_entry(x):
+        if x is None:
+            return ''
+        elif isinstance(x, float):
+            return repr(x)
+        elif isinstance(x, basestring):
+            return x
+        else:
+            return str(x)
+
+    with open_text(fname) as fh:
+        for n, line in enumerate(fh):
+            if line.strip() == '':
+                continue
+
+            try:
+                table = json.loads(line)
+                tag   = table['tag']
+                data  = table['data']
+            except (ValueError, KeyError, TypeError):
+                json_msg = "Line %d of '%s' is not a JSON object with"
+                json_msg += " 'tag' and 'data' keys"
+                raise ValueError(json_msg % (n + 1, fname))
+
+            rows = [[json_entry(e) for e in tolist(row)] for row in data]
+            yield tag, rows
+
+
+def read_tables_dta(fname):
+    """
+    Stata .dta files (format 117 and later). If the data has a string
+    variable named 'tag', rows are grouped into tables by its value
+    (rows with the same tag must be contiguous); otherwise the file is
+    one table tagged with the file name. Missing values are read as
+    '.' or '.a' through '.z'.
+    """
+    with open_binary(fname) as fh:
+        dta = fh.read()
+
+    def after(name, start = 0):
+        i = dta.find(b'<' + name + b'>', start)
+        if i < 0:
+            dta_tag_msg = "File '%s' is missing the <%s> section"
+            raise ValueError(dta_tag_msg % (fname, name.decode('ascii')))
+        return i + len(name) + 2
+
+    if not dta.startswith(b'<stata_dta>'):
+        dta_format_msg = "File '%s' is not a Stata .dta file of format 117+"
+        raise ValueError(dta_format_msg % fname)
+
+    i       = after(b'release')
+    release = int(dta[i:i + 3])
+    if release not in [117, 118, 119]:
+        dta_release_msg = "File '%s' has unsupported .dta format %d"
+        raise ValueError(dta_release_msg % (fname, release))
+
+    bo  = '>' if dta[after(b'byteorder'):].startswith(b'MSF') else '<'
+    K   = struct.unpack_from(bo + ('I' if release == 119 else 'H'),
+                             dta, after(b'K'))[0]
+    N   = struct.unpack_from(bo + ('I' if release == 117 else 'Q'),
+                             dta, after(b'N'))[0]
+    smap     = struct.unpack_from(bo + '14Q', dta, after(b'map'))
+    vtypes   = struct.unpack_from(bo + '%dH' % K, dta,
+                                  after(b'variable_types', smap[2]))
+    namelen  = 33 if release == 117 else 129
+    encoding = 'latin-1' if release == 117 else 'utf-8'
+
+    def dta_str(raw):
+        return raw.split(b'\0', 1)[0].decode(encoding, 'replace')
+
+    i = after(b'varnames', smap[3])
+    varnames = [dta_str(dta[i + k * namelen:i + (k + 1) * namelen])
+                for k in range(K)]
+
+    # strL contents are stored once in <strls> as (v, o)-keyed GSOs
+    strls = {}
+    i     = after(b'strls', smap[10])
+    olen  = 4 if release == 117 else 8
+    while dta[i:i + 3] == b'GSO':
+        v, o = struct.unpack_from(bo + 'I' + ('I' if olen == 4 else 'Q'),
+                                  dta, i + 3)
+        t, n = struct.unpack_from(bo + 'BI', dta, i + 7 + olen)
+        i   += 12 + olen
+        raw  = dta[i:i + n]
+        strls[(v, o)] = dta_str(raw) if t == 130 else raw.decode('latin-1')
+        i   += n
+
+    vbits = {117: 32, 118: 16, 119: 24}[release]
+    if bo == '<':
+        def strl_key(q):
+            return (q & ((1 << vbits) - 1), q >> vbits)
+    else:
+        def strl_key(q):
+            return (q >> (64 - vbits), q & ((1 << (64 - vbits)) - 1))
+
+    def dta_missing(code):
+        return '.' if code == 0 else '.' + chr(ord('a') + code - 1)
+
+    def dta_int(cutoff):
+        def convert(v):
+            return str(v) if v <= cutoff else dta_missing(v - cutoff - 1)
+        return convert
+
+    def dta_float(v):
+        if v >= 2.0 ** 127:
+            bits = struct.unpack('<I', struct.pack('<f', v))[0]
+            return dta_missing((bits - 0x7f000000) >> 11)
+        for digits in range(7, 10):
+            s = '%.*g' % (digits, v)
+            if struct.unpack('<f', struct.pack('<f', float(s)))[0] == v:
+                return s
+        return repr(v)
+
+    def dta_double(v):
+        if v >= 2.0 ** 1023:
+            bits = struct.unpack('<Q', struct.pack('<d', v))[0]
+            return dta_missing((bits - 0x7fe0000000000000) >> 40)
+        elif v == int(v) and abs(v) < 1e15:
+            return '%d' % v
+        return repr(v)
+
+    # Each record is parsed with a single struct; strLs are read as
+    # 8-byte integers and looked up in the GSO dictionary.
+    codes   = []
+    convert = []
+    for vtype in vtypes:
+        if vtype <= 2045:
+            codes   += ['%ds' % vtype]
+            convert += [dta_str]
+        elif vtype == 32768:
+            codes   += ['Q']
+            convert += [lambda q: strls.get(strl_key(q), '')]
+        elif vtype == 65526:
+            codes   += ['d']
+            convert += [dta_double]
+        elif vtype == 65527:
+            codes   += ['f']
+            convert += [dta_float]
+        elif vtype == 65528:
+            codes   += ['i']
+            convert += [dta_int(2147483620)]
+        elif vtype == 65529:
+            codes   += ['h']
+            convert += [dta_int(32740)]
+        elif vtype == 65530:
+            codes   += ['b']
+            convert += [dta_int(100)]
+        else:
+            dta_type_msg = "File '%s' has unknown Stata type %d"
+            raise ValueError(dta_type_msg % (fname, vtype))
+
+    record = struct.Struct(bo + ''.join(codes))
+    start  = after(b'data', smap[9])
+    block  = dta[start:start + N * record.size]
+    if hasattr(record, 'iter_unpack'):
+        records = record.iter_unpack(block)
+    else:
+        records = (record.unpack_from(block, n * record.size)
+                   for n in range(N))
+
+    lower = [v.lower() for v in varnames]
+    if 'tag' in lower and (vtypes[lower.index('tag')] <= 2045 or
+                           vtypes[lower.index('tag')] == 32768):
+        t = lower.index('tag')
+    else:
+        t = None
+
+    tag  = path.splitext(path.basename(fname))[0] if t is None else None
+    rows = []
+    cols = [k for k in range(K) if k != t]
+    for rec in records:
+        if t is not None:
+            rowtag = convert[t](rec[t])
+            if rowtag != tag:
+                if tag is not None:
+                    yield tag, rows
+
+                tag  = rowtag
+                rows = []
+
+        rows += [[convert[k](rec[k]) for k in cols]]
+
+    if tag is not None:
+        yield tag, rows
+
+
+register_reader('text', read_tables_text,
+                extensions = ['txt'],
+                sniff = lambda line: re_tab_tag.match(line) is not None)
+register_reader('jsonl', read_tables_jsonl,
+                extensions = ['jsonl', 'ndjson'],
+                sniff = lambda line: line.lstrip().startswith('{'))
+register_reader('csv', read_tables_delimited, extensions = ['csv'])
+register_reader('tsv', read_tables_tsv, extensions = ['tsv', 'tab'])
+register_reader('dta', read_tables_dta,
+                extensions = ['dta'],
+                sniff = lambda line: line.startswith('<stata_dta>'))
+
+
+# ---------------------------------------------------------------------
+# tablefill_store
+
+class tablefill_store:
+    """
+    SQLite-backed store of input tables. Tags are indexed and entries
+    are stored one per row, as text (the value tablefill fills in) and
+    as a number when they parse as one. The database uses write-ahead
+    logging so any number of fill processes can read it while another
+    process ingests new inputs.
+
+    Usage
+    -----
+    with tablefill_store('tables.db') as store:
+        store.ingest(['tables1.txt', 'tables2.txt'])
+        tables = store.get_tables(['tag1', 'tag2'])
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS sources (
+            source TEXT PRIMARY KEY,
+            mtime  REAL,
+            size   INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS tables (
+            tag    TEXT PRIMARY KEY,
+            source TEXT,
+            nrows  INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS entries (
+            tag    TEXT,
+            row    INTEGER,
+            col    INTEGER,
+            value  TEXT,
+            num    REAL,
+            PRIMARY KEY (tag, row, col))""",
+        """CREATE INDEX IF NOT EXISTS tables_source ON tables (source)"""
+    ]
+
+    # Tags per query (SQLite allows 999 parameters before 3.32)
+    batch = 500
+
+    def __init__(self, dbfile, readonly = False, timeout = 60):
+        if not sqliteok:
+            raise ImportError("Table stores require python's sqlite3 module")
+
+        self.dbfile   = path.abspath(dbfile)
+        self.readonly = readonly
+        if readonly:
+            if not path.isfile(self.dbfile):
+                raise IOError("Store '%s' does not exist" % self.dbfile)
+            try:
+                uri = 'file:%s?mode=ro' % pathname2url(self.dbfile)
+                self.conn = sqlite3.connect(uri, timeout = timeout, uri = True)
+            except TypeError:
+                # Python < 3.4 cannot open read-only connections
+                self.conn = sqlite3.connect(self.dbfile, timeout = timeout)
+        else:
+            self.conn = sqlite3.connect(self.dbfile, timeout = timeout)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            with self.conn:
+                for statement in self.schema:
+                    self.conn.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def ingest(self, flist, input_format = None, force = False):
+        """
+        Load input files into the store. Files whose modification time
+        and size are unchanged since they were last ingested are skipped
+        unless 'force' is set. Tags in later files replace tags already
+        in the store. Returns the list of files that were (re-)read.
+        """
+        ingested = []
+        for fname in flist:
+            fname = path.abspath(fname)
+            stat  = (path.getmtime(fname), path.getsize(fname))
+            query = 'SELECT mtime, size FROM sources WHERE source = ?'
+            known = self.conn.execute(query, (fname,)).fetchone()
+            if known is not None and tuple(known) == stat and not force:
+                continue
+
+            with self.conn:
+                self.drop_source(fname)
+                for tag, rows in read_tables([fname], input_format):
+                    self.put_table(tag.lower(), rows, fname)
+
+                self.conn.execute('INSERT OR REPLACE INTO sources'
+                                  ' VALUES (?, ?, ?)', (fname,) + stat)
+
+            ingested += [fname]
+
+        return ingested
+
+    def drop_source(self, source):
+        self.conn.execute('DELETE FROM entries WHERE tag IN'
+                          ' (SELECT tag FROM tables WHERE source = ?)',
+                          (source,))
+        self.conn.execute('DELETE FROM tables WHERE source = ?', (source,))
+
+    def put_table(self, tag, rows, source = None):
+        def typed_entries():
+            for i, row in enumerate(rows):
+                for j, value in enumerate(row):
+                    yield tag, i, j, value, custom_convert(value, float)
+
+        self.conn.execute('DELETE FROM entries WHERE tag = ?', (tag,))
+        self.conn.execute('INSERT OR REPLACE INTO tables VALUES (?, ?, ?)',
+                          (tag, source, len(rows)))
+        self.conn.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+                              typed_entries())
+
+    def tags(self):
+        return [t for (t,) in self.conn.execute('SELECT tag FROM tables')]
+
+    def get_tables(self, tags):
+        """
+        Get a dictionary with tags as keys and lists of rows as values
+        for the requested tags that are in the store.
+        """
+        tables = {}
+        tags   = sorted(set(tags))
+        for i in range(0, len(tags), self.batch):
+            batch  = tags[i:(i + self.batch)]
+            query  = 'SELECT t.tag, e.row, e.value FROM tables t'
+            query += ' LEFT JOIN entries e ON e.tag = t.tag'
+            query += ' WHERE t.tag IN (%s)' % ', '.join(['?'] * len(batch))
+            query += ' ORDER BY t.tag, e.row, e.col'
+            last = None
+            for tag, row, value in self.conn.execute(query, batch):
+                rows = tables.setdefault(tag, [])
+                if row is None:
+                    continue
+                elif (tag, row) != last:
+                    rows += [[]]
+                    last  = (tag, row)
+                rows[-1] += [value]
+
+        return tables
+
+
+# ---------------------------------------------------------------------
+# tablefill_compile
+#
+# Each compile job runs in the output's directory (no chdir) with a
+# per-command timeout. LaTeX is re-run only while the .aux file keeps
+# changing, and bibtex only when the citations in the .aux changed.
+
+compilers = {
+    'tex': ['xelatex', '-interaction=nonstopmode', '-halt-on-error'],
+    'lyx': ['lyx', '-e', 'pdf2'],
+    'md':  ['pandoc', '-i']
+}
+
+bibtex_programs = {
+    'tex': ['bibtex']
+}
+
+
+def file_digest(fname, keep = None):
+    """
+    Hash of the contents of 'fname' (None if it does not exist). If
+    'keep' is given, only lines for which keep(line) is True count.
+    """
+    if not path.isfile(fname):
+        return None
+
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as fh:
+        for line in fh:
+            if keep is None or keep(line):
+                digest.update(line)
+
+    return digest.hexdigest()
+
+
+def run_program(cmd, cwd, timeout = None, verbose = False):
+    """
+    Run 'cmd' in 'cwd'; returns (status, msg) with status one of
+    SUCCESS, ERROR, TIMEOUT.
+    """
+    proc = subprocess.Popen(cmd,
+                            cwd    = cwd,
+                            stdin  = subprocess.PIPE,
+                            stdout = subprocess.PIPE,
+                            stderr = subprocess.STDOUT)
+    try:
+        if version_info >= (3, 3):
+            out = proc.communicate(timeout = timeout)[0]
+        else:
+            out = proc.communicate()[0]
+    except TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        timeout_msg = "'%s' timed out after %s seconds"
+        return 'TIMEOUT', timeout_msg % (' '.join(cmd), timeout)
+
+    out = out.decode('utf-8', 'replace')
+    print_verbose(verbose, out)
+    if proc.returncode != 0:
+        error_msg = "'%s' exited with status %d"
+        return 'ERROR', error_msg % (' '.join(cmd), proc.returncode)
+
+    return 'SUCCESS', ''
+
+
+def compile_output(output,
+                   filetype,
+                   bibtex   = False,
+                   timeout  = None,
+                   maxruns  = 4,
+                   compiler = None,
+                   bibtex_program = None,
+                   verbose  = False):
+    """
+    Compile a filled template. Returns (status, msg) with status one
+    of SUCCESS, WARNING (the .aux or .bbl still changed after maxruns
+    LaTeX runs), ERROR, TIMEOUT.
+
+    Args:
+        output (str): Filled template
+        filetype (str): lyx, tex, or md
+
+    Kwargs:
+        bibtex (bool): Run bibtex when citations changed
+        timeout (float): Seconds allowed per command (None for no limit)
+        maxruns (int): Maximum number of LaTeX runs
+        compiler (list): Override the compiler command
+        bibtex_program (list): Override the bibtex command
+        verbose (bool): Print the programs' output
+    """
+    output  = path.abspath(output)
+    cwd     = path.dirname(output)
+    base    = path.splitext(path.basename(output))[0]
+    auxfile = path.join(cwd, base + '.aux')
+    bblfile = path.join(cwd, base + '.bbl')
+
+    compiler = compilers[filetype] if compiler is None else compiler
+    compile_cmd = list(compiler) + [path.basename(output)]
+
+    if bibtex_program is None:
+        bibtex_program = bibtex_programs.get(filetype, None)
+
+    if bibtex and bibtex_program is None:
+        bibtex_note = "NOTE: Not sure how to run BiBTeX for '%s' files."
+        print_verbose(verbose, bibtex_note % filetype)
+        bibtex = False
+
+    # Only citation-related lines in the .aux matter for bibtex
+    def citations(line):
+        return line.startswith((b'\\citation', b'\\bibdata', b'\\bibstyle'))
+
+    cite_digest = file_digest(auxfile, citations)
+    aux_digest  = file_digest(auxfile)
+    runs        = 0
+    rerun       = False
+    while runs < maxruns:
+        status, msg = run_program(compile_cmd, cwd, timeout, verbose)
+        runs += 1
+        if status != 'SUCCESS' or filetype != 'tex':
+            return status, msg
+
+        rerun = False
+        if bibtex:
+            new_cite_digest = file_digest(auxfile, citations)
+            if new_cite_digest != cite_digest or not path.isfile(bblfile):
+                bbl_digest = file_digest(bblfile)
+                bibtex_cmd = list(bibtex_program) + [base]
+                status, msg = run_program(bibtex_cmd, cwd, timeout, verbose)
+                if status != 'SUCCESS':
+                    return status, msg
+
+                rerun = file_digest(bblfile) != bbl_digest
+
+            cite_digest = new_cite_digest
+
+        new_aux_digest = file_digest(auxfile)
+        rerun = rerun or new_aux_digest != aux_digest
+        aux_digest = new_aux_digest
+        if not rerun:
+            break
+
+    if rerun:
+        rerun_msg  = "Compiled '%s' in %d run(s) but the .aux or .bbl file"
+        rerun_msg += " was still changing; references may be stale"
+        return 'WARNING', rerun_msg % (output, runs)
+
+    return 'SUCCESS', "Compiled '%s' in %d run(s)" % (output, runs)
+
+
+def compile_outputs(outputs, filetype, jobs = None, **kwargs):
+    """
+    Compile several filled templates in parallel (see compile_output
+    for the other options). Returns a list of (output, status, msg)
+    in the same order as 'outputs'.
+    """
+    def compile_one(output):
+        return (output,) + compile_output(output, filetype, **kwargs)
+
+    if futures is None or jobs == 1 or len(outputs) < 2:
+        return [compile_one(output) for output in outputs]
+
+    with futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+        return list(pool.map(compile_one, outputs))
+
+
+# ---------------------------------------------------------------------
+# tablefill_missing
+
+class tablefill_missing:
+    """
+    Compiled missing-value policy: a set of literal tokens plus optional
+    regexes and special values. Special values are
+
+        nan     NaN in any case, with or without a sign
+        inf     Inf or Infinity in any case, with or without a sign
+        stata   Stata missing values '.' and '.a' through '.z'
+
+    The policy is applied once per table; entries are only checked
+    against the regexes if they are not literal matches and, for the
+    special values, only if their first character could start one.
+
+    Usage
+    -----
+    missing = tablefill_missing(['', 'NA'], regexes = ['-+'],
+                                special = ['nan', 'inf', 'stata'])
+    missing.filter(['1', '.b', '-Inf', '---', '2'])  # ['1', '2']
+    """
+
+    special_regexes = {
+        'nan':   (r'[+-]?nan', '+-nN'),
+        'inf':   (r'[+-]?inf(?:inity)?', '+-iI'),
+        'stata': (r'\.[a-z]?', '.')
+    }
+
+    def __init__(self,
+                 literals = ['.', '', 'NA', 'nan', 'NaN', 'None', 'Inf', 'INF'],
+                 regexes  = [],
+                 special  = []):
+        unknown = [s for s in special if s not in self.special_regexes]
+        if unknown != []:
+            unknown_msg  = "Unknown special missing value(s) '%s'."
+            unknown_msg += " Expected one of: nan, inf, stata"
+            raise KeyError(unknown_msg % "', '".join(unknown))
+
+        self.literals = frozenset(literals)
+        self.regexes  = list(regexes)
+        self.special  = list(special)
+
+        if self.special != []:
+            spec  = [self.special_regexes[s] for s in self.special]
+            first = ''.join(f for (r, f) in spec)
+            match = re.compile('(?:%s)\\Z' % '|'.join(r for (r, f) in spec),
+                               flags = re.IGNORECASE).match
+            self.special_match = lambda e: e[:1] in first and match(e)
+        else:
+            self.special_match = None
+
+        if self.regexes != []:
+            self.regex_match = re.compile('(?:%s)\\Z' % '|'.join(
+                '(?:%s)' % r for r in self.regexes)).match
+        else:
+            self.regex_match = None
+
+    def get_key(self):
+        """
+        The policy as a JSON-serializable list, for hashing
+        """
+        return [sorted(self.literals), self.regexes, sorted(self.special)]
+
+    def is_missing(self, entry):
+        return entry in self.literals or \
+            bool(self.special_match and self.special_match(entry)) or \
+            bool(self.regex_match and self.regex_match(entry))
+
+    def filter(self, entries):
+        literals = self.literals
+        entries  = [e for e in entries if e not in literals]
+        for match in [self.special_match, self.regex_match]:
+            if match is not None:
+                entries = [e for e in entries if not match(e)]
+
+        return entries
+
+
+# ---------------------------------------------------------------------
+# stata_dates
+#
+# #{fmt}unit# placeholders format Stata dates, stored as periods since
+# 01Jan1960: 'date' or 'td' (days), 'time' (seconds), 'tc' (milliseconds,
+# without leap seconds, as %tc), 'tw' (weeks), 'tm' (months), 'tq'
+# (quarters), or 'th' (half-years). Weeks, months, quarters, and halves
+# are converted to their first day.
+
+stata_epoch = datetime(1960, 1, 1)
+stata_epoch_ordinal = stata_epoch.toordinal()
+stata_months = {'tm': 1, 'tq': 3, 'th': 6}
+
+
+def stata_datetime(value, unit):
+    """
+    datetime for the integer Stata date 'value' in 'unit'
+    """
+    if unit in ['date', 'td']:
+        return datetime.fromordinal(stata_epoch_ordinal + value)
+    elif unit == 'time':
+        return stata_epoch + timedelta(seconds = value)
+    elif unit == 'tc':
+        return stata_epoch + timedelta(milliseconds = value)
+    elif unit == 'tw':
+        # Stata years have 52 weeks; the last one has the leftover days
+        year, week = divmod(value, 52)
+        return datetime(1960 + year, 1, 1) + timedelta(days = 7 * week)
+    else:
+        year, month = divmod(value * stata_months[unit], 12)
+        return datetime(1960 + year, month + 1, 1)
+
+
+# ---------------------------------------------------------------------
+# tablefill_placeholders
+#
+# Besides the built-in ###, #*#, #\d+#, and #{}# placeholders, users can
+# register their own. A placeholder type has a regex that matches the
+# whole placeholder and a formatter that is called once per distinct
+# placeholder with the regex's groups; it returns the function that
+# fills each table entry (a string) into that placeholder.
+
+tablefill_placeholders = OrderedDict()
+
+
+def get_callable_name(func):
+    """
+    module.name of a function, to tell registered formatters apart
+    """
+    name = getattr(func, '__name__', type(func).__name__)
+    return '%s.%s' % (getattr(func, '__module__', None), name)
+
+
+def register_placeholder(name, regex, formatter):
+    """
+    Register a placeholder type. 'regex' matches the whole placeholder
+    in the template and 'formatter(*groups)' returns a function that
+    takes a table entry and returns the text to fill in. For instance,
+    #@2# to show an entry in thousands with 2 digits:
+
+        register_placeholder('thousands', r'#@(\d+)#',
+                             lambda digits: lambda entry:
+                                 '%.*f' % (int(digits), float(entry) / 1000))
+
+    Built-in placeholders take precedence. Placeholder types are kept
+    per python process.
+    """
+    re.compile(regex)
+    tablefill_placeholders[name] = {
+        'regex': regex,
+        'formatter': formatter
+    }
+
+
+# ---------------------------------------------------------------------
+# tablefill_hooks
+#
+# Hooks let users trace a fill (say, a span per template and per table)
+# without changing the engine. A hook is called as hook(event, stage,
+# info) with event 'start' or 'end' around each stage of a fill:
+#
+#     template  the whole fill        (template, output; exit at end)
+#     parse     reading the inputs    (input; tags at end)
+#     xml       custom XML tables     (xml; tags at end)
+#     region    each table filled     (tag, line; end, entries at end)
+#     lines     each line filled      (tag, line, slots, entry; entries at end)
+#     write     writing the output    (output; bytes at end)
+#
+# 'info' is the same dict at start and end, so a hook can keep state in
+# it. Hooks run in the thread doing the fill and an exception in a hook
+# fails the fill. The engine takes the hooks registered when it starts
+# and looks up each stage's hooks once per fill, so a stage nobody hooks
+# costs a truth test per table or line. A table with no end closes its
+# region at the end of the template (end is None).
+
+hook_stages     = ['template', 'parse', 'xml', 'region', 'lines', 'write']
+tablefill_hooks = OrderedDict((stage, []) for stage in hook_stages)
+
+
+def register_hook(stage, hook):
+    """
+    Register hook(event, stage, info) to be called at the start and end
+    of 'stage' (one of hook_stages). For instance, to count the
+    placeholders filled by kind:
+
+        counts = Counter()
+        def count_slots(event, stage, info):
+            if event == 'end':
+                counts.update(kind for (kind, cell, spec) in info['slots'])
+
+        register_hook('lines', count_slots)
+
+    Hooks are kept per python process.
+    """
+    if stage not in tablefill_hooks:
+        unknown_stage  = "Hook stage '%s' not known. Expecting one of: %s"
+        unknown_stage %= (stage, ', '.join(hook_stages))
+        raise KeyError(unknown_stage)
+
+    tablefill_hooks[stage].append(hook)
+    return hook
+
+
+def remove_hook(stage, hook):
+    """
+    Remove a hook added with register_hook
+    """
+    tablefill_hooks[stage].remove(hook)
+
+
+def get_hooks():
+    """
+    Copy of the hooks registered, with only the stages that have any
+    """
+    return dict((stage, tuple(hooks))
+                for (stage, hooks) in tablefill_hooks.items() if hooks)
+
+
+def run_hooks(hooks, event, stage, info):
+    for hook in hooks:
+        hook(event, stage, info)
+
+
+# ---------------------------------------------------------------------
+# tablefill_plan
+#
+# A fill plan is the result of scanning a template once: which lines
+# begin and end a table (and the table's label), and every line with
+# placeholders split into literal text and slots. Filling a template
+# then only walks the plan. Plans are cached in memory and, if given a
+# directory, on disk, keyed by a hash of the template and the regexes.
+#
+# A 'tablefill:matrix fmt=...' line in a table expands to the whole
+# matrix of the table's tag, one row per input row, with the fmt
+# placeholders formatting each column (the last one the rest): LaTeX
+# rows (a & b \\) after a '% tablefill:matrix' comment, Markdown rows
+# (| a | b |) after a '<!-- tablefill:matrix -->' comment, and, in LyX,
+# copies of the row whose first cell says 'tablefill:matrix'.
+
+fill_plan_version    = 2
+fill_sidecar_version = 1
+fill_plans           = OrderedDict()
+fill_plans_max       = 32
+fill_plans_lock      = threading.Lock()
+
+
+class tablefill_plan:
+    """
+    Compiled template. Attributes are
+
+        begin   {line: label} for lines that begin a table ('' if the
+                table has no label)
+        end     set of lines that end a table
+        lines   {line: (commented, literals, slots)} for lines with
+                placeholders; literals[i] precedes slots[i], and each
+                slot is (kind, placeholder, spec) where kind is one of
+
+                    '#'  replace with the entry (spec: [])
+                    '*'  p-value to stars (spec: [])
+                    'b'  rounding (spec: [digits, ',' or '%', abs])
+                    'f'  python format (spec: [format, date unit or None])
+                    'c'  registered placeholder (spec: [name, groups])
+                    'a'  addressed cell (spec: [tag, row, col, slot])
+
+        addressed whether any line has an addressed slot
+
+        matrices {line: (slots, layout)} for tablefill:matrix lines; a
+                slot per fmt placeholder, and the layout of the rows:
+                {'indent': ...} for LaTeX and Markdown, and for LyX the
+                first and last lines of the row to copy ('row'), the
+                line with its lyxtabular ('tabular'), and the row's
+                opening <row> and <cell> tags ('open', 'cells')
+    """
+    def __init__(self, key, begin = [], end = [], lines = [], matrices = []):
+        self.key   = key
+        self.begin = dict((n, label) for (n, label) in begin)
+        self.end   = set(end)
+        self.lines = {}
+        self.addressed = False
+        for (n, commented, literals, slots) in lines:
+            slots = [tuple(slot) for slot in slots]
+            self.lines[n] = (commented, literals, slots)
+            self.addressed = self.addressed or any(s[0] == 'a' for s in slots)
+
+        self.matrices = {}
+        for (n, slots, layout) in matrices:
+            self.matrices[n] = ([tuple(slot) for slot in slots], layout)
+
+    def save(self, fname):
+        """
+        Write the plan to 'fname' as JSON (via a temporary file, so
+        concurrent fills never read a partial plan).
+        """
+        plan = {'version': fill_plan_version,
+                'key':     self.key,
+                'begin':   sorted(self.begin.items()),
+                'end':     sorted(self.end),
+                'lines':   [[n] + list(self.lines[n])
+                            for n in sorted(self.lines)],
+                'matrices': [[n] + list(self.matrices[n])
+                             for n in sorted(self.matrices)]}
+
+        # Failing to cache the plan is not an error
+        tmp = None
+        try:
+            if not path.isdir(path.dirname(fname)):
+                makedirs(path.dirname(fname))
+
+            fh, tmp = mkstemp_for(fname)
+            with fdopen(fh, 'w') as out:
+                json.dump(plan, out)
+
+            rename(tmp, fname)
+        except (IOError, OSError):
+            if tmp is not None and path.isfile(tmp):
+                remove(tmp)
+
+    @staticmethod
+    def load(fname, key):
+        """
+        Read a plan saved by save(); None if it is not a plan for 'key'.
+        """
+        try:
+            with open(fname, 'r') as fh:
+                plan = json.load(fh)
+
+            if plan['version'] != fill_plan_version or plan['key'] != key:
+                return None
+
+            return tablefill_plan(key,
+                                  plan['begin'],
+                                  plan['end'],
+                                  plan['lines'],
+                                  plan['matrices'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+
+def get_plan_key(lines, regexes):
+    digest  = hashlib.sha1()
+    options = json.dumps([fill_plan_version, sorted(regexes.items())])
+    digest.update(options.encode('utf-8'))
+    for line in lines:
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+
+        digest.update(line)
+
+    return digest.hexdigest()
+
+
+def full_match(regex, text):
+    match = regex.match(text)
+    return match if match and match.end() == len(text) else None
+
+
+def find_label(lines, start, label, end):
+    r"""
+    Search for 'label' in 'lines' from position 'start' until the first
+    line matching 'end' (e.g. \end{table}). Returns the label ('' if none
+    is found before the table ends).
+    """
+    for n in range(start, len(lines)):
+        if re.search(end, lines[n]):
+            return ''
+
+        if re.search(label, lines[n], flags = re.IGNORECASE):
+            found = re.findall(label, lines[n], flags = re.IGNORECASE)[0]
+            return found.strip('{}"').lower()
+
+    return ''
+
+
+def find_lyx_row(lines, n):
+    """
+    The LyX table row around line n: its first and last lines and the
+    line with the table's lyxtabular tag (None if not in a row)
+    """
+    start = n
+    while start >= 0 and not lines[start].startswith('<row'):
+        if lines[start].startswith('</row>'):
+            return None
+        start -= 1
+
+    end = n
+    while end < len(lines) and not lines[end].startswith('</row>'):
+        end += 1
+
+    tabular = start
+    while tabular >= 0 and not lines[tabular].startswith('<lyxtabular'):
+        tabular -= 1
+
+    if start < 0 or end == len(lines) or tabular < 0:
+        return None
+
+    return start, end, tabular
+
+
+def get_matrix_layout(lines, n, directive, rows):
+    """
+    Layout of the rows a tablefill:matrix line expands to (see
+    tablefill_plan); None if a LyX directive is not in a table row.
+    """
+    if rows != 'lyx':
+        return {'indent': directive.group(1)}
+
+    found = find_lyx_row(lines, n)
+    if found is None:
+        return None
+
+    start, end, tabular = found
+    cells = [lines[i].rstrip('\r\n') for i in range(start, end)
+             if lines[i].startswith('<cell')]
+    return {'row': [start, end],
+            'tabular': tabular,
+            'open': lines[start].rstrip('\r\n'),
+            'cells': cells}
+
+
+def compile_slot(cell, matcha, matchb, matchd, matchf, custom, matcht = None):
+    """
+    Plan slot (kind, cell, spec) for placeholder 'cell'; None if it is
+    not a full match of any placeholder. An addressed placeholder,
+    #tab:tag[row,col]|fmt#, is kind 'a' with spec [tag, row, col, slot]
+    where slot is the plan slot of the placeholder #fmt# (### if there
+    is no |fmt).
+    """
+    cella, cellb, cellf = [full_match(regex, cell)
+                           for regex in (matcha, matchb, matchf)]
+    cellt = None if matcht is None else full_match(matcht, cell)
+    if cellt:
+        tag, row, col, fmt = cellt.groups()
+        inner = '#%s#' % ('#' if fmt is None else fmt)
+        inner = compile_slot(inner, matcha, matchb, matchd, matchf, custom)
+        if inner is None or int(row) < 1 or int(col) < 1:
+            return None
+
+        kind = 'a'
+        spec = [tag.lower(), int(row), int(col), list(inner)]
+    elif cella:
+        kind = '*' if '*' in cella.groups() else '#'
+        spec = []
+    elif cellb:
+        precision, comma = cellb.groups()
+        kind = 'b'
+        spec = [int(precision), comma, bool(matchd.search(cell))]
+    elif cellf:
+        kind = 'f'
+        spec = [cellf.group(1), cellf.group(3)]
+    else:
+        for name, regex in custom:
+            cellc = full_match(regex, cell)
+            if cellc:
+                kind = 'c'
+                spec = [name, list(cellc.groups())]
+                break
+        else:
+            return None
+
+    return (kind, cell, spec)
+
+
+def compile_plan(lines, regexes, key = None):
+    """
+    Scan template 'lines' into a tablefill_plan. 'regexes' has the
+    engine's begin, end, label, comments, match0, matcha, matchb,
+    matchd, matchf, matcht, and matrix regexes, the style of matrix rows
+    (matrix_rows: tex, lyx, or md), and the (name, regex) of
+    registered placeholders.
+    """
+    begin    = []
+    end      = []
+    plines   = []
+    matrices = []
+    custom   = [(name, re.compile(regex))
+                for (name, regex) in regexes.get('placeholders', [])]
+    match0   = [regexes['match0'], regexes['matcht']]
+    match0  += [c.pattern for (name, c) in custom]
+    match0   = re.compile('|'.join('(?:%s)' % regex for regex in match0))
+    matcha   = re.compile(regexes['matcha'])
+    matchb   = re.compile(regexes['matchb'])
+    matchd   = re.compile(regexes['matchd'])
+    matchf   = re.compile(regexes['matchf'])
+    matcht   = re.compile(regexes['matcht'])
+    comments = re.compile(regexes['comments'])
+    matrix   = re.compile(regexes['matrix'])
+    slotargs = (matcha, matchb, matchd, matchf, custom, matcht)
+    for n, line in enumerate(lines):
+        if re.search(regexes['begin'], line):
+            label  = find_label(lines, n, regexes['label'], regexes['end'])
+            begin += [(n, label)]
+
+        if re.search(regexes['end'], line):
+            end += [n]
+
+        directive = matrix.search(line)
+        if directive:
+            layout = get_matrix_layout(lines, n, directive, regexes['matrix_rows'])
+            fmt    = re.search(r'\bfmt\s*=\s*(\S+)', directive.group(2))
+            fmt    = '###' if fmt is None else fmt.group(1)
+            slots  = [compile_slot(m.group(0), *slotargs)
+                      for m in match0.finditer(fmt)]
+            slots  = [slot for slot in slots if slot is not None and slot[0] != 'a']
+            if layout is not None and slots:
+                matrices += [(n, slots, layout)]
+                continue
+
+        if not (matcha.search(line) or matchb.search(line) or matchf.search(line)):
+            if not (matcht.search(line) or any(c.search(line) for (name, c) in custom)):
+                continue
+
+        # Placeholders that are not a full ###, #*#, #\d+#, #{}#, or
+        # #tab:tag[row,col]# match are left as literal text
+        literals = []
+        slots    = []
+        last     = 0
+        for match in match0.finditer(line):
+            slot = compile_slot(match.group(0), *slotargs)
+            if slot is None:
+                continue
+
+            literals += [line[last:match.start()]]
+            slots    += [slot]
+            last      = match.end()
+
+        literals += [line[last:]]
+        commented = bool(comments.search(line.strip()))
+        plines   += [(n, commented, literals, slots)]
+
+    # LyX rows that a matrix replaces are not filled themselves
+    rows   = [layout['row'] for (n, slots, layout) in matrices if 'row' in layout]
+    plines = [p for p in plines if not any(a <= p[0] <= b for (a, b) in rows)]
+    if key is None:
+        key = get_plan_key(lines, regexes)
+
+    return tablefill_plan(key, begin, end, plines, matrices)
+
+
+def get_fill_plan(lines, regexes, cache_dir = None):
+    """
+    Get the fill plan for template 'lines': from memory, from
+    'cache_dir' (if given), or compiled and saved to 'cache_dir'.
+    Returns (plan, source) with source one of 'memory', 'disk', None.
+    """
+    key = get_plan_key(lines, regexes)
+    with fill_plans_lock:
+        if key in fill_plans:
+            fill_plans[key] = fill_plans.pop(key)
+            return fill_plans[key], 'memory'
+
+    plan   = None
+    source = None
+    if cache_dir is not None:
+        fname = path.join(cache_dir, key + '.json')
+        if path.isfile(fname):
+            plan   = tablefill_plan.load(fname, key)
+            source = None if plan is None else 'disk'
+
+    if plan is None:
+        plan = compile_plan(lines, regexes, key)
+        if cache_dir is not None:
+            plan.save(fname)
+
+    with fill_plans_lock:
+        fill_plans[key] = plan
+        while len(fill_plans) > fill_plans_max:
+            fill_plans.popitem(last = False)
+
+    return plan, source
+
+
+# ---------------------------------------------------------------------
+# tablefill_xml_sandbox
+#
+# Custom XML tables can be evaluated in a pool of worker processes
+# (tablefill's 'xml_jobs'), so an expression that never ends or that
+# allocates too much only fails its own tag. Each expression has a
+# wall-clock limit (an alarm in the worker; the pool is killed if the
+# worker does not answer in time anyway) and a limit on the memory it
+# can add to the worker (where RLIMIT_AS is available). Tables that do
+# not name other custom tables are evaluated at the same time. Workers
+# get only the tables an expression names and send back the flat
+# entries, as an array of doubles if that loses nothing, with the
+# number of entries in each row of the result.
+
+xml_grace = 5
+
+
+class xml_expired(Exception):
+    pass
+
+
+def raise_xml_expired(signum, frame):
+    raise xml_expired()
+
+
+# When each custom table started in a worker, in memory shared with the
+# fill (see parse_xml_sandboxed)
+xml_started = None
+
+
+def init_xml_worker(started):
+    global xml_started
+    xml_started = started
+
+
+def get_address_space():
+    """
+    Size of this process' address space in bytes (None if unknown)
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[0]) * resource.getpagesize()
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def pack_entries(entries):
+    """
+    Entries (strings) as an array of doubles if that keeps them as is
+    """
+    try:
+        packed = array('d', [float(e) for e in entries])
+    except ValueError:
+        return entries
+
+    if all(str(f) == e for (f, e) in zip(packed, entries)):
+        return packed
+    else:
+        return entries
+
+
+def unpack_entries(packed):
+    if isinstance(packed, array):
+        return [str(f) for f in packed]
+    else:
+        return list(packed)
+
+
+def get_custom_rows(ceval, usenumpy):
+    """
+    Rows of the value of a custom table's expression, each a list of
+    entries
+    """
+    rows = tolist2(ceval)
+    if usenumpy:
+        return [list(flatten([numpy.array([l])])) for l in rows]
+    else:
+        return [list(flatten([l])) for l in rows]
+
+
+def eval_custom_rows(text, tables, usenumpy, usetype):
     """
-    WARNING: This function expects command-line inputs to exist.
+    Evaluate a custom table's expression with 'tables' (rows of
+    strings) in scope, as parse_xml_file does. Returns the entries as
+    strings and the number of entries from each row of the result.
     """
+    if usetype in ['float', 'numeric']:
+        tables = dict((k, nested_convert(v, float)) for (k, v) in tables.items())
 
-    fill = tablefill_internals_cliparse()
-    fill.get_input_parser()
-    fill.get_parsed_arguments()
-    fill.get_argument_strings()
-    fill.get_file_type()
+    if usenumpy:
+        tables = dict((k, numpy_matrix(v)) for (k, v) in tables.items())
+        tables['numpy'] = numpy
 
-    exit, exit_msg = tablefill(template       = fill.template,
-                               input          = fill.input,
-                               output         = fill.output,
-                               filetype       = fill.ext,
-                               verbose        = fill.verbose,
-                               silent         = fill.silent,
-                               pvals          = fill.pvals,
-                               stars          = fill.stars,
-                               nafilters      = fill.nafilters,
-                               fillc          = fill.fillc,
-                               nohead         = fill.nohead,
-                               log_file       = fill.log_file,
-                               log_only       = fill.log_only,
-                               legacy_parsing = fill.legacy_parsing,
-                               numpy_syntax   = fill.numpy_syntax,
-                               use_floats     = fill.use_floats,
-                               ignore_xml     = fill.ignore_xml,
-                               xml_tables     = fill.xml_tables)
+    rows    = get_custom_rows(eval(text, tables), usenumpy)
+    entries = [custom_convert(x, str) for row in rows for x in row]
+    return entries, [len(row) for row in rows]
 
-    if exit == 'SUCCESS':
-        fill.get_compiled()
-        sysexit(0)
-    elif exit == 'WARNING':
-        print_silent(fill.silent, "Exit status came with a warning")
-        print_silent(fill.silent, "Output might not be as expected!")
-        print_silent(fill.silent, "Rerun program with --verbose option.")
-        fill.get_compiled()
-        sysexit(-1)
-    elif exit == 'ERROR':
-        fillerror_msg  = 'ERROR while filling table.'
-        fillerror_msg += ' Check function call.' + linesep
-        print_silent(fill.silent, fillerror_msg)
-        fill.parser.print_usage()
-        sysexit(1)
 
+def eval_custom_table(args):
+    """
+    Evaluate one custom table in a worker process within its time and
+    memory limits. Returns (tag, entries, lengths, error), with entries
+    packed by pack_entries, or None and the reason if it failed.
+    """
+    tag, text, tables, usenumpy, usetype, timeout, memory, index = args
+    if xml_started is not None:
+        xml_started[index] = time.time()
 
-# Backwards-compatible file concatenation
-def concat_files(flist):
-    if version_info >= (3, 0):
-        readlist = [open(fn, 'r', newline = None).readlines() for fn in flist]
-    else:
-        readlist = [open(fn, 'rU').readlines() for fn in flist]
+    limits = None
+    timer  = timeout is not None and hasattr(signal, 'setitimer')
+    try:
+        if memory is not None and resource is not None:
+            used = get_address_space()
+            if used is not None:
+                limits = resource.getrlimit(resource.RLIMIT_AS)
+                wanted = used + int(memory * 1024 ** 2)
+                if limits[1] != resource.RLIM_INFINITY:
+                    wanted = min(wanted, limits[1])
+                resource.setrlimit(resource.RLIMIT_AS, (wanted, limits[1]))
+
+        if timer:
+            signal.signal(signal.SIGALRM, raise_xml_expired)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+
+        entries, lengths = eval_custom_rows(text, tables, usenumpy, usetype)
+        return tag, pack_entries(entries), lengths, None
+    except xml_expired:
+        return tag, None, None, 'took longer than %gs' % timeout
+    except MemoryError:
+        return tag, None, None, 'ran out of memory'
+    except Exception as e:
+        return tag, None, None, '%s: %s' % (type(e).__name__, e)
+    finally:
+        if timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+        if limits is not None:
+            resource.setrlimit(resource.RLIMIT_AS, limits)
 
-    return sum(readlist, [])
 
+# ---------------------------------------------------------------------
+# tablefill_metrics
+#
+# Statistics of one or more fills in the Prometheus text format, so a
+# batch can leave a file for the node exporter's textfile collector:
+# templates filled (by exit status), placeholders replaced, warnings by
+# category, bytes read and written, and the duration of each phase.
 
-# Backwards-compatible string formatting
-def compat_format(x):
-    if version_info >= (2, 7):
-        return format(x, ',d')
-    else:
-        import locale
-        locale.setlocale(locale.LC_ALL, 'en_US')
-        return locale.format("%d", x, grouping = True)
+metrics_buckets  = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+metrics_exits    = ['SUCCESS', 'WARNING', 'ERROR']
+metrics_warnings = ['nomatch', 'notable', 'nolabel', 'toolong']
+metrics_phases   = ['parse', 'fill', 'write', 'total']
 
 
-# Backwards-compatible list flattening
-# http://stackoverflow.com/questions/2158395/
-def flatten(l):
-    if version_info >= (3, 0):
-        for el in l:
-            if isinstance(el, Iter) and not isinstance(el, (str, bytes)):
-                for sub in flatten(el):
-                    yield sub
-            else:
-                yield el
-    else:
-        for el in l:
-            if isinstance(el, Iter) and not isinstance(el, basestring):
-                for sub in flatten(el):
-                    yield sub
-            else:
-                yield el
+class tablefill_metrics:
+    """
+    Counters and histograms over fills. Pass an instance as tablefill's
+    'metrics' to add a fill to it (tablefill_many and tablefill_project
+    add each of their fills), then save it with write(). Passing a file
+    name instead writes the statistics of that call to it.
+    """
+    def __init__(self):
+        self.lock          = threading.Lock()
+        self.templates     = OrderedDict((e, 0) for e in metrics_exits)
+        self.warnings      = OrderedDict((w, 0) for w in metrics_warnings)
+        self.placeholders  = 0
+        self.file_bytes    = 0
+        self.bytes_written = 0
+        self.phases = OrderedDict((p, {'buckets': [0] * len(metrics_buckets),
+                                       'sum':     0.0,
+                                       'count':   0})
+                                  for p in metrics_phases)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add(self, exit, placeholders, warnings, file_bytes, bytes_written, phases):
+        """
+        Add one fill: its exit status, number of placeholders replaced,
+        {category: number of warnings}, size of its template and input
+        files, bytes written, and {phase: seconds}.
+        """
+        with self.lock:
+            self.templates[exit] += 1
+            self.placeholders    += placeholders
+            self.file_bytes      += file_bytes
+            self.bytes_written   += bytes_written
+            for category, count in warnings.items():
+                self.warnings[category] += count
+
+            for phase, seconds in phases.items():
+                histogram = self.phases[phase]
+                histogram['sum']   += seconds
+                histogram['count'] += 1
+                for i, le in enumerate(metrics_buckets):
+                    if seconds <= le:
+                        histogram['buckets'][i] += 1
+
+    def merge(self, other):
+        """
+        Add the fills counted in another tablefill_metrics
+        """
+        with self.lock:
+            for exit, count in other.templates.items():
+                self.templates[exit] += count
+
+            for category, count in other.warnings.items():
+                self.warnings[category] += count
+
+            self.placeholders  += other.placeholders
+            self.file_bytes    += other.file_bytes
+            self.bytes_written += other.bytes_written
+            for phase, histogram in other.phases.items():
+                self.phases[phase]['sum']   += histogram['sum']
+                self.phases[phase]['count'] += histogram['count']
+                for i, count in enumerate(histogram['buckets']):
+                    self.phases[phase]['buckets'][i] += count
+
+    def get_text(self):
+        """
+        Statistics in the Prometheus text format
+        """
+        def metric(name, kind, text, samples):
+            lines  = ["# HELP %s %s" % (name, text)]
+            lines += ["# TYPE %s %s" % (name, kind)]
+            lines += ["%s%s %s" % (name, labels, value) for (labels, value) in samples]
+            return lines
+
+        def number(x):
+            return repr(float(x)) if isinstance(x, float) else str(x)
+
+        with self.lock:
+            text  = metric('tablefill_templates_total', 'counter',
+                           "Templates filled, by exit status",
+                           [('{status="%s"}' % e, n) for e, n in self.templates.items()])
+            text += metric('tablefill_placeholders_total', 'counter',
+                           "Placeholders replaced",
+                           [('', self.placeholders)])
+            text += metric('tablefill_warnings_total', 'counter',
+                           "Warnings, by category",
+                           [('{category="%s"}' % w, n) for w, n in self.warnings.items()])
+            text += metric('tablefill_input_file_bytes_total', 'counter',
+                           "Size on disk of the template and input files of"
+                           " each fill (stdin and stores are not counted)",
+                           [('', self.file_bytes)])
+            text += metric('tablefill_written_bytes_total', 'counter',
+                           "Bytes written to outputs",
+                           [('', self.bytes_written)])
+
+            samples = []
+            for phase, histogram in self.phases.items():
+                for le, count in zip(metrics_buckets, histogram['buckets']):
+                    samples += [('{phase="%s",le="%s"}' % (phase, number(le)), count)]
+
+                samples += [('{phase="%s",le="+Inf"}' % phase, histogram['count'])]
+                samples += [('_sum{phase="%s"}' % phase, number(histogram['sum']))]
+                samples += [('_count{phase="%s"}' % phase, histogram['count'])]
+
+            text += ["# HELP tablefill_phase_seconds Duration of each fill phase"]
+            text += ["# TYPE tablefill_phase_seconds histogram"]
+            for labels, value in samples:
+                name = 'tablefill_phase_seconds'
+                if not labels.startswith('_'):
+                    name += '_bucket'
+                text += ["%s%s %s" % (name, labels, value)]
+
+        text += metric('tablefill_last_run_timestamp_seconds', 'gauge',
+                       "When these statistics were written",
+                       [('', number(time.time()))])
+        return '\n'.join(text) + '\n'
+
+    def write(self, fname):
+        """
+        Write the statistics to 'fname' (via a temporary file, so a
+        collector never reads a partial file)
+        """
+        fh, tmp = mkstemp_for(fname, prefix = '.tablefill')
+        with fdopen(fh, 'w') as out:
+            out.write(self.get_text())
 
+        rename(tmp, fname)
 
-def tolist(anything):
-    return anything if isinstance(anything, list) else [anything]
 
+def record_metrics(metrics, logger, exit, engine, phases):
+    """
+    Add a fill to 'metrics' (a tablefill_metrics or a file name, which
+    gets the statistics of this fill only); 'engine' is None if the
+    fill failed before it was set up.
+    """
+    fill_metrics = metrics
+    if not isinstance(metrics, tablefill_metrics):
+        fill_metrics = tablefill_metrics()
+
+    warnings = getattr(engine, 'warning_lists', {})
+    fill_metrics.add(exit,
+                     getattr(engine, 'replaced', 0),
+                     dict((w, len(warnings.get(w, []))) for w in metrics_warnings),
+                     0 if engine is None else engine.get_file_bytes(),
+                     getattr(engine, 'bytes_written', 0),
+                     phases)
+
+    if fill_metrics is not metrics:
+        try:
+            fill_metrics.write(metrics)
+        except (IOError, OSError):
+            logger.warning("Could not write metrics to '%s'", metrics)
 
-def tolist2(anything):
-    return list(anything) if hasattr(anything, '__iter__') else [anything]
 
+# ---------------------------------------------------------------------
+# tablefill_logging
+#
+# Messages go to the 'tablefill' logger hierarchy. Each fill logs to a
+# logger of its own (a child of 'tablefill.fill' that is not kept in
+# logging's registry) with a level set by verbose/silent and a handler,
+# tablefill_sink, that writes the fill's messages to the terminal and
+# its log file. Messages use lazy %-style arguments, so nothing is
+# formatted unless the level is enabled. 'tablefill' does not propagate
+# to the root logger because tablefill prints its own messages; add
+# handlers to logging.getLogger('tablefill') to capture them.
+
+logger = logging.getLogger('tablefill')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+exit_levels = {
+    'SUCCESS': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR':   logging.ERROR
+}
+
+
+class tablefill_sink(logging.Handler):
+    """
+    Handler for the messages of a single tablefill call. They are
+    written to 'stream' (sys.stdout at the time of writing if None)
+    unless 'log_only', and to 'log_file' if given. Messages are buffered
+    and written as whole lines, up to 'capacity' at a time, so fills
+    running in separate threads don't mix their messages within a line.
+    """
+    stream_lock = threading.Lock()
 
-def print_verbose(prints, stuff):
-    if prints:
-        print(stuff)
+    def __init__(self,
+                 stream   = None,
+                 log_file = None,
+                 log_only = False,
+                 capacity = 64):
+        logging.Handler.__init__(self)
+        self.stream   = stream
+        self.log      = None if log_file is None else open(log_file, 'w')
+        self.log_only = log_only and self.log is not None
+        self.capacity = capacity
+        self.buffer   = []
+
+    def emit(self, record):
+        self.buffer += [self.format(record) + '\n']
+        if len(self.buffer) >= self.capacity:
+            self.flush()
 
+    def flush(self):
+        text, self.buffer = ''.join(self.buffer), []
+        if text == '':
+            return
 
-def print_silent(silence, stuff):
-    if not silence:
-        print(stuff)
+        if self.log is not None:
+            self.log.write(text)
 
+        if not self.log_only:
+            with self.stream_lock:
+                stream = sys.stdout if self.stream is None else self.stream
+                stream.write(text)
 
-def custom_convert(x, func):
-    if isinstance(x, func):
-        return x
-    else:
-        try:
-            return func(x)
-        except:
-            return None
+    def close(self):
+        self.flush()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
 
+        logging.Handler.close(self)
 
-def nested_convert(item, func):
-    if hasattr(item, '__iter__') and not isinstance(item, basestring):
-        return [nested_convert(x, func) for x in item]
 
-    return custom_convert(item, func)
+def get_fill_logger(sink, verbose = True, silent = False):
+    """
+    Logger for a single fill: debug messages if verbose, the exit status
+    unless silent, and nothing otherwise.
+    """
+    fill_logger        = logging.Logger('tablefill.fill')
+    fill_logger.parent = logging.getLogger('tablefill.fill')
+    if verbose and not silent:
+        fill_logger.setLevel(logging.DEBUG)
+    elif not silent:
+        fill_logger.setLevel(logging.INFO)
+    else:
+        fill_logger.setLevel(logging.CRITICAL + 1)
+
+    fill_logger.addHandler(sink)
+    return fill_logger
 
 
 # ---------------------------------------------------------------------
@@ -293,6 +2268,24 @@ def tablefill(silent         = False,
               use_floats     = False,
               ignore_xml     = False,
               xml_tables     = None,
+              input_format   = None,
+              store          = None,
+              naregex        = [],
+              naspecial      = [],
+              plan_cache     = None,
+              query          = None,
+              query_json     = False,
+              incremental    = False,
+              binary         = False,
+              metrics        = None,
+              xml_jobs       = None,
+              xml_timeout    = 10,
+              xml_memory     = 1024,
+              deterministic  = False,
+              root           = None,
+              input_jobs     = None,
+              template_lines = None,
+              tables         = None,
               **kwargs):
     """Fill LaTeX, LyX, or Markdown template files with external inputs
 
@@ -311,9 +2304,14 @@ def tablefill(silent         = False,
         Name of user-written document to use as basis for update
     input : str
         Space-separated list of files with tables to be used in update.
+        A folder or glob stands for the files in it or matching it.
     output : str
         Filled template to be produced.
 
+    Either the template or one input can be '-' to read it from stdin,
+    and the output can be '-' to write it to stdout (messages are then
+    printed to stderr).
+
     For details on the files and the replace engine, see the online documentation.
 
         https://mcaceresb.github.io/tablefill/getting-started.html
@@ -326,6 +2324,66 @@ def tablefill(silent         = False,
         try to print nothing at all
     filetype : str
         auto, lyx, tex, or md
+    input_format : str
+        Force a reader for all inputs (text, csv, tsv, jsonl, or any
+        reader added via register_reader). Detected if None.
+    store : str
+        SQLite table store (see tablefill_store) to read tags from in
+        addition to the input files; input files take precedence.
+    nafilters : list or tablefill_missing
+        Entries treated as missing, or a compiled missing-value policy
+    naregex : list
+        Regexes; entries that fully match one are treated as missing
+    naspecial : list
+        Special values treated as missing: nan, inf, and/or stata
+        (Stata's '.', '.a' through '.z')
+    plan_cache : str
+        Folder to save compiled templates (fill plans) in. A template
+        is only re-scanned if it or its file type changed.
+    query : list
+        Do not fill; instead write a report of every table in the
+        template (label, placeholders, entries in the matching tag) to
+        output. If the list has tags, only report those tables.
+    query_json : bool
+        Write the query report as JSON
+    incremental : bool
+        Keep a sidecar file next to the output (output + '.tablefill')
+        with a hash of every tag and where its tables are. The next
+        incremental fill only refills tables whose tags changed and
+        patches them into the output; if the template, options, or
+        output changed, or the warnings would change, it fills the
+        whole template instead.
+    binary : bool
+        Read and write files as bytes (latin-1, newlines untranslated),
+        so the template's encoding and line endings pass through the
+        fill untouched whatever the locale. Placeholders are ASCII.
+    metrics : str or tablefill_metrics
+        File to write fill statistics to (Prometheus text format), or a
+        tablefill_metrics to add them to
+    xml_jobs : int
+        Evaluate custom XML tables in this many worker processes, each
+        within xml_timeout and xml_memory. A table that fails is left
+        out (and reported) instead of stopping the fill.
+    xml_timeout : float
+        Seconds each custom XML table may take with xml_jobs (None for
+        no limit)
+    xml_memory : float
+        Megabytes each custom XML table may allocate with xml_jobs
+        (None for no limit)
+    deterministic : bool
+        Make the output depend only on the template, the tables, and
+        the options: the header shows paths relative to 'root' and a
+        fingerprint of the contents instead of absolute paths.
+    root : str
+        Folder the header's paths are relative to with deterministic
+        (the template's folder if None)
+    input_jobs : int
+        Parse the input files in this many processes
+    template_lines : list
+        Contents of the template, if already read (see tablefill_many)
+    tables : dict
+        Tables parsed from the input files, if already read (see
+        tablefill_project)
 
     Output
     ------
@@ -341,14 +2399,27 @@ def tablefill(silent         = False,
                                input    = 'input_file(s)',
                                output   = 'output_file')
     """
-    if log_file:
-        sys.stdout = Logger(log_file, log_only)
-
-    print_verbose(verbose, "Arguments look OK. Will run tablefill.")
+    # Messages go to this call's logger and sink (never to a replaced
+    # sys.stdout), so fills can run in several threads; with output to
+    # stdout, messages go to stderr
+    if kwargs.get('output', None) == '-':
+        sink = tablefill_sink(sys.stderr, log_file, log_only)
+    else:
+        sink = tablefill_sink(None, log_file, log_only)
+
+    verbose = verbose and not silent
+    logger  = get_fill_logger(sink, verbose, silent)
+    logger.debug("Arguments look OK. Will run tablefill.")
+
+    previous        = getattr(binary_files, 'on', False)
+    binary_files.on = binary
+    fill_engine     = None
+    exit            = 'ERROR'
+    template_hooks  = None
+    phases          = OrderedDict()
+    start = lap     = time.time()
     try:
-        verbose = verbose and not silent
-        logmsg  = "Parsing arguments..."
-        print_verbose(verbose, logmsg)
+        logger.debug("Parsing arguments...")
         fill_engine = tablefill_internals_engine(filetype,
                                                  verbose,
                                                  silent,
@@ -361,42 +2432,309 @@ def tablefill(silent         = False,
                                                  numpy_syntax,
                                                  use_floats,
                                                  ignore_xml,
-                                                 xml_tables)
+                                                 xml_tables,
+                                                 input_format,
+                                                 store,
+                                                 naregex,
+                                                 naspecial,
+                                                 plan_cache,
+                                                 query,
+                                                 query_json,
+                                                 incremental,
+                                                 binary,
+                                                 xml_jobs,
+                                                 xml_timeout,
+                                                 xml_memory,
+                                                 deterministic,
+                                                 root,
+                                                 input_jobs)
+
+        fill_engine.outstream = sys.stdout
+        fill_engine.logger    = logger
+        if template_lines is not None:
+            fill_engine.template_lines = template_lines
+
+        if tables is not None:
+            fill_engine.input_tables = tables
 
         fill_engine.get_parsed_arguments(kwargs)
+        template_hooks = fill_engine.hooks.get('template')
+        if template_hooks:
+            template_info = {'template': fill_engine.template,
+                             'output': fill_engine.output}
+            run_hooks(template_hooks, 'start', 'template', template_info)
+
         fill_engine.get_file_type()
         fill_engine.get_regexps()
 
-        logmsg  = "Parsing tables in into dictionary:" + linesep + '\t'
-        logmsg += (linesep + '\t').join(tolist(fill_engine.input))
-        print_verbose(verbose, logmsg)
+        logmsg = "Parsing tables in into dictionary:" + linesep + '\t%s'
+        logger.debug(logmsg, (linesep + '\t').join(fill_engine.input))
         fill_engine.get_parsed_tables()
+        phases['parse'], lap = time.time() - lap, time.time()
+
+        logmsg = "Searching for labels in template:" + linesep + '\t%s'
+        logger.debug(logmsg + linesep, fill_engine.template)
+        if query is not None:
+            fill_engine.get_query()
+            fill_engine.get_warning_messages()
+            phases['fill'], lap = time.time() - lap, time.time()
+
+            logger.debug("Writing query report to '%s'", fill_engine.output)
+            fill_engine.write_to_output(fill_engine.get_query_report())
+        elif incremental and fill_engine.get_patched_output():
+            phases['fill'], lap = time.time() - lap, time.time()
+            fill_engine.write_sidecar()
+        else:
+            fill_engine.get_filled_template()
 
-        logmsg  = "Searching for labels in template:" + linesep + '\t'
-        logmsg += (linesep + '\t').join(tolist(fill_engine.template))
-        print_verbose(verbose, logmsg + linesep)
-        fill_engine.get_filled_template()
+            logmsg = "Adding warning that this was automatically generated..."
+            logger.debug(logmsg)
+            fill_engine.get_notification_message()
+            phases['fill'], lap = time.time() - lap, time.time()
 
-        logmsg = "Adding warning that this was automatically generated..."
-        print_verbose(verbose, logmsg)
-        fill_engine.get_notification_message()
+            logger.debug("Writing to output file '%s'", fill_engine.output)
+            fill_engine.write_to_output(fill_engine.filled_template)
+            if incremental:
+                fill_engine.write_sidecar()
 
-        logmsg = "Writing to output file '%s'" % fill_engine.output
-        print_verbose(verbose, logmsg)
-        fill_engine.write_to_output(fill_engine.filled_template)
+        phases['write'] = time.time() - lap
 
-        logmsg = "Wrapping up..." + linesep
-        print_verbose(verbose, logmsg)
+        logger.debug("Wrapping up..." + linesep)
         fill_engine.get_exit_message()
-        print_silent(silent, fill_engine.exit + '!')
-        print_silent(silent, fill_engine.exit_msg)
+        exit  = fill_engine.exit
+        if template_hooks:
+            template_info['exit'] = exit
+            hooks, template_hooks = template_hooks, None
+            run_hooks(hooks, 'end', 'template', template_info)
+
+        level = exit_levels[fill_engine.exit]
+        logger.log(level, "%s!", fill_engine.exit)
+        logger.log(level, "%s", fill_engine.exit_msg)
         return fill_engine.exit, fill_engine.exit_msg
     except:
         exit_msg = format_exc()
         exit     = 'ERROR'
-        print_silent(silent, exit + '!')
-        print_silent(silent, exit_msg)
+        logger.error("%s!", exit)
+        logger.error("%s", exit_msg)
+        if template_hooks:
+            template_info['exit'] = exit
+            run_hooks(template_hooks, 'end', 'template', template_info)
+
         return exit, exit_msg
+    finally:
+        if metrics is not None:
+            phases['total'] = time.time() - start
+            record_metrics(metrics, logger, exit, fill_engine, phases)
+
+        binary_files.on = previous
+        logger.removeHandler(sink)
+        sink.close()
+
+# ---------------------------------------------------------------------
+# tablefill_many
+
+def fill_variant(args):
+    template, template_lines, input, output, kwargs = args
+    exit, exit_msg = tablefill(template       = template,
+                               input          = input,
+                               output         = output,
+                               template_lines = template_lines,
+                               **kwargs)
+    return output, exit, exit_msg, kwargs.get('metrics', None)
+
+
+def tablefill_many(template, variants, jobs = None, **kwargs):
+    """
+    Fill one template with several sets of inputs. The template is read
+    once and compiled into a single fill plan, which fills each
+    (input, output) pair in 'variants'. With 'jobs', variants are
+    filled in that many processes. Other arguments are passed on to
+    tablefill. Returns a list of (output, exit, exit_msg).
+
+    Usage
+    -----
+    variants = [('tables_%s.txt' % c, 'appendix_%s.tex' % c)
+                for c in ['us', 'fr', 'de']]
+    filled   = tablefill_many('appendix.tex', variants, jobs = 4)
+    """
+    with binary_mode(kwargs.get('binary', False)):
+        with open_text(template) as fh:
+            template_lines = fh.readlines()
+
+    args = [(template, template_lines, ' '.join(tolist(input)), output, kwargs)
+            for (input, output) in variants]
+
+    return fill_variants(args, jobs)
+
+
+def fill_variants(args, jobs = None):
+    """
+    fill_variant for each of 'args', in 'jobs' processes if given.
+    Returns a list of (output, exit, exit_msg).
+    """
+    args, metrics = get_variant_metrics(args)
+    if futures is None or jobs in [None, 1] or len(args) < 2:
+        filled = [fill_variant(a) for a in args]
+    else:
+        with futures.ProcessPoolExecutor(max_workers = jobs) as pool:
+            filled = list(pool.map(fill_variant, args))
+
+    record_variant_metrics(metrics, filled)
+    return [f[:3] for f in filled]
+
+
+def get_variant_metrics(args):
+    """
+    Give each variant its own tablefill_metrics (they may be filled in
+    other processes) if the batch has 'metrics'; returns the new args
+    and the batch's metrics.
+    """
+    metrics = None
+    if len(args) > 0:
+        metrics = args[0][-1].get('metrics', None)
+
+    if metrics is not None:
+        args = [a[:-1] + (dict(a[-1], metrics = tablefill_metrics()),)
+                for a in args]
+
+    return args, metrics
+
+
+def record_variant_metrics(metrics, filled):
+    """
+    Add the metrics of each filled variant to the batch's 'metrics' (a
+    tablefill_metrics or a file name to write them to)
+    """
+    if metrics is None:
+        return
+
+    batch = metrics
+    if not isinstance(metrics, tablefill_metrics):
+        batch = tablefill_metrics()
+
+    for f in filled:
+        batch.merge(f[3])
+
+    if batch is not metrics:
+        try:
+            batch.write(metrics)
+        except (IOError, OSError):
+            logger.warning("Could not write metrics to '%s'", metrics)
+
+
+# ---------------------------------------------------------------------
+# tablefill_project
+#
+# A project is a master .tex or .md file and every file it includes,
+# recursively: \input{} and \include{} in LaTeX (relative to the
+# master's folder, as LaTeX resolves them, with .tex added if there is
+# no extension), and '!include file' or '{!file!}' in Markdown (relative
+# to the including file). Included files that do not exist (say, ones
+# that are generated) are skipped.
+
+re_tex_comment = re.compile(r'(?<!\\)%.*')
+re_tex_include = re.compile(r'\\(?:input|include)\s*\{\s*([^}]+?)\s*\}')
+re_md_include  = re.compile(r'^\s*!include\s+(\S+)|\{!\s*(.+?)\s*!\}')
+
+
+def get_includes(fname, root, filetype):
+    """
+    Files included in 'fname' (absolute paths, in order)
+    """
+    includes = []
+    with open_text(fname) as fh:
+        for line in fh:
+            if filetype == 'tex':
+                line  = re_tex_comment.sub('', line)
+                found = re_tex_include.findall(line)
+                found = [f if path.splitext(f)[1] else f + '.tex' for f in found]
+                includes += [path.join(root, f) for f in found]
+            else:
+                found = re_md_include.findall(line)
+                includes += [path.join(path.dirname(fname), a or b)
+                             for (a, b) in found]
+
+    return [path.normpath(f) for f in includes]
+
+
+def filetype_of(fname):
+    ext = path.splitext(fname)[-1].lower().strip('. ')
+    return 'md' if ext == 'markdown' else ext
+
+
+def get_project_files(master):
+    """
+    Files in the document tree of 'master', master first and then in
+    the order they are included (each file once). Only files of the
+    master's type are followed (not, say, \\input of a .pgf figure).
+    """
+    master   = path.abspath(master)
+    root     = path.dirname(master)
+    filetype = filetype_of(master)
+    if filetype not in ['tex', 'md']:
+        project_type_msg = "Project master '%s' must be a .tex or .md file"
+        raise KeyError(project_type_msg % master)
+
+    files   = []
+    pending = [master]
+    while len(pending) > 0:
+        fname = pending.pop(0)
+        if fname in files or filetype_of(fname) != filetype:
+            continue
+        elif not path.isfile(fname):
+            continue
+
+        files   += [fname]
+        pending  = get_includes(fname, root, filetype) + pending
+
+    return files
+
+
+def tablefill_project(master, input, output, jobs = None, **kwargs):
+    """
+    Fill every template in the document tree of 'master' (see
+    get_project_files). Inputs are parsed once for all templates and
+    filled templates are written to the folder 'output', mirroring
+    their place relative to the master's folder. With 'jobs', templates
+    are filled in that many processes. Other arguments are passed on to
+    tablefill. Returns a list of (output, exit, exit_msg), master first;
+    if the tree cannot be read or filled (e.g. an input is missing or a
+    template is outside the master's folder), the list only has the
+    master with an ERROR.
+
+    Usage
+    -----
+    filled = tablefill_project('paper/master.tex',
+                               'tables1.txt tables2.txt',
+                               'filled',
+                               jobs = 4)
+    """
+    root   = path.dirname(path.abspath(master))
+    input  = ' '.join(tolist(input))
+    args   = []
+    try:
+        with binary_mode(kwargs.get('binary', False)):
+            files  = get_project_files(master)
+            tables = parse_tables(get_input_files(input.split()),
+                                  kwargs.get('input_format', None),
+                                  jobs = kwargs.get('input_jobs', None))
+
+        for fname in files:
+            relative = path.relpath(fname, root)
+            if relative.startswith(path.pardir):
+                outside_msg = "'%s' is included in the project but is outside '%s'"
+                raise ValueError(outside_msg % (fname, root))
+
+            filled = path.join(output, relative)
+            if not path.isdir(path.dirname(path.abspath(filled))):
+                makedirs(path.dirname(path.abspath(filled)))
+
+            args += [(fname, None, input, filled, dict(kwargs, tables = tables))]
+    except:
+        return [(path.join(output, path.basename(master)), 'ERROR', format_exc())]
+
+    return fill_variants(args, jobs)
+
 
 # ---------------------------------------------------------------------
 # tablefill_internals_cliparse
@@ -406,14 +2744,6 @@ class tablefill_internals_cliparse:
     """
     WARNING: Internal class to parse arguments to pass to tablefill
     """
-    def __init__(self):
-        self.compiler = {'tex': "xelatex ",
-                         'lyx': "lyx -e pdf2 ",
-                         'md': "pandoc -i "}
-        self.bibtex   = {'tex': "bibtex ",
-                         'lyx': "echo Not sure how to run BiBTeX via LyX on ",
-                         'md': "echo Not sure how to run BiBTeX via pandoc on "}
-
     def get_input_parser(self):
         """
         Parse command-line arguments using argparse; return parser
@@ -439,8 +2769,8 @@ class tablefill_internals_cliparse:
                             nargs    = '*',
                             metavar  = 'INPUT',
                             default  = None,
-                            help     = "Input files with tables"
-                                       " (default: INPUT_table)",
+                            help     = "Input files, folders, or globs with"
+                                       " tables (default: INPUT_table)",
                             required = False)
         parser.add_argument('-o', '--output',
                             dest     = 'output',
@@ -459,6 +2789,114 @@ class tablefill_internals_cliparse:
                             default  = ['auto'],
                             help     = "Template file type (default: auto)",
                             required = False)
+        parser.add_argument('--input-format',
+                            dest     = 'input_format',
+                            type     = str,
+                            default  = None,
+                            choices  = list(tablefill_readers.keys()),
+                            help     = "Input file format"
+                                       " (default: detected)",
+                            required = False)
+        parser.add_argument('--store',
+                            dest     = 'store',
+                            type     = str,
+                            metavar  = 'STORE',
+                            default  = None,
+                            help     = "SQLite table store with inputs"
+                                       " (see 'tablefill ingest')",
+                            required = False)
+        parser.add_argument('--query',
+                            dest     = 'query',
+                            type     = str,
+                            nargs    = '*',
+                            metavar  = 'TAG',
+                            default  = None,
+                            help     = "Report tables, placeholders, and"
+                                       " matching tags (only TAG, if given)"
+                                       " instead of filling",
+                            required = False)
+        parser.add_argument('--json',
+                            dest     = 'json',
+                            action   = 'store_true',
+                            help     = "Write the --query report as JSON",
+                            required = False)
+        parser.add_argument('--binary',
+                            dest     = 'binary',
+                            action   = 'store_true',
+                            help     = "Pass the template's bytes (encoding,"
+                                       " line endings) through untouched",
+                            required = False)
+        parser.add_argument('--deterministic',
+                            dest     = 'deterministic',
+                            action   = 'store_true',
+                            help     = "Same output for the same template and"
+                                       " tables on any machine: relative"
+                                       " paths and a fingerprint in the"
+                                       " header",
+                            required = False)
+        parser.add_argument('--input-jobs',
+                            dest     = 'input_jobs',
+                            type     = int,
+                            metavar  = 'N',
+                            default  = None,
+                            help     = "Parse input files (e.g. the shards in"
+                                       " a folder) in N processes",
+                            required = False)
+        parser.add_argument('--root',
+                            dest     = 'root',
+                            type     = str,
+                            metavar  = 'DIR',
+                            default  = None,
+                            help     = "Folder to show paths relative to with"
+                                       " --deterministic (default: the"
+                                       " template's folder)",
+                            required = False)
+        parser.add_argument('--project',
+                            dest     = 'project',
+                            action   = 'store_true',
+                            help     = "Fill TEMPLATE and every file it"
+                                       " includes (\\input, \\include, or"
+                                       " Markdown includes) into folder"
+                                       " OUTPUT",
+                            required = False)
+        parser.add_argument('--incremental',
+                            dest     = 'incremental',
+                            action   = 'store_true',
+                            help     = "Only refill tables whose tags changed"
+                                       " since the last --incremental fill"
+                                       " of OUTPUT",
+                            required = False)
+        parser.add_argument('--each',
+                            dest     = 'each',
+                            type     = str,
+                            nargs    = '+',
+                            metavar  = 'VALUE',
+                            default  = None,
+                            help     = "Fill once per VALUE, replacing {}"
+                                       " in INPUT and OUTPUT with it",
+                            required = False)
+        parser.add_argument('--jobs',
+                            dest     = 'jobs',
+                            type     = int,
+                            metavar  = 'N',
+                            default  = None,
+                            help     = "Parallel jobs for --each",
+                            required = False)
+        parser.add_argument('--plan-cache',
+                            dest     = 'plan_cache',
+                            type     = str,
+                            metavar  = 'DIR',
+                            default  = None,
+                            help     = "Folder to cache compiled templates in",
+                            required = False)
+        parser.add_argument('--metrics',
+                            dest     = 'metrics',
+                            type     = str,
+                            metavar  = 'FILE',
+                            default  = None,
+                            help     = "Write fill statistics to FILE"
+                                       " (Prometheus text format)",
+                            required = False)
         parser.add_argument('--pvals',
                             dest     = 'pvals',
                             type     = str,
@@ -482,6 +2920,24 @@ class tablefill_internals_cliparse:
                             help     = "Filters for missing values"
                                        "(enclose each in quotes)",
                             required = False)
+        parser.add_argument('--na-regex',
+                            dest     = 'naregex',
+                            type     = str,
+                            nargs    = '*',
+                            metavar  = 'REGEX',
+                            default  = [],
+                            help     = "Regexes for missing values"
+                                       " (enclose each in quotes)",
+                            required = False)
+        parser.add_argument('--na-special',
+                            dest     = 'naspecial',
+                            type     = str,
+                            nargs    = '*',
+                            choices  = ['nan', 'inf', 'stata'],
+                            default  = [],
+                            help     = "Special missing values: any NaN,"
+                                       " +/-Inf, or Stata missing values",
+                            required = False)
         parser.add_argument('-f', '--force',
                             dest     = 'force',
                             action   = 'store_true',
@@ -497,6 +2953,37 @@ class tablefill_internals_cliparse:
                             action   = 'store_true',
                             help     = "Compile BiBTeX",
                             required = False)
+        parser.add_argument('--xml-jobs',
+                            dest     = 'xml_jobs',
+                            type     = int,
+                            metavar  = 'N',
+                            default  = None,
+                            help     = "Evaluate custom XML tables in N"
+                                       " worker processes",
+                            required = False)
+        parser.add_argument('--xml-timeout',
+                            dest     = 'xml_timeout',
+                            type     = float,
+                            metavar  = 'SECONDS',
+                            default  = 10,
+                            help     = "Time limit for each custom XML table"
+                                       " (with --xml-jobs)",
+                            required = False)
+        parser.add_argument('--xml-memory',
+                            dest     = 'xml_memory',
+                            type     = float,
+                            metavar  = 'MB',
+                            default  = 1024,
+                            help     = "Memory limit for each custom XML table"
+                                       " (with --xml-jobs)",
+                            required = False)
+        parser.add_argument('--compile-timeout',
+                            dest     = 'compile_timeout',
+                            type     = float,
+                            metavar  = 'SECONDS',
+                            default  = None,
+                            help     = "Time limit for each compile command",
+                            required = False)
         parser.add_argument('-fc', '--fill-comments',
                             dest     = 'fill_comments',
                             action   = 'store_true',
@@ -560,12 +3047,81 @@ class tablefill_internals_cliparse:
                             required = False)
         self.parser = parser
 
+    def get_ingest_parser(self):
+        """
+        Parse arguments for 'tablefill ingest STORE INPUT [INPUT ...]'
+        """
+        parser = argparse.ArgumentParser(prog = __program__ + ' ingest',
+                                         description = "Load input tables"
+                                                       " into a table store")
+        parser.add_argument('store',
+                            type     = str,
+                            metavar  = 'STORE',
+                            help     = "SQLite table store (created if"
+                                       " it does not exist)")
+        parser.add_argument('input',
+                            type     = str,
+                            nargs    = '+',
+                            metavar  = 'INPUT',
+                            help     = "Input files, folders, or globs with"
+                                       " tables")
+        parser.add_argument('--input-format',
+                            dest     = 'input_format',
+                            type     = str,
+                            default  = None,
+                            choices  = list(tablefill_readers.keys()),
+                            help     = "Input file format"
+                                       " (default: detected)",
+                            required = False)
+        parser.add_argument('--force',
+                            dest     = 'force',
+                            action   = 'store_true',
+                            help     = "Re-read unchanged input files",
+                            required = False)
+        parser.add_argument('--silent',
+                            dest     = 'silent',
+                            action   = 'store_true',
+                            help     = "No printing",
+                            required = False)
+        self.parser = parser
+
+    def get_ingested(self, argv):
+        """
+        Load the inputs into the store; unchanged inputs are skipped.
+        """
+        args   = self.parser.parse_args(argv)
+        inputs = get_input_files(args.input)
+        with tablefill_store(args.store) as store:
+            ingested = store.ingest(inputs,
+                                    input_format = args.input_format,
+                                    force = args.force)
+
+        ingest_msg  = "Ingested %d of %d input file(s) into '%s'"
+        ingest_msg %= (len(ingested), len(inputs), args.store)
+        print_silent(args.silent, ingest_msg)
+        for fname in ingested:
+            print_silent(args.silent, '\t' + fname)
+
     def get_parsed_arguments(self):
         """
         Get arguments; if input and output names are missing, guess them
         (only guess with the --force option, otherwise don't run).
         """
         args = self.parser.parse_args()
+        if args.input is None and args.store is not None:
+            args.input = []
+
+        if args.output is None and args.query is not None:
+            args.output = ['-']
+
+        if args.output is None and args.project and args.force:
+            args.output = ['filled']
+
+        if args.force and args.template[0] == '-':
+            stdin_msg = "Cannot name input/output with --force when the"
+            stdin_msg += " template is read from stdin."
+            raise KeyError(stdin_msg)
+
         missing_args  = []
         missing_args += ['INPUT'] if args.input is None else []
         missing_args += ['OUTPUT'] if args.output is None else []
@@ -595,22 +3151,50 @@ class tablefill_internals_cliparse:
         """
         Get arguments as strings to pass to tablefill
         """
-        self.template  = path.abspath(self.args.template[0])
-        self.input     = ' '.join([path.abspath(f) for f in self.args.input])
-        self.output    = path.abspath(self.args.output[0])
+        self.template  = abspath_stdio(self.args.template[0])
+        self.input     = ' '.join([abspath_stdio(f) for f in self.args.input])
+        self.output    = abspath_stdio(self.args.output[0])
         self.silent    = self.args.silent
         self.verbose   = self.args.verbose and not self.args.silent
         self.stars     = self.args.stars
         self.nafilters = self.args.nafilters
+        self.naregex   = self.args.naregex
+        self.naspecial = self.args.naspecial
         self.fillc     = self.args.fill_comments
         self.nohead    = self.args.no_header
-        self.log_file  = self.args.log_file
+        self.log_file  = self.args.log_file and self.args.log_file[0]
         self.log_only  = self.args.log_only
         self.legacy_parsing = self.args.legacy_parsing
         self.numpy_syntax   = self.args.numpy_syntax
         self.use_floats     = self.args.use_floats
         self.ignore_xml     = self.args.ignore_xml
         self.xml_tables     = self.args.xml_tables
+        self.input_format   = self.args.input_format
+        self.store          = self.args.store
+        self.plan_cache     = self.args.plan_cache
+        self.query          = self.args.query
+        self.query_json     = self.args.json
+        self.incremental    = self.args.incremental
+        self.binary         = self.args.binary
+        self.metrics        = self.args.metrics
+        self.xml_jobs       = self.args.xml_jobs
+        self.xml_timeout    = self.args.xml_timeout
+        self.xml_memory     = self.args.xml_memory
+        self.deterministic  = self.args.deterministic
+        self.root           = self.args.root
+        self.input_jobs     = self.args.input_jobs
+        self.each           = self.args.each
+        self.project        = self.args.project
+        self.jobs           = self.args.jobs
+        self.outputs        = [self.output]
+        if self.each is not None and self.output == '-':
+            each_msg = "Cannot write the outputs of --each to stdout"
+            raise KeyError(each_msg)
+        elif self.project and (self.output == '-' or self.template == '-'):
+            project_msg = "Cannot fill a --project from stdin or to stdout"
+            raise KeyError(project_msg)
+        elif self.project and self.each is not None:
+            raise KeyError("Cannot use --each with --project")
         try:
             self.pvals = [float(p) for p in self.args.pvals]
             assert all([(0 < p < 1) for p in self.pvals])
@@ -632,6 +3216,10 @@ class tablefill_internals_cliparse:
             unknown_type = "Type '%s' not allowed. Expected {auto,lyx,tex}."
             unknown_type = unknown_type % inext
             raise KeyError(unknown_type)
+        elif inext == 'auto' and self.template == '-':
+            stdin_type = "Cannot detect the type of a template read from"
+            stdin_type += " stdin. Specify it with --type {lyx,tex,md}."
+            raise KeyError(stdin_type)
         elif inext == 'auto':
             if ext not in ['tex', 'lyx', 'md', 'markdown']:
                 unknown_type  = "File type '%s' not known."
@@ -654,31 +3242,83 @@ class tablefill_internals_cliparse:
                 mismatch_msg  = mismatch_msg % (inext, ext, inext)
                 print_verbose(self.verbose, mismatch_msg + linesep)
 
+    def get_filled_each(self, options):
+        """
+        Fill the template once per --each value; returns the worst exit
+        """
+        variants = [(self.input.replace('{}', value),
+                     self.output.replace('{}', value))
+                    for value in self.each]
+
+        filled = tablefill_many(self.template,
+                                variants,
+                                jobs = self.jobs,
+                                **options)
+
+        self.outputs = [output for (output, exit, msg) in filled
+                        if exit != 'ERROR']
+
+        return self.get_filled_summary(filled)
+
+    def get_filled_project(self, options):
+        """
+        Fill the --project of the template; returns the worst exit. Only
+        the filled master is compiled.
+        """
+        filled = tablefill_project(self.template,
+                                   self.input,
+                                   self.output,
+                                   jobs = self.jobs,
+                                   **options)
+
+        self.outputs = [output for (output, exit, msg) in filled[:1]
+                        if exit != 'ERROR']
+
+        return self.get_filled_summary(filled)
+
+    def get_filled_summary(self, filled):
+        exits    = [exit for (output, exit, msg) in filled]
+        each_msg = ["%s: %s" % (exit, output)
+                    for (output, exit, msg) in filled]
+        each_msg = linesep.join(each_msg)
+        print_silent(self.silent, each_msg)
+        if 'ERROR' in exits:
+            return 'ERROR', each_msg
+        elif 'WARNING' in exits:
+            return 'WARNING', each_msg
+        else:
+            return 'SUCCESS', each_msg
+
     def get_compiled(self):
         """
         Compile the filled template with the corresponding program.
         """
 
+        if self.args.query is not None:
+            return
+
         if not self.args.compile and self.args.bibtex:
             print("NOTE: Cannot run BiBTeX without compiling." + linesep)
 
-        if self.args.compile:
-            chdir(path.dirname(path.abspath(self.output)))
-            compile_program  = self.compiler[self.ext]
-            compile_program += ' ' + self.output
-
-            bibtex_auxfile   = path.splitext(path.basename(self.output))[0]
-            bibtex_program   = self.bibtex[self.ext]
-            bibtex_program  += ' ' + bibtex_auxfile + '.aux'
-
+        if self.args.compile and self.output == '-':
+            print("NOTE: Cannot compile output written to stdout." + linesep)
+        elif self.args.compile:
             logmsg = "Compiling in beta! Use with caution. Running"
             print_verbose(self.verbose, logmsg)
-            print_verbose(self.verbose, compile_program + linesep)
-            system(compile_program + linesep)
-            if self.args.bibtex:
-                system(bibtex_program + linesep)
-                system(compile_program + linesep)
-                system(compile_program + linesep)
+            print_verbose(self.verbose, ' '.join(compilers[self.ext]) +
+                                        ' ' + self.output + linesep)
+
+            compiled = compile_outputs(self.outputs,
+                                       self.ext,
+                                       jobs    = self.jobs,
+                                       bibtex  = self.args.bibtex,
+                                       timeout = self.args.compile_timeout,
+                                       verbose = self.verbose)
+            for output, status, msg in compiled:
+                if status == 'SUCCESS':
+                    print_verbose(self.verbose, msg)
+                else:
+                    print_silent(self.silent, status + ': ' + msg)
 
 
 # ---------------------------------------------------------------------
@@ -701,7 +3341,22 @@ class tablefill_internals_engine:
                  numpy_syntax   = False,
                  use_floats     = False,
                  ignore_xml     = False,
-                 xml_tables     = None):
+                 xml_tables     = None,
+                 input_format   = None,
+                 store          = None,
+                 naregex        = [],
+                 naspecial      = [],
+                 plan_cache     = None,
+                 query          = None,
+                 query_json     = False,
+                 incremental    = False,
+                 binary         = False,
+                 xml_jobs       = None,
+                 xml_timeout    = 10,
+                 xml_memory     = 1024,
+                 deterministic  = False,
+                 root           = None,
+                 input_jobs     = None):
 
         # Get file type
         self.filetype     = filetype.lower()
@@ -711,15 +3366,17 @@ class tablefill_internals_engine:
             unknown_type  = unknown_type % filetype
             raise KeyError(unknown_type)
 
-        self.warn_msg  = {'nomatch': '',
-                          'notable': '',
-                          'nolabel': '',
-                          'toolong': ''}
-        self.warnings  = {'nomatch': [],
-                          'notable': [],
-                          'nolabel': [],
-                          'toolong': []}
+        # Ordered, so warnings are listed in the same order everywhere
+        self.warn_msg  = OrderedDict([('nomatch', ''),
+                                      ('notable', ''),
+                                      ('nolabel', ''),
+                                      ('toolong', '')])
+        self.warnings  = OrderedDict([('nomatch', []),
+                                      ('notable', []),
+                                      ('nolabel', []),
+                                      ('toolong', [])])
         self.warn_pre  = ""
+        self.logger    = logging.getLogger('tablefill.engine')
         self.verbose   = verbose and not silent
         self.silent    = silent
 
@@ -734,7 +3391,13 @@ class tablefill_internals_engine:
         starlist.sort(key = lambda p: p[0], reverse = True)
         self.pvals          = [p for (p, s) in starlist]
         self.stars          = [s for (p, s) in starlist]
+        self.pvals_sorted   = self.pvals[::-1]
         self.nafilters      = nafilters
+        if isinstance(nafilters, tablefill_missing):
+            self.missing = nafilters
+        else:
+            self.missing = tablefill_missing(nafilters, naregex, naspecial)
+
         self.fillc          = fillc
         self.nohead         = nohead
         self.legacy_parsing = legacy_parsing
@@ -742,6 +3405,26 @@ class tablefill_internals_engine:
         self.use_floats     = use_floats
         self.ignore_xml     = ignore_xml
         self.xml_tables     = xml_tables
+        self.input_format   = input_format
+        self.store          = store
+        self.plan_cache     = plan_cache
+        self.query          = query
+        self.query_json     = query_json
+        self.incremental    = incremental
+        self.binary         = binary
+        self.xml_jobs       = xml_jobs
+        self.xml_timeout    = xml_timeout
+        self.xml_memory     = xml_memory
+        self.xml_errors     = OrderedDict()
+        self.xml_rows       = {}
+        self.deterministic  = deterministic
+        self.root           = root
+        self.input_jobs     = input_jobs
+        self.date_formats   = {}
+        self.replaced       = 0
+        self.bytes_written  = 0
+        self.formatters     = {}
+        self.hooks          = get_hooks()
 
     def get_parsed_arguments(self, kwargs):
         """
@@ -770,17 +3453,31 @@ class tablefill_internals_engine:
             mismatched_msg = linesep.join(msg)
             raise TypeError(mismatched_msg)
 
-        self.template = path.abspath(kwargs['template'])
-        self.output   = path.abspath(kwargs['output'])
-        self.input    = [path.abspath(ins) for ins in kwargs['input'].split()]
+        self.template = abspath_stdio(kwargs['template'])
+        self.output   = abspath_stdio(kwargs['output'])
+        self.input    = [abspath_stdio(ins) for ins in kwargs['input'].split()]
+        self.inputs   = list(self.input)
+        self.input    = get_input_files(self.input)
 
         infiles = [self.template] + self.input
+        if infiles.count('-') > 1:
+            stdin_msg = "Only one of template and input can be '-' (stdin)"
+            raise IOError(stdin_msg)
+
+        infiles = [f for f in infiles if f != '-']
+        if self.store is not None:
+            self.store = path.abspath(self.store)
+            infiles   += [self.store]
+
         missing_files = list(filter(lambda f: not path.isfile(f), infiles))
         if missing_files != []:
             missing_files_msg  = "Please check the following are available:"
             missing_files_msg += linesep + linesep.join(missing_files)
             raise IOError(missing_files_msg)
 
+        if self.output == '-':
+            return
+
         outdir = path.split(self.output)[0]
         missing_path = not path.isdir(outdir)
         if missing_path:
@@ -802,7 +3499,12 @@ class tablefill_internals_engine:
         fname = path.basename(self.template)
         ext   = path.splitext(fname)[-1].lower().strip('. ')
         inext = self.filetype
-        if inext == 'auto':
+        if inext == 'auto' and self.template == '-':
+            stdin_type  = "Option filetype = 'auto' cannot detect the type"
+            stdin_type += " of a template read from stdin. Specify one of"
+            stdin_type += " 'lyx', 'tex', or 'md'."
+            raise KeyError(stdin_type)
+        elif inext == 'auto':
             if ext not in ['tex', 'lyx', 'md', 'markdown']:
                 unknown_type  = "Option filetype = 'auto' detected type '%s'"
                 unknown_type += " but was expecting a .lyx or .tex file."
@@ -813,14 +3515,13 @@ class tablefill_internals_engine:
                     self.filetype = 'md'
                 else:
                     self.filetype = ext.lower()
-                logmsg = "NOTE: Automatically detected input type as %s" % ext
-                print_verbose(self.verbose, logmsg)
+                logmsg = "NOTE: Automatically detected input type as %s"
+                self.logger.debug(logmsg, ext)
         elif ext != inext:
             mismatch_msg  = "NOTE: Provided template type '%s' "
             mismatch_msg += "does not match detected template type '%s'"
             mismatch_msg += linesep + "Will use program associated with '%s'"
-            mismatch_msg  = mismatch_msg % (inext, ext, inext)
-            print_verbose(self.verbose, mismatch_msg + linesep)
+            self.logger.debug(mismatch_msg + linesep, inext, ext, inext)
 
     def get_regexps(self):
         """
@@ -835,15 +3536,17 @@ class tablefill_internals_engine:
         #   - matchc:   (-?)integer(.decimal)?
         #   - matchd:   absolute value
         #   - matchf:   python formatting
+        #   - matcht:   addressed matches (#tab:tag[row,col]|fmt#)
         #   - comments: comment
         self.tags      = '^<Tab:(.+)>[\r\n' + linesep + ']'
         self.matche    = r'[^\\](%|&)'
-        self.match0    = r'\\?#\|?((\d+)(,?|\\?%)?|\\?(#|\*)|{0?(:.*?)?}(date|time)?)\|?\\?#'
+        self.match0    = r'\\?#\|?((\d+)(,?|\\?%)?|\\?(#|\*)|{0?(:.*?)?}(date|time|t[dcwmqh])?)\|?\\?#'
         self.matcha    = r'\\?#\\?(#|\*)\\?#'
         self.matchb    = r'\\?#\|?(\d+)(,?|\\?%)\|?\\?#'
         self.matchc    = '(-?\d+)(\.?\d*)'
         self.matchd    = r'\\?#\|.{1,4}\|\\?#'
-        self.matchf    = r'\\?#({0?(:.*?)?})(date|time)?\\?#'
+        self.matchf    = r'\\?#({0?(:.*?)?})(date|time|t[dcwmqh])?\\?#'
+        self.matcht    = r'\\?#tab:([^\s#|\[\]]+)\[\s*(\d+)\s*,\s*(\d+)\s*\](?:\|(#|[^#]*?))?\\?#'
         self.comments  = '^\s*%'
 
         # TODO: Allow custom regexes!
@@ -859,17 +3562,20 @@ class tablefill_internals_engine:
                 # 'label': r'(.*\\label{tab:(.+)})|(^\s*%\s*tablefill:start\s+tab:(.+)\b)'
                 'begin': r'(^\s*%\s*tablefill:start\s+tab:.+$)|(.*\\begin{(sub)?table}.*)',
                 'end':   r'(^\s*%\s*tablefill:end.*$)|(.*\\end{(sub)?table}.*)',
-                'label': r'(?:^\s*%\s*tablefill:start\s+|.*\\label{)tab:(.+?)(?:}|\b)'
+                'label': r'(?:^\s*%\s*tablefill:start\s+|.*\\label{)tab:(.+?)(?:}|\b)',
+                'matrix': r'^(\s*)%\s*tablefill:matrix\b(.*)$'
             },
             'lyx': {
                 'begin':  r'.*\\begin_inset Float table.*',
                 'end':    r'</lyxtabular>',
-                'label':  r'name "tab:(.+)"'
+                'label':  r'name "tab:(.+)"',
+                'matrix': r'^()tablefill:matrix\b(.*)$'
             },
             'md': {
                 'begin': r'(^<!--.*tablefill:start.*-->$)|(^\s*\\begin{table}.*)',
                 'end':   r'(^<!--.*tablefill:end.*-->$)|(.*\\end{table}.*)',
-                'label': r'(?:^<!--.*\b|.*\\label{)tab:(.+)(?:\b.*-->$|})'
+                'label': r'(?:^<!--.*\b|.*\\label{)tab:(.+)(?:\b.*-->$|})',
+                'matrix': r'^(\s*)<!--\s*tablefill:matrix\b(.*?)-->\s*$'
             }
             # 'md': {
             #     'begin': r'^<!--.*tablefill:start.*-->$',
@@ -879,17 +3585,20 @@ class tablefill_internals_engine:
         }
 
         if self.filetype == 'tex':
-            self.begin = dictRegexes['tex']['begin']
-            self.end   = dictRegexes['tex']['end']
-            self.label = dictRegexes['tex']['label']
+            self.begin  = dictRegexes['tex']['begin']
+            self.end    = dictRegexes['tex']['end']
+            self.label  = dictRegexes['tex']['label']
+            self.matrix = dictRegexes['tex']['matrix']
         elif self.filetype == 'lyx':
-            self.begin = dictRegexes['lyx']['begin']
-            self.end   = dictRegexes['lyx']['end']
-            self.label = dictRegexes['lyx']['label']
+            self.begin  = dictRegexes['lyx']['begin']
+            self.end    = dictRegexes['lyx']['end']
+            self.label  = dictRegexes['lyx']['label']
+            self.matrix = dictRegexes['lyx']['matrix']
         elif self.filetype == 'md':
-            self.begin = dictRegexes['md']['begin']
-            self.end   = dictRegexes['md']['end']
-            self.label = dictRegexes['md']['label']
+            self.begin  = dictRegexes['md']['begin']
+            self.end    = dictRegexes['md']['end']
+            self.label  = dictRegexes['md']['label']
+            self.matrix = dictRegexes['md']['matrix']
 
     def get_parsed_tables(self):
         """
@@ -900,37 +3609,93 @@ class tablefill_internals_engine:
         # TODO: I cannot believe the case-insensitivity here (i.e. the lower)
         # TODO: is the cause of all the evil in the world.
 
-        # Read in all the tables
-        parse_data = concat_files(self.input)
-        ctables    = {}
-        for row in parse_data:
-            if re.match(self.tags, row, flags = re.IGNORECASE):
-                tag = re.findall(self.tags, row, flags = re.IGNORECASE)
-                tag = tag[0].lower()
-                ctables[tag] = []
-            else:
-                clean_row_entries = [e.strip() for e in row.split('\t')]
-                ctables[tag] += [clean_row_entries]
+        hooks = self.hooks.get('parse')
+        if hooks:
+            info = {'input': self.input}
+            run_hooks(hooks, 'start', 'parse', info)
+
+        # Read in all the tables (store first, so input files take
+        # precedence over tags in the store)
+        ctables = {} if self.store is None else self.get_store_tables()
+        if hasattr(self, 'input_tables'):
+            ctables.update(self.input_tables)
+        else:
+            parse_tables(self.input, self.input_format, ctables, self.input_jobs)
 
         if self.xml_tables is None and not self.ignore_xml:
-            if self.legacy_parsing:
-                self.parse_xml_file_legacy(ctables,
-                                           self.template,
-                                           prefix = '^%\s*')
-            else:
-                self.parse_xml_file(ctables, self.template, prefix = '^%\s*')
+            self.get_xml_tables(ctables, self.template, prefix = '^%\s*')
         else:
-            if self.legacy_parsing:
-                self.parse_xml_file_legacy(ctables,
-                                           self.xml_tables,
-                                           prefix = '')
-            else:
-                self.parse_xml_file(ctables, self.xml_tables, prefix = '')
+            self.get_xml_tables(ctables, self.xml_tables, prefix = '')
 
-        # Read in actual and custom tables
+        # Read in actual and custom tables (and keep their rows, with
+        # the shape custom tables had, for tablefill:matrix)
         # self.tables = {k: self.filter_missing(v) for k, v in tables.items()}
         self.tables = dict((k, self.filter_missing(list(flatten(v))))
                            for (k, v) in ctables.items())
+        self.matrices = dict(ctables)
+        self.matrices.update(self.xml_rows)
+
+        if hooks:
+            info['tags'] = len(self.tables)
+            run_hooks(hooks, 'end', 'parse', info)
+
+    def get_xml_tables(self, ctables, xml_input, prefix = ''):
+        """
+        Parse custom XML tables with the legacy or the current parser
+        """
+        hooks = self.hooks.get('xml')
+        if hooks:
+            info = {'xml': xml_input}
+            run_hooks(hooks, 'start', 'xml', info)
+
+        if self.legacy_parsing:
+            self.parse_xml_file_legacy(ctables, xml_input, prefix = prefix)
+        else:
+            self.parse_xml_file(ctables, xml_input, prefix = prefix)
+
+        if hooks:
+            info['tags'] = len(ctables)
+            run_hooks(hooks, 'end', 'xml', info)
+
+    def get_template_lines(self):
+        """
+        Read the template once; a template read from stdin cannot be
+        read again, and the label search needs to look ahead.
+        """
+        if not hasattr(self, 'template_lines'):
+            with open_text(self.template) as fh:
+                self.template_lines = fh.readlines()
+
+        return self.template_lines
+
+    def get_xml_lines(self, xml_input):
+        if xml_input is self.template:
+            return list(self.get_template_lines())
+        else:
+            return concat_files(tolist(xml_input))
+
+    def get_store_tables(self):
+        """
+        Query the store for the tags the template might use: those in
+        its fill plan (see get_template_tags) and the names used inside
+        the custom XML tables.
+        """
+        wanted = self.get_template_tags()
+        if not self.ignore_xml:
+            xml_input = self.xml_tables
+            xml_input = self.template if xml_input is None else xml_input
+            inside    = False
+            for line in self.get_xml_lines(xml_input):
+                if re.search('</\s*tablefill-python\s*>', line):
+                    inside = False
+                elif re.search('<tablefill-python\\b', line):
+                    inside = True
+                elif inside:
+                    names = re.findall(r'[A-Za-z_]\w*', line)
+                    wanted.update(name.lower() for name in names)
+
+        with tablefill_store(self.store, readonly = True) as store:
+            return store.get_tables(wanted)
 
     def parse_xml_file(self, ctables, xml_input, prefix = ''):
         """Parse custom tabs in comments/XML files
@@ -956,8 +3721,7 @@ class tablefill_internals_engine:
         """
 
         # Read in all the custom tables
-        xml_list     = tolist(xml_input)
-        xml_toparse  = concat_files(xml_list)
+        xml_toparse  = self.get_xml_lines(xml_input)
 
         xml_regex  = prefix
         xml_regex += "<tablefill-python\s+tag\s*=\s*['\"](.+)\s*['\"]"
@@ -981,7 +3745,7 @@ class tablefill_internals_engine:
             i += 1
 
         # Prase each custom XMl tag into a dictionary
-        cdict = {}
+        cdict = OrderedDict()
         for c in custom:
             chtml    = []
             cobj     = itemgetter(*c)(xml_toparse)
@@ -997,6 +3761,12 @@ class tablefill_internals_engine:
             t = cxml.get('tag')
             cdict[t] = cxml
 
+        if not cdict:
+            return
+        elif self.xml_jobs is not None:
+            self.parse_xml_sandboxed(ctables, cdict)
+            return
+
         # Get temporary string and numeric dictionaries
         strdict = ctables
         numdict = {}
@@ -1007,35 +3777,17 @@ class tablefill_internals_engine:
         numpy_numdict = {}
         if numpyok:
             for tag, table in strdict.items():
-                numpy_strdict[tag] = numpy.asmatrix(table)
+                numpy_strdict[tag] = numpy_matrix(table)
 
             for tag, table in numdict.items():
-                numpy_numdict[tag] = numpy.asmatrix(table)
+                numpy_numdict[tag] = numpy_matrix(table)
 
         # Create all the custom tables using python/numpy slicing
-        print_verbose(self.verbose, linesep + "Creating custom tables")
+        self.logger.debug(linesep + "Creating custom tables")
         for tag, cxml in cdict.items():
-            print_verbose(self.verbose, "\ttab:%s" % (tag))
-
-            csyntax = cxml.get('syntax')
-            if csyntax not in [None, 'python', 'numpy']:
-                xml_syntax_msg  = "Custom table '%s' requested unknown syntax"
-                xml_syntax_msg += " '%s'. Specify 'python' or 'numpy'."
-                raise Warning('\t' + xml_syntax_msg % (tag, csyntax))
-
-            usenumpy = self.numpy_syntax and not csyntax == 'python'
-            usenumpy = usenumpy or (csyntax == 'numpy')
-            if usenumpy and not numpyok:
-                xml_numpy_msg  = "Custom table '%s' requested syntax 'numpy'"
-                xml_numpy_msg += " but python failed to import numpy."
-                raise Warning('\t' + xml_numpy_msg % tag)
-
-            usetype = 'float' if self.use_floats else cxml.get('type')
-            if usetype not in [None, 'float', 'numeric', 'str', 'string']:
-                xml_usetype_msg  = "Custom table '%s' asked unknown type"
-                xml_usetype_msg += " '%s'. Specify 'float' or 'str'."
-                raise Warning('\t' + xml_usetype_msg % (tag, usetype))
+            self.logger.debug("\ttab:%s", tag)
 
+            usenumpy, usetype = self.get_xml_syntax(tag, cxml)
             if usetype in ['float', 'numeric']:
                 usedict = numpy_numdict if numpyok and usenumpy else numdict
             else:
@@ -1047,7 +3799,7 @@ class tablefill_internals_engine:
             addok = False
             try:
                 clean_text = re.subn('\s|' + linesep, '', cxml.text)[0]
-                print_verbose(self.verbose, "\t\t%s" % clean_text)
+                self.logger.debug("\t\t%s", clean_text)
                 ceval = eval(clean_text, usedict)
 
                 if numpyok and usenumpy:
@@ -1068,20 +3820,142 @@ class tablefill_internals_engine:
                     strdict[tag] = nested_convert(ceval, str)
                     numdict[tag] = nested_convert(ceval, float)
                     if numpyok:
-                        numpy_strdict[tag] = numpy.asmatrix(strdict[tag])
-                        numpy_numdict[tag] = numpy.asmatrix(numdict[tag])
+                        numpy_strdict[tag] = numpy_matrix(strdict[tag])
+                        numpy_numdict[tag] = numpy_matrix(numdict[tag])
 
                     addok = True
             except Exception:
-                warn_custom = "custom 'tab:%s' failed to parse." % tag
-                print_verbose(self.verbose, '\t' + warn_custom)
-                print_verbose(self.verbose, sys.exc_info()[2])
+                warn_custom = "\tcustom 'tab:%s' failed to parse."
+                self.logger.debug(warn_custom, tag)
+                self.logger.debug("%s", sys.exc_info()[2])
 
             if numpyok and usenumpy:
                 usedict.pop('numpy')
 
             if addok:
                 ctables[tag] = list(nested_convert(toadd, str))
+                rows = get_custom_rows(ceval, numpyok and usenumpy)
+                self.xml_rows[tag] = nested_convert(rows, str)
+
+    def get_xml_syntax(self, tag, cxml):
+        """
+        Whether custom table 'tag' uses numpy, and the type it asked for
+        """
+        csyntax = cxml.get('syntax')
+        if csyntax not in [None, 'python', 'numpy']:
+            xml_syntax_msg  = "Custom table '%s' requested unknown syntax"
+            xml_syntax_msg += " '%s'. Specify 'python' or 'numpy'."
+            raise Warning('\t' + xml_syntax_msg % (tag, csyntax))
+
+        usenumpy = self.numpy_syntax and not csyntax == 'python'
+        usenumpy = usenumpy or (csyntax == 'numpy')
+        if usenumpy and not numpyok:
+            xml_numpy_msg  = "Custom table '%s' requested syntax 'numpy'"
+            xml_numpy_msg += " but python failed to import numpy."
+            raise Warning('\t' + xml_numpy_msg % tag)
+
+        usetype = 'float' if self.use_floats else cxml.get('type')
+        if usetype not in [None, 'float', 'numeric', 'str', 'string']:
+            xml_usetype_msg  = "Custom table '%s' asked unknown type"
+            xml_usetype_msg += " '%s'. Specify 'float' or 'str'."
+            raise Warning('\t' + xml_usetype_msg % (tag, usetype))
+
+        return usenumpy, usetype
+
+    def parse_xml_sandboxed(self, ctables, cdict):
+        """
+        Evaluate the custom tables in 'cdict' in a pool of self.xml_jobs
+        worker processes (see eval_custom_table). A custom table waits
+        for the custom tables before it that it names; the rest are
+        evaluated at once. Tables that fail are left out of 'ctables'
+        and reported, with the reason, in self.xml_errors.
+        """
+        self.logger.debug(linesep + "Creating custom tables in %d processes",
+                          self.xml_jobs)
+
+        # A custom table is evaluated one step after those it names
+        steps = OrderedDict()
+        tasks = []
+        for tag, cxml in cdict.items():
+            usenumpy, usetype = self.get_xml_syntax(tag, cxml)
+            text  = re.subn('\s|' + linesep, '', cxml.text)[0]
+            names = set(re.findall(r'[A-Za-z_]\w*', text))
+            after = [steps[name] + 1 for name in names if name in steps]
+            steps[tag] = max([0] + after)
+            tasks += [(steps[tag], tag, text, names, usenumpy, usetype)]
+
+        if not tasks:
+            return
+
+        # Later custom tables see earlier ones with the shape they had.
+        # Workers note when they start each table in shared memory, so a
+        # table that hangs without releasing the GIL still shows as
+        # started.
+        rows    = dict(ctables)
+        wait    = None if self.xml_timeout is None else self.xml_timeout + xml_grace
+        started = multiprocessing.Array('d', len(tasks), lock = False)
+        pool    = multiprocessing.Pool(self.xml_jobs, init_xml_worker, (started,))
+        try:
+            for step in range(max(steps.values()) + 1):
+                pending = []
+                for index, (s, tag, text, names, usenumpy, usetype) in enumerate(tasks):
+                    if s == step:
+                        self.logger.debug("\ttab:%s", tag)
+                        self.logger.debug("\t\t%s", text)
+                        tables = dict((k, rows[k]) for k in names if k in rows)
+                        args   = (tag, text, tables, usenumpy, usetype,
+                                  self.xml_timeout, self.xml_memory, index)
+                        pending += [[tag, args, pool.apply_async(eval_custom_table,
+                                                                 (args,))]]
+
+                k = 0
+                while k < len(pending):
+                    tag, args, result = pending[k]
+                    if tag in self.xml_errors:
+                        k += 1
+                        continue
+
+                    try:
+                        tag, packed, lengths, error = result.get(wait)
+                    except multiprocessing.TimeoutError:
+                        # Tables that ran for their whole time failed; the
+                        # rest (say, queued behind a hung table) start over
+                        now   = time.time()
+                        error = 'took longer than %gs' % self.xml_timeout
+                        pool.terminate()
+                        pool  = multiprocessing.Pool(self.xml_jobs,
+                                                     init_xml_worker,
+                                                     (started,))
+                        for task in pending[k:]:
+                            t, a, r = task
+                            if r.ready():
+                                continue
+                            elif 0 < started[a[-1]] <= now - self.xml_timeout:
+                                self.xml_errors[t] = error
+                            else:
+                                started[a[-1]] = 0
+                                task[2] = pool.apply_async(eval_custom_table, (a,))
+
+                        continue
+
+                    k += 1
+                    if error is not None:
+                        self.xml_errors[tag] = error
+                        continue
+
+                    entries, i = unpack_entries(packed), 0
+                    ctables[tag] = entries
+                    rows[tag]    = []
+                    for n in lengths:
+                        rows[tag] += [entries[i:i + n]]
+                        i += n
+
+                    self.xml_rows[tag] = rows[tag]
+        finally:
+            pool.terminate()
+
+        for tag, error in self.xml_errors.items():
+            self.logger.warning("\tcustom 'tab:%s' failed: %s", tag, error)
 
     def parse_xml_file_legacy(self, ctables, xml_input, prefix = ''):
         """Parse custom tabs in comments/XML files
@@ -1107,8 +3981,7 @@ class tablefill_internals_engine:
         """
 
         # Read in all the custom tables
-        xml_list     = tolist(xml_input)
-        xml_toparse  = concat_files(xml_list)
+        xml_toparse  = self.get_xml_lines(xml_input)
 
         xml_regex  = prefix
         xml_regex += "<tablefill-(custom|python)\s+tag\s*=\s*['\"](.+)\s*['\"]"
@@ -1155,7 +4028,7 @@ class tablefill_internals_engine:
 
         # Create all the custom tables using python/numpy slicing
         for tag, cxml in cdict.items():
-            print_verbose(self.verbose, "\tcreating custom tab:%s" % (tag))
+            self.logger.debug("\tcreating custom tab:%s", tag)
 
             csyntax = cxml.get('syntax')
             if csyntax not in [None, 'python', 'numpy']:
@@ -1237,17 +4110,15 @@ class tablefill_internals_engine:
                         except:
                             warn_custom  = "custom 'tab:%s' failed to subset "
                             warn_custom += "'%s' from 'tab:%s'; will continue."
-                            warn_msg = warn_custom % (tag, clean_subset, ctag)
-                            print_verbose(self.verbose, warn_msg)
+                            self.logger.debug(warn_custom, tag, clean_subset, ctag)
                             continue
 
                 ctables[tag] = list(flatten(table_tag))
 
     def filter_missing(self, string_list):
-        filters = self.nafilters
-        return list(filter(lambda a: a not in filters, string_list))
+        return self.missing.filter(string_list)
 
-    def get_filled_template(self):
+    def get_filled_template(self, tags = None):
         """
         Fill template file using table input(s). The idea is to read the
         template line by line and if the line matches the start of a
@@ -1263,82 +4134,322 @@ class tablefill_internals_engine:
             - Too many tokens in table and not enough values.
             - Token outside of begin/end table statement.
             - Table label does not match tag in inputs.
+
+        If 'tags' is given, only tables with those tags are filled (see
+        get_patched_output). The lines each filled table spans are kept
+        in self.regions.
         """
-        if version_info >= (3, 0):
-            read_template = open(self.template, 'r').readlines()
-        else:
-            read_template = open(self.template, 'rU').readlines()
+        read_template = list(self.get_template_lines())
         table_start   = -1
         table_search  = False
         table_tag     = ''
         table_entry   = 0
+        self.regions  = []
 
+        plan = self.get_fill_plan()
         warn = self.warn_pre
+
+        region_hooks = self.hooks.get('region')
+        lines_hooks  = self.hooks.get('lines')
+        region_info  = None
         for n in range(len(read_template)):
-            line = read_template[n]
-            if not table_search and re.search(self.begin, line):
-                table_search, table_tag = self.search_label(read_template, n)
+            if not table_search and n in plan.begin:
+                table_tag    = plan.begin[n]
+                table_search = table_tag in self.tables
                 table_start  = n
-                search_msg   = self.get_search_msg(table_search, table_tag, n)
-                print_verbose(self.verbose, search_msg)
+                self.log_search(table_search, table_tag, n)
 
-            found =                             \
-                re.search(self.matcha, line) or \
-                re.search(self.matchb, line) or \
-                re.search(self.matchf, line)
+                filled = tags is None or table_tag in tags
+                if region_hooks and table_search and filled:
+                    region_info = {'tag': table_tag, 'line': n}
+                    run_hooks(region_hooks, 'start', 'region', region_info)
 
-            if found:
-                if re.search(self.comments, line.strip()) and not self.fillc:
-                    warn_incomments  = r"Line %d matches #(#|\d+,*|{.*})#"
+            if n in plan.matrices:
+                if table_search and (tags is None or table_tag in tags):
+                    self.fill_matrix(read_template, n, plan.matrices[n],
+                                     table_tag, lines_hooks)
+                elif table_start == -1:
+                    self.warnings['notable'] += [str(n)]
+                    warn_notable  = "%sLine %d has a tablefill:matrix but is"
+                    warn_notable += " not in begin/end table statements."
+                    warn_notable += " Skipping..."
+                    self.logger.debug(warn_notable, warn, n)
+                elif table_tag == '':
+                    self.warnings['nolabel'] += [str(n)]
+                    warn_nolabel  = "%sLine %d has a tablefill:matrix"
+                    warn_nolabel += " but couldn't find %s Skipping..."
+                    self.logger.debug(warn_nolabel, warn, n, self.label)
+
+            if n in plan.lines:
+                commented, literals, slots = plan.lines[n]
+                addressed  = [slot for slot in slots if slot[0] == 'a']
+                sequential = len(addressed) < len(slots)
+                if commented and not self.fillc:
+                    warn_incomments  = r"%sLine %d matches #(#|\d+,*|{.*})#"
                     warn_incomments += " but it appears to be commented out."
                     warn_incomments += " Skipping..."
-                    print_verbose(self.verbose, warn + warn_incomments % n)
+                    self.logger.debug(warn_incomments, warn, n)
+                elif table_search and tags is not None and table_tag not in tags:
+                    pass
                 elif table_search:
-                    table  = self.tables[table_tag]
-                    ntable = len(table)
-                    update = self.replace_line(line, table, table_entry)
-                    read_template[n], table_entry, entry_start = update
+                    table       = self.tables[table_tag]
+                    ntable      = len(table)
+                    entry_start = table_entry
+                    if lines_hooks:
+                        lines_info = {'tag': table_tag,
+                                      'line': n,
+                                      'slots': slots,
+                                      'entry': table_entry}
+                        run_hooks(lines_hooks, 'start', 'lines', lines_info)
+
+                    update      = self.fill_line(literals,
+                                                 slots,
+                                                 table,
+                                                 table_entry,
+                                                 n)
+                    read_template[n], table_entry = update
+                    if lines_hooks:
+                        lines_info['entries'] = table_entry - entry_start
+                        run_hooks(lines_hooks, 'end', 'lines', lines_info)
+
                     if ntable < table_entry:
                         self.warnings['toolong'] += [str(n)]
 
-                        nstart        = entry_start + 1
-                        nend          = table_entry
-                        aux_toolong   = (n, nstart, nend, table_tag, ntable)
-
-                        warn_toolong  = "Line %d has matches %d-%d for table"
+                        warn_toolong  = "%sLine %d has matches %d-%d for table"
                         warn_toolong += " %s but the corresponding input"
                         warn_toolong += " matrix only has %d entries."
                         warn_toolong += " Skipping..."
-                        warn_toolong  = warn_toolong % aux_toolong
+                        self.logger.debug(warn_toolong, warn, n,
+                                          entry_start + 1, table_entry,
+                                          table_tag, ntable)
+                else:
+                    # Addressed placeholders are filled anywhere
+                    if addressed:
+                        read_template[n] = self.fill_line(literals, slots,
+                                                          [], 0, n)[0]
+
+                    if not sequential:
+                        pass
+                    elif table_start == -1:
+                        self.warnings['notable'] += [str(n)]
+
+                        warn_notable  = r"%sLine %d matches #(#|\d+,*|{.*})# but"
+                        warn_notable += " is not in begin/end table statements."
+                        warn_notable += " Skipping..."
+                        self.logger.debug(warn_notable, warn, n)
+                    elif table_tag == '':
+                        self.warnings['nolabel'] += [str(n)]
+                        warn_nolabel  = r"%sLine %d matches #(#|\d+,*|{.*})#"
+                        warn_nolabel += " but couldn't find %s Skipping..."
+                        self.logger.debug(warn_nolabel, warn, n, self.label)
+
+            if n in plan.end and table_search:
+                search_msg   = "Table '%s' in line %d ended in line %d."
+                search_msg  += " %d replacements were made."
+                self.logger.debug(search_msg + linesep,
+                                  table_tag, table_start, n, table_entry)
+
+                self.regions += [(table_start, n, table_tag)]
+                if region_info is not None:
+                    region_info['end']     = n
+                    region_info['entries'] = table_entry
+                    run_hooks(region_hooks, 'end', 'region', region_info)
+                    region_info = None
+
+                table_start  = -1
+                table_search = False
+                table_tag    = ''
+                table_entry  = 0
+
+        # A table left open at the end of the template
+        if region_info is not None:
+            region_info['end']     = None
+            region_info['entries'] = table_entry
+            run_hooks(region_hooks, 'end', 'region', region_info)
 
-                        print_verbose(self.verbose, warn + warn_toolong)
+        self.filled_template = read_template
+
+    def get_query(self):
+        """
+        Report every table in the template (its label, lines, number of
+        placeholders, and whether the inputs have a tag with enough
+        entries) without filling anything. The warnings are the same
+        ones a fill would give. If self.query has tags, only tables
+        with those labels are reported.
+        """
+        lines        = self.get_template_lines()
+        table_start  = -1
+        table_search = False
+        table_tag    = ''
+        table_entry  = 0
+        region       = None
+        regions      = []
+        sequential   = []
+
+        plan = self.get_fill_plan()
+        for n in range(len(lines)):
+            if not table_search and n in plan.begin:
+                table_tag    = plan.begin[n]
+                table_search = table_tag in self.tables
+                table_start  = n
+                self.log_search(table_search, table_tag, n)
+
+            if region is None and n in plan.begin:
+                region = OrderedDict([
+                    ('label',        plan.begin[n]),
+                    ('begin',        n),
+                    ('end',          None),
+                    ('placeholders', 0),
+                    ('tag',          plan.begin[n] in self.tables),
+                    ('entries',      None)
+                ])
+                regions    += [region]
+                sequential += [0]
+                if region['tag']:
+                    region['entries'] = len(self.tables[region['label']])
+
+            if n in plan.matrices:
+                # Without a tag, count the fmt placeholders
+                if region is not None and table_search:
+                    region['placeholders'] += \
+                        self.count_matrix_cells(plan.matrices[n], table_tag)
+                elif region is not None:
+                    region['placeholders'] += len(plan.matrices[n][0])
+
+                if table_search:
+                    pass
                 elif table_start == -1:
                     self.warnings['notable'] += [str(n)]
+                elif table_tag == '':
+                    self.warnings['nolabel'] += [str(n)]
 
-                    warn_notable  = r"Line %d matches #(#|\d+,*|{.*})# but"
-                    warn_notable += " is not in begin/end table statements."
-                    warn_notable += " Skipping..."
-
-                    print_verbose(self.verbose, warn + warn_notable % n)
+            if n in plan.lines:
+                commented, literals, slots = plan.lines[n]
+                addressed = [slot for slot in slots if slot[0] == 'a']
+                nslots    = len(slots) - len(addressed)
+                if commented and not self.fillc:
+                    pass
+                elif table_search and nslots:
+                    ntable      = len(self.tables[table_tag])
+                    if table_entry + nslots <= ntable:
+                        table_entry += nslots
+                    else:
+                        table_entry  = max(table_entry, ntable) + 1
+                        self.warnings['toolong'] += [str(n)]
+                elif table_search or not nslots:
+                    pass
+                elif table_start == -1:
+                    self.warnings['notable'] += [str(n)]
                 elif table_tag == '':
                     self.warnings['nolabel'] += [str(n)]
-                    warn_nolabel  = r"Line %d matches #(#|\d+,*|{.*})#" % n
-                    warn_nolabel += " but couldn't find " + self.label
-                    warn_nolabel += " Skipping..."
-                    print_verbose(self.verbose, warn + warn_nolabel)
 
-            if re.search(self.end, line) and table_search:
-                search_msg   = "Table '%s' in line %d ended in line %d."
-                search_msg  += " %d replacements were made." % table_entry
-                search_msg   = search_msg % (table_tag, table_start, n)
-                print_verbose(self.verbose, search_msg + linesep)
+                if not (commented and not self.fillc):
+                    for (kind, cell, spec) in addressed:
+                        self.get_address(spec, n)
+
+                if region is not None and not (commented and not self.fillc):
+                    region['placeholders'] += nslots
+                    sequential[-1]         += nslots
+
+            if n in plan.end and region is not None:
+                region['end'] = n
+                region = None
 
+            if n in plan.end and table_search:
                 table_start  = -1
                 table_search = False
                 table_tag    = ''
                 table_entry  = 0
 
-        self.filled_template = read_template
+        # Matrix cells do not use up entries
+        for region, nslots in zip(regions, sequential):
+            if region['label'] == '':
+                region['ok'] = region['placeholders'] == 0
+            else:
+                region['ok'] = region['tag'] and nslots <= region['entries']
+
+        # Only keep the warnings about the tables that were asked for
+        if self.query != []:
+            tags    = [tag.lower() for tag in self.query]
+            regions = [r for r in regions if r['label'] in tags]
+            spans   = [(r['begin'], len(lines) if r['end'] is None else r['end'])
+                       for r in regions]
+
+            toolong = [l for l in self.warnings['toolong']
+                       if any([b <= int(l) <= e for (b, e) in spans])]
+            nomatch = [t for t in self.warnings['nomatch'] if t in tags]
+            self.warnings['nomatch'] = nomatch
+            self.warnings['notable'] = []
+            self.warnings['nolabel'] = []
+            self.warnings['toolong'] = toolong
+
+        self.query_tables   = regions
+        self.query_warnings = dict((k, list(v))
+                                   for (k, v) in self.warnings.items())
+
+    def get_query_report(self):
+        """
+        Format the query as text or, with query_json, as JSON
+        """
+        template = self.get_shown_path(self.template)
+        inputs   = [self.get_shown_path(f) for f in self.inputs]
+        if self.query_json:
+            report = OrderedDict([('template', template),
+                                  ('input',    inputs),
+                                  ('tables',   self.query_tables),
+                                  ('warnings', self.query_warnings)])
+            return [json.dumps(report, indent = 2) + linesep]
+
+        labels  = [r['label'] for r in self.query_tables]
+        width   = max([len('Table')] + [len(label) for label in labels])
+        row     = '%-' + str(width) + 's  %-11s  %12s  %7s  %s'
+        report  = ["Template: %s" % template]
+        report += ["Input file(s): %s" % inputs, '']
+        report += [row % ('Table', 'Lines', 'Placeholders', 'Entries', 'Status')]
+        for r in self.query_tables:
+            end     = '' if r['end'] is None else r['end']
+            entries = '-' if r['entries'] is None else r['entries']
+            if r['ok']:
+                status = 'OK'
+            elif r['label'] == '':
+                status = 'NO LABEL'
+            elif not r['tag']:
+                status = 'NO TAG'
+            else:
+                status = 'TOO FEW ENTRIES'
+
+            report += [row % (r['label'] or '-',
+                              '%d-%s' % (r['begin'], end),
+                              r['placeholders'],
+                              entries,
+                              status)]
+
+        return [line + linesep for line in report]
+
+    def get_fill_plan(self):
+        plan, source = get_fill_plan(self.get_template_lines(),
+                                     self.get_plan_regexes(),
+                                     self.plan_cache)
+        if source is not None:
+            self.logger.debug("Using fill plan cached in %s", source)
+
+        return plan
+
+    def get_plan_regexes(self):
+        return {'begin':    self.begin,
+                'end':      self.end,
+                'label':    self.label,
+                'comments': self.comments,
+                'match0':   self.match0,
+                'matcha':   self.matcha,
+                'matchb':   self.matchb,
+                'matchd':   self.matchd,
+                'matchf':   self.matchf,
+                'matcht':   self.matcht,
+                'matrix':   self.matrix,
+                'matrix_rows': self.filetype,
+                'placeholders': [(name, entry['regex']) for (name, entry)
+                                 in tablefill_placeholders.items()]}
 
     def search_label(self, intext, start):
         r"""
@@ -1346,151 +4457,299 @@ class tablefill_internals_engine:
         \end{table} statement. Returns label value ('' if none is found)
         and whether it matches a tag in the tables file
         """
-        N = start
-        searchline  = intext[N]
-        searchmatch = re.search(self.label, searchline,
-                                flags = re.IGNORECASE)
-        searchend   = re.search(self.end, searchline)
-        while not searchmatch and not searchend:
-            N += 1
-            searchline  = intext[N]
-            searchmatch = re.search(self.label, searchline,
-                                    flags = re.IGNORECASE)
-            searchend   = re.search(self.end, searchline)
-
-        if not searchend and searchmatch:
-            label = re.findall(self.label, searchline,
-                               flags = re.IGNORECASE)[0]
-            label = label.strip('{}"').lower()
-            return label in self.tables, label
-        else:
-            return False, ''
+        label = find_label(intext, start, self.label, self.end)
+        return label in self.tables, label
 
-    def get_search_msg(self, search, tag, start):
-        warn_nomatch = ''
-        search_msg   = "Found table in line %d. " % start
+    def log_search(self, search, tag, start):
+        """
+        Log the result of the label search for the table in line
+        'start'; a label with no matching tag is a 'nomatch' warning.
+        """
         if tag == '':
-            search_msg += "No label. Skipping..."
+            search_msg = "Found table in line %d. No label. Skipping..."
+            self.logger.debug(search_msg, start)
+        elif search:
+            search_msg = "Found table in line %d. Found label '%s'... Found match!"
+            self.logger.debug(search_msg, start, tag)
         else:
-            search_msg += "Found label '%s'... " % tag
-            if search:
-                search_msg += "Found match!"
+            self.warnings['nomatch'] += [tag]
+            if self.logger.isEnabledFor(logging.DEBUG):
+                search_msg  = "Found table in line %d. Found label '%s'... "
+                search_msg += linesep + "%sNO MACHES FOR '%s' IN" + linesep
+                search_msg += '\t%s' + linesep + "Please check input file(s)"
+                search_msg += linesep
+                inputs = (linesep + '\t').join(self.input)
+                self.logger.debug(search_msg, start, tag, self.warn_pre,
+                                  tag, inputs)
+
+    def fill_line(self, literals, slots, table, tablen, n = None):
+        """
+        Fill the slots of a plan line with table entries starting at
+        'tablen'. If the table runs out, the rest of the line is left
+        as is. Addressed slots (line n) are filled from the cell they
+        point to and do not use table entries. Returns the line and the
+        next table entry.
+        """
+        line  = [literals[0]]
+        ended = False
+        for i, slot in enumerate(slots):
+            if slot[0] == 'a':
+                line += [self.fill_address(slot, n)]
+            elif ended or tablen >= len(table):
+                line += [slot[1]]
+                ended = True
             else:
-                self.warnings['nomatch']  += [tag]
-                warn_nomatch  = linesep + self.warn_pre
-                warn_nomatch += "NO MACHES FOR '%s' IN" + linesep + '\t'
-                warn_nomatch += (linesep + '\t').join(self.input)
-                warn_nomatch += linesep + "Please check input file(s)"
-                warn_nomatch  = warn_nomatch % tag + linesep
+                line   += [self.fill_slot(slot, table[tablen])]
+                tablen += 1
+                self.replaced += 1
 
-        return search_msg + warn_nomatch
+            line += [literals[i + 1]]
 
-    def replace_line(self, line, table, tablen):
-        r"""
-        Replaces all matches of #(#|\d+,*|{.*})#. Splits by & because
-        that's how LaTeX delimits tables. Returns how many values it
-        replaced because LaTeX can have any number of entries per line.
+        return ''.join(line), tablen + 1 if ended else tablen
+
+    def fill_address(self, slot, n):
         """
-        i = 0
-        force_stop = False
-        starts = tablen
-        match0 = re.search(self.match0, line)
-        while match0 and not force_stop:
-            s, e = match0.span()
-            cell = line[s:e]
-            matcha = re.search(self.matcha, cell)
-            matchb = re.search(self.matchb, cell)
-            matchf = re.search(self.matchf, cell)
-
-            if len(table) > tablen:
-                # Replace all pattern A matches (simply replace the text)
-                if matcha:
-                    entry    = re.sub(self.matche, '\\\\\\1', table[tablen])
-                    if '*' in matcha.groups():
-                        cell = self.parse_pval_to_stars(cell, entry)
-                    else:
-                        cell = re.sub(self.matcha, entry, cell, count = 1)
-
-                    line    = re.sub(self.matcha, cell, line, count = 1)
-                    tablen += 1
-
-                # Replace all pattern B matches (round, comma and % format)
-                if matchb:
-                    entry   = re.sub(self.matche, '\\\\\\1', table[tablen])
-                    cell    = self.round_and_format(cell, entry)
-                    line    = re.sub(self.matchb, cell, line, count = 1)
-                    tablen += 1
-
-                # Replace all pattern F matches ({} arbitrary python formatting)
-                if matchf:
-                    entry = re.sub(self.matche, '\\\\\\1', table[tablen])
-                    if matchf.group(3) in ['date', 'time']:
-                        try:
-                            d = datetime(1960, 1, 1)
-                            if matchf.group(3) == 'date':
-                                d += timedelta(days = int(float(entry)))
-                            else:
-                                d += timedelta(seconds = int(float(entry)))
+        Fill an addressed slot in line n with the entry of the cell it
+        points to, formatted as its #fmt# placeholder. The placeholder
+        is left as is if there is no such cell; missing entries are
+        left blank.
+        """
+        kind, cell, spec = slot
+        entry = self.get_address(spec, n)
+        if entry is None:
+            return cell
+        elif self.missing.is_missing(entry):
+            return ''
 
-                            fmt = matchf.group(1).replace('\\', '').format(d)
-                        except:
-                            msg = "Unable to apply datetime format '%s' to entry '%s'"
-                            raise Warning(msg % (matchf.group(1).replace('\\', ''), int(float(entry))))
-                    else:
-                        try:
-                            try:
-                                fmt = matchf.group(1).format(entry)
-                            except:
-                                fmt = matchf.group(1).format(float(entry))
-                        except:
-                            msg = "Unable to apply python format '%s' to entry '%s'"
-                            raise Warning(msg % (matchf.group(1), entry))
+        self.replaced += 1
+        return self.fill_slot(tuple(spec[3]), entry)
+
+    def get_address(self, spec, n):
+        """
+        Entry of the cell row, col (starting at 1) of the matrix of tag
+        that an addressed slot in line n points to. If there is no such
+        tag ('nomatch') or cell ('toolong') this is a warning and the
+        entry is None.
+        """
+        tag, row, col, inner = spec
+        warn = self.warn_pre
+        if tag not in self.matrices:
+            if tag not in self.warnings['nomatch']:
+                self.warnings['nomatch'] += [tag]
 
-                    cell    = re.sub(self.matchf, fmt,  cell, count = 1)
-                    line    = re.sub(self.matchf, cell, line, count = 1)
-                    tablen += 1
+            warn_nomatch  = "%sLine %d points to table '%s' but there is"
+            warn_nomatch += " no such tag in the inputs. Skipping..."
+            self.logger.debug(warn_nomatch, warn, n, tag)
+            return None
 
-            else:
-                if matcha or matchb or matchf:
-                    starts  = tablen if tablen - starts == i + 1 else starts
-                    tablen += 1
+        try:
+            entry = tolist(self.get_matrix_rows(tag)[row - 1])[col - 1]
+        except IndexError:
+            if str(n) not in self.warnings['toolong']:
+                self.warnings['toolong'] += [str(n)]
+
+            warn_toolong  = "%sLine %d points to row %d, column %d of table"
+            warn_toolong += " %s but the corresponding input matrix has no"
+            warn_toolong += " such cell. Skipping..."
+            self.logger.debug(warn_toolong, warn, n, row, col, tag)
+            return None
 
-                force_stop = True
+        return entry if isinstance(entry, basestring) else str(entry)
 
-            match0 = re.search(self.match0, line)
-            i += 1
+    def get_matrix_rows(self, tag):
+        """
+        Rows of the matrix of 'tag' as read from the inputs or as the
+        custom table evaluated (a flat list of entries is a single row)
+        """
+        rows = self.matrices[tag]
+        if rows and not any(isinstance(row, list) for row in rows):
+            rows = [rows]
+
+        return rows
+
+    def fill_matrix(self, template, n, matrix, tag, hooks = None):
+        """
+        Expand the tablefill:matrix at line n of 'template' into a row
+        per row of the matrix of 'tag' (see tablefill_plan). Column j
+        is formatted with the j-th fmt placeholder, or the last one;
+        missing entries are left blank.
+        """
+        slots, layout = matrix
+        if hooks:
+            info = {'tag': tag, 'line': n, 'slots': slots, 'entry': 0}
+            run_hooks(hooks, 'start', 'lines', info)
+
+        line  = template[n]
+        eol   = line[len(line.rstrip('\r\n')):] or linesep
+        rows  = self.get_matrix_rows(tag)
+        cells = []
+        for row in rows:
+            cells += [[]]
+            for j, entry in enumerate(tolist(row)):
+                entry = entry if isinstance(entry, basestring) else str(entry)
+                if self.missing.is_missing(entry):
+                    cells[-1] += ['']
+                else:
+                    slot = slots[min(j, len(slots) - 1)]
+                    cells[-1] += [self.fill_slot(slot, entry)]
+
+        if self.filetype == 'lyx':
+            start, end = layout['row']
+            ncols  = len(layout['cells'])
+            filled = []
+            for row in cells:
+                filled += [layout['open'] + eol]
+                for cell, entry in zip(layout['cells'], row + [''] * ncols):
+                    filled += [cell + eol,
+                               '\\begin_inset Text' + eol + eol,
+                               '\\begin_layout Plain Layout' + eol,
+                               entry + eol,
+                               '\\end_layout' + eol + eol,
+                               '\\end_inset' + eol,
+                               '</cell>' + eol]
+
+                filled += ['</row>' + eol]
+
+            template[start:(end + 1)] = [''.join(filled)] + [''] * (end - start)
+
+            nrows = lambda m: 'rows="%d"' % (int(m.group(1)) + len(cells) - 1)
+            template[layout['tabular']] = re.sub(r'rows="(\d+)"', nrows,
+                                                 template[layout['tabular']],
+                                                 count = 1)
+        elif self.filetype == 'md':
+            indent = layout['indent']
+            cells  = [[c.replace('|', '\\|') for c in row] for row in cells]
+            rows   = [indent + '| ' + ' | '.join(row) + ' |' + eol for row in cells]
+            template[n] = line + ''.join(rows)
+        else:
+            indent = layout['indent']
+            rows   = [indent + ' & '.join(row) + ' \\\\' + eol for row in cells]
+            template[n] = line + ''.join(rows)
+
+        filled = self.count_matrix_cells(matrix, tag)
+        self.replaced += filled
+        if hooks:
+            info['entries'] = filled
+            run_hooks(hooks, 'end', 'lines', info)
+
+    def count_matrix_cells(self, matrix, tag):
+        """
+        Number of cells a tablefill:matrix fills with the entries of
+        'tag': the entries that are not missing (in the cells of the
+        copied row, for LyX)
+        """
+        slots, layout = matrix
+        ncols = len(layout['cells']) if 'cells' in layout else None
+        cells = 0
+        for row in self.get_matrix_rows(tag):
+            for entry in tolist(row)[:ncols]:
+                entry  = entry if isinstance(entry, basestring) else str(entry)
+                cells += not self.missing.is_missing(entry)
+
+        return cells
 
-        return line, tablen, starts
+    def fill_slot(self, slot, entry):
+        """
+        Format one table entry for a plan slot. & and % are escaped.
+        """
+        kind, cell, spec = slot
+        if '%' in entry or '&' in entry:
+            entry = re.sub(self.matche, '\\\\\\1', entry)
+
+        if cell not in self.formatters:
+            self.formatters[cell] = self.get_formatter(kind, spec)
+
+        formatter, regex = self.formatters[cell]
+        fill = formatter(entry)
 
-    def round_and_format(self, cell, entry):
+        # Entries were always substituted into the placeholder and then
+        # into the line, so backslash escapes are expanded twice
+        if '\\' in fill:
+            fill = re.sub(regex, fill, cell, count = 1)
+            fill = re.sub(regex, fill, cell, count = 1)
+
+        return fill
+
+    def get_formatter(self, kind, spec):
         """
-        Rounds entry according to the format in cell. Note Decimal's
-        quantize makes the object have the same number of significant
-        digits as the input passed. format(str, ',d') returns str with
-        comma as thousands separator.
+        Compile a plan slot into (formatter, regex): the function that
+        formats each entry for the placeholder, and the placeholder's
+        regex. fill_slot caches these per placeholder.
         """
-        precision, comma = re.findall(self.matchb, cell)[0]
-        precision = int(precision)
-        roundas   = 0 if precision == 0 else pow(10, -precision)
-        roundas   = Decimal(str(roundas))
-        dentry    = 100 * Decimal(entry) if '%' in comma else Decimal(entry)
-        dentry    = abs(dentry) if re.search(self.matchd, cell) else dentry
-        rounded   = str(dentry.quantize(roundas, rounding = ROUND_HALF_UP))
-        if ',' in comma:
-            integer_part, decimal_part = re.findall(self.matchc, rounded)[0]
-            neg      = '-' if re.match('^-0', integer_part) else ''
-            rounded  = neg + compat_format(int(integer_part)) + decimal_part
-        return re.sub(self.matchb, rounded, cell, count = 1)
+        if kind == '#':
+            return (lambda entry: entry), self.matcha
+        elif kind == '*':
+            return self.parse_pval_to_stars, self.matcha
+        elif kind == 'b':
+            return self.get_rounder(*spec), self.matchb
+        elif kind == 'f':
+            fmt, unit = spec
+            return (lambda entry: self.python_format(entry, fmt, unit)), self.matchf
+        else:
+            name, groups = spec
+            placeholder  = tablefill_placeholders[name]
+            return placeholder['formatter'](*groups), placeholder['regex']
 
-    def parse_pval_to_stars(self, cell, entry):
+    def get_rounder(self, precision, comma, absval = False):
+        """
+        Function that rounds entries to 'precision' digits, possibly as
+        a percentage or with comma as thousands separator. Note
+        Decimal's quantize makes the object have the same number of
+        significant digits as the input passed. format(str, ',d')
+        returns str with comma as thousands separator.
+        """
+        roundas = 0 if precision == 0 else pow(10, -precision)
+        roundas = Decimal(str(roundas))
+        percent = '%' in comma
+        commas  = ',' in comma
+
+        def round_and_format(entry):
+            dentry  = 100 * Decimal(entry) if percent else Decimal(entry)
+            dentry  = abs(dentry) if absval else dentry
+            rounded = str(dentry.quantize(roundas, rounding = ROUND_HALF_UP))
+            if commas:
+                integer_part, decimal_part = re.findall(self.matchc, rounded)[0]
+                neg     = '-' if re.match('^-0', integer_part) else ''
+                rounded = neg + compat_format(int(integer_part)) + decimal_part
+            return rounded
+
+        return round_and_format
+
+    def parse_pval_to_stars(self, entry):
         """
         Parse a p-value to significance symbols. The default is to
         parse 0.1, 0.05, 0.01 to *, **, ***, but the user can specify
         arbitrary thresholds and symbols.
         """
-        pos  = sum([float(entry) < p for p in self.pvals]) - 1
-        star = '' if pos < 0 else self.stars[pos]
-        return re.sub(self.matcha, star, cell, count = 1)
+        larger = len(self.pvals_sorted) - bisect_right(self.pvals_sorted, float(entry))
+        return '' if larger == 0 else self.stars[larger - 1]
+
+    def python_format(self, entry, fmt, unit = None):
+        """
+        Apply python format 'fmt' to entry; if 'unit' is given, entries
+        are Stata dates in that unit (see stata_datetime). Dates repeat
+        a lot in panel tables, so each formatted date is cached.
+        """
+        if unit is not None:
+            key = (entry, fmt, unit)
+            if key not in self.date_formats:
+                try:
+                    d = stata_datetime(int(float(entry)), unit)
+                    self.date_formats[key] = fmt.replace('\\', '').format(d)
+                except:
+                    msg = "Unable to apply datetime format '%s' to entry '%s'"
+                    raise Warning(msg % (fmt.replace('\\', ''), int(float(entry))))
+
+            return self.date_formats[key]
+        else:
+            try:
+                try:
+                    return fmt.format(entry)
+                except:
+                    return fmt.format(float(entry))
+            except:
+                msg = "Unable to apply python format '%s' to entry '%s'"
+                raise Warning(msg % (fmt, entry))
 
     def get_notification_message(self):
         r"""
@@ -1523,6 +4782,83 @@ class tablefill_internals_engine:
             head  = ["<!-- "]
             tail  = [" -->", linesep, linesep]
 
+        self.get_warning_messages()
+        msg  = ["This file was produced by 'tablefill.py'"]
+        msg += ["\tTemplate file: %s" % self.get_shown_path(self.template)]
+        msg += ["\tInput file(s): %s" % [self.get_shown_path(f) for f in self.inputs]]
+        if self.store is not None:
+            msg += ["\tTable store: %s" % self.get_shown_path(self.store)]
+        if self.deterministic:
+            msg += ["\tFingerprint: sha1:%s" % self.get_fingerprint()]
+        if self.binary:
+            msg = [fs_latin1(m) for m in msg]
+        msg += ["To make changes, edit the input and template files."]
+        msg += [pre + after]
+
+        if self.warning:
+            msg += ["THERE WAS AN ISSUE CREATING THIS FILE!"]
+            msg += [s for s in self.warn_msg.values()]
+        else:
+            msg += ["DO NOT EDIT THIS FILE DIRECTLY."]
+
+        self.head = [0, 0]
+        if self.nohead:
+            return
+
+        msg = [pre + m + after for m in msg]
+        self.filled_template[n:n] = head + msg + tail
+        self.head = [n, ''.join(head + msg + tail).count('\n')]
+
+    def get_shown_path(self, fname):
+        """
+        File name as shown in the output: as is, or with deterministic,
+        relative to self.root (the template's folder if None) with '/'
+        as the separator
+        """
+        if not self.deterministic or fname == '-':
+            return fname
+
+        root = self.root
+        if root is None and self.template == '-':
+            root = getcwd()
+        elif root is None:
+            root = path.dirname(self.template)
+
+        shown = path.relpath(path.abspath(fname), path.abspath(root))
+        return shown.replace(path.sep, '/')
+
+    def get_fingerprint(self):
+        """
+        Hash of what the filled output is made of: the template, the
+        entries of the tags it uses, and the formatting, missing-value,
+        and custom table options and registered placeholders (by name,
+        regex, and formatter), but not where any of the files are
+        """
+        placeholders = [(name, entry['regex'], get_callable_name(entry['formatter']))
+                        for (name, entry) in tablefill_placeholders.items()]
+        contents = [__version__,
+                    ''.join(self.get_template_lines()),
+                    self.filetype,
+                    self.pvals,
+                    self.stars,
+                    self.fillc,
+                    self.missing.get_key(),
+                    self.numpy_syntax,
+                    self.use_floats,
+                    placeholders,
+                    sorted(self.get_tag_digests().items(),
+                           key = lambda d: d[0])]
+
+        digest = hashlib.sha1()
+        digest.update(json.dumps(contents, default = str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_warning_messages(self):
+        """
+        Summarize the warnings found while filling (or querying)
+        """
+        pre = '% ' if self.filetype == 'tex' else ''
+        self.warning_lists = dict((k, list(v)) for k, v in self.warnings.items())
         for key in self.warnings.keys():
             self.warnings[key] = ', '.join(self.warnings[key])
 
@@ -1534,8 +4870,11 @@ class tablefill_internals_engine:
             fillh  = "'template' file"
             imtags = "WARNING: These tags were in %s but not in %s: " % fillt
             imhead = "WARNING: Lines in %s matching '#(#|d+,*)#'" % fillh
-            imend  = linesep + pre if self.filetype == 'tex' else '; '
-            imend += "Output '%s' may not compile!" % self.output
+            if self.query is None:
+                imend  = linesep + pre if self.filetype == 'tex' else '; '
+                imend += "Output '%s' may not compile!" % self.get_shown_path(self.output)
+            else:
+                imend  = ''
 
         if self.warnings['nomatch'] != '':
             self.warn_msg['nomatch']  = imtags
@@ -1557,28 +4896,226 @@ class tablefill_internals_engine:
             self.warn_msg['toolong'] += " ran out of entries: "
             self.warn_msg['toolong'] += self.warnings['toolong'] + imend
 
-        msg  = ["This file was produced by 'tablefill.py'"]
-        msg += ["\tTemplate file: %s" % self.template]
-        msg += ["\tInput file(s): %s" % self.input]
-        msg += ["To make changes, edit the input and template files."]
-        msg += [pre + after]
-
-        if self.warning:
-            msg += ["THERE WAS AN ISSUE CREATING THIS FILE!"]
-            msg += [s for s in self.warn_msg.values()]
+    def write_to_output(self, text):
+        hooks = self.hooks.get('write')
+        if hooks:
+            info = {'output': self.output}
+            run_hooks(hooks, 'start', 'write', info)
+
+        if self.output == '-' and self.binary and hasattr(self.outstream, 'buffer'):
+            text = ''.join(text).encode('latin-1')
+            self.outstream.flush()
+            self.outstream.buffer.write(text)
+            self.outstream.buffer.flush()
+            self.bytes_written = len(text)
+        elif self.output == '-':
+            self.outstream.writelines(text)
+            self.outstream.flush()
+            self.bytes_written = len(''.join(text).encode('utf-8'))
         else:
-            msg += ["DO NOT EDIT THIS FILE DIRECTLY."]
+            if self.binary:
+                outfile = open_latin1(self.output, 'w')
+            else:
+                outfile = open(self.output, 'w')
+            outfile.write(''.join(text))
+            outfile.close()
+            self.bytes_written = path.getsize(self.output)
 
-        if self.nohead:
+        if hooks:
+            info['bytes'] = self.bytes_written
+            run_hooks(hooks, 'end', 'write', info)
+
+    def get_file_bytes(self):
+        """
+        Size on disk of the template and the input files (shards
+        expanded), each counted once. This is not what was read: stdin
+        and table stores are not counted.
+        """
+        files  = [getattr(self, 'template', '-')]
+        files += tolist(getattr(self, 'input', []))
+        files += tolist(self.xml_tables or [])
+        files  = set(path.realpath(f) for f in files if f != '-' and path.isfile(f))
+        return sum(path.getsize(f) for f in files)
+
+    def get_sidecar_name(self):
+        return self.output + '.tablefill'
+
+    def get_sidecar_key(self):
+        """
+        Hash of everything besides the tags that goes into the output:
+        the template and its fill plan, the inputs and output (named in
+        the header), and the formatting and missing-value options.
+        """
+        options = [fill_sidecar_version,
+                   __version__,
+                   self.get_fill_plan().key,
+                   self.filetype,
+                   self.template,
+                   self.input,
+                   self.store,
+                   self.output,
+                   self.pvals,
+                   self.stars,
+                   self.fillc,
+                   self.nohead,
+                   self.deterministic,
+                   self.root,
+                   self.missing.get_key()]
+
+        digest = hashlib.sha1()
+        digest.update(json.dumps(options, default = str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_template_tags(self):
+        """
+        Tags the fill plan uses: table labels (which tablefill:matrix
+        lines fill from) and the tags of addressed placeholders
+        """
+        plan  = self.get_fill_plan()
+        tags  = set(tag for tag in plan.begin.values() if tag != '')
+        tags |= set(spec[0] for (commented, literals, slots) in plan.lines.values()
+                    for (kind, cell, spec) in slots if kind == 'a')
+        return tags
+
+    def get_tag_digests(self):
+        """
+        Hash of the entries of each tag the template uses, as a table
+        label or in addressed placeholders (None if the tag is not in
+        the inputs). The rows are hashed as read, with their shape and
+        missing entries, since matrices and addresses depend on both.
+        """
+        digests = {}
+        for tag in self.get_template_tags():
+            if tag not in self.tables:
+                digests[tag] = None
+            else:
+                entries = json.dumps(self.matrices[tag], default = str)
+                digests[tag] = hashlib.sha1(entries.encode('utf-8')).hexdigest()
+
+        return digests
+
+    def write_sidecar(self):
+        """
+        Save what an incremental fill needs to patch the output: hashes
+        of the tags, the lines spanned by each filled table, where the
+        header is, the warnings, and a hash of the output itself.
+        """
+        if self.output == '-':
             return
 
-        msg = [pre + m + after for m in msg]
-        self.filled_template[n:n] = head + msg + tail
+        text    = ''.join(self.filled_template)
+        sidecar = {'version':  fill_sidecar_version,
+                   'key':      self.get_sidecar_key(),
+                   'output':   hashlib.sha1(text.encode('utf-8')).hexdigest(),
+                   'lines':    text.count('\n'),
+                   'head':     self.head,
+                   'tags':     self.get_tag_digests(),
+                   'regions':  self.regions,
+                   'warnings': self.warning_lists}
 
-    def write_to_output(self, text):
-        outfile = open(self.output, 'w')
-        outfile.write(''.join(text))
-        outfile.close()
+        fname = self.get_sidecar_name()
+        fh, tmp = mkstemp_for(fname)
+        with fdopen(fh, 'w') as out:
+            json.dump(sidecar, out)
+
+        rename(tmp, fname)
+
+    def read_sidecar(self):
+        """
+        Sidecar of the last incremental fill, if it is still valid for
+        the template, options, and the output as it is now; else None
+        """
+        fname = self.get_sidecar_name()
+        if self.output == '-' or not path.isfile(fname):
+            return None
+
+        try:
+            with open(fname, 'r') as fh:
+                sidecar = json.load(fh)
+
+            if sidecar['version'] != fill_sidecar_version:
+                return None
+            elif sidecar['key'] != self.get_sidecar_key():
+                return None
+
+            with open_text(self.output) as fh:
+                sidecar['text'] = fh.readlines()
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+        text = ''.join(sidecar['text']).encode('utf-8')
+        if hashlib.sha1(text).hexdigest() != sidecar['output']:
+            return None
+
+        return sidecar
+
+    def get_patched_output(self):
+        """
+        Refill only the tables whose tags changed since the last
+        incremental fill and patch them into the existing output. Does
+        nothing and returns False if a full fill is needed: there is no
+        valid sidecar, a tag was added or removed, a changed tag has a
+        table that could not be located, or the warnings (and hence
+        the header) would change.
+        """
+        sidecar = self.read_sidecar()
+        if sidecar is None:
+            self.logger.debug("No incremental fill to patch. Filling all tables...")
+            return False
+        elif self.get_fill_plan().matrices:
+            self.logger.debug("Matrices change the number of lines. Filling all tables...")
+            return False
+        elif self.get_fill_plan().addressed:
+            self.logger.debug("Addressed placeholders can quote any tag. Filling all tables...")
+            return False
+
+        tags = self.get_tag_digests()
+        prev = sidecar['tags']
+        if sorted(tags) != sorted(prev):
+            return False
+        elif any((tags[tag] is None) != (prev[tag] is None) for tag in tags):
+            return False
+
+        changed = set(tag for tag in tags if tags[tag] != prev[tag])
+        regions = [r for r in sidecar['regions'] if r[2] in changed]
+        if set(r[2] for r in regions) != changed:
+            return False
+        elif changed and self.deterministic and not self.nohead:
+            self.logger.debug("The fingerprint in the header changed. Filling all tables...")
+            return False
+
+        if len(changed) > 0:
+            self.get_filled_template(changed)
+
+        # Only placeholders in the refilled tables can give new warnings
+        warnings = sidecar['warnings']
+        inside   = lambda n: any(b <= int(n) <= e for (b, e, tag) in regions)
+        toolong  = [n for n in warnings['toolong'] if not inside(n)]
+        toolong += self.warnings['toolong']
+        if sorted(toolong, key = int) != sorted(warnings['toolong'], key = int):
+            self.logger.debug("Refilled tables change the warnings. Filling all tables...")
+            self.warnings = OrderedDict((k, []) for k in self.warnings)
+            return False
+
+        output = sidecar['text']
+        head_at, head_lines = sidecar['head']
+        for (b, e, tag) in regions:
+            shift = head_lines if b >= head_at else 0
+            output[(b + shift):(e + shift + 1)] = self.filled_template[b:(e + 1)]
+
+        self.warnings = OrderedDict((k, list(warnings[k])) for k in self.warnings)
+        self.get_warning_messages()
+        self.filled_template = output
+        self.head    = sidecar['head']
+        self.regions = sidecar['regions']
+        if len(changed) > 0:
+            logmsg = "Patching tables for tags %s into output file '%s'"
+            self.logger.debug(logmsg, ', '.join(sorted(changed)), self.output)
+            self.write_to_output(self.filled_template)
+        else:
+            self.logger.debug("Output file '%s' is up to date", self.output)
+
+        return True
 
     def get_exit_message(self):
         if self.warning:
@@ -1586,6 +5123,10 @@ class tablefill_internals_engine:
             msg += list(filter(lambda wm: wm != '', self.warn_msg.values()))
             self.exit_msg = linesep.join(msg)
             self.exit     = 'WARNING'
+        elif self.query is not None:
+            msg  = "All tables in '%s' have tags with enough entries"
+            self.exit_msg = msg % self.template + linesep
+            self.exit     = 'SUCCESS'
         else:
             msg  = "All tags in '%s' successfully filled by 'tablefill.py'"
             msg += linesep + "Output can be found in '%s'" + linesep
@@ -1593,22 +5134,6 @@ class tablefill_internals_engine:
             self.exit     = 'SUCCESS'
 
 
-class Logger(object):
-    def __init__(self, log_file, log_only):
-        self.log_only = log_only
-        if not self.log_only:
-            self.terminal = sys.stdout
-        self.log = open(log_file, "w")
-
-    def write(self, message):
-        if not self.log_only:
-            self.terminal.write(message)
-        self.log.write(message)
-
-    def flush(self):
-        pass
-
-
 # ---------------------------------------------------------------------
 # Run the function
 
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+# ---------------------------------------------------------------------
+# Overhead of instrumentation hooks on the fill hot path
+#
+# Writes a template with many tables and fills it with no hooks, with
+# a hook on a stage the hot path does not reach ('xml'), and with no-op
+# hooks on every stage. The cases take turns and each is the best of
+# several runs. Fails if a hook on an unrelated stage is slower than no
+# hooks by more than 'tolerance' percent. Run from the test folder:
+#
+#     python benchmark_hooks.py [tables] [runs] [tolerance]
+
+from __future__ import division, print_function
+from time import time
+import tempfile
+import shutil
+import os
+import sys
+sys.path.append('../tablefill/')
+from tablefill import tablefill, register_hook, remove_hook, hook_stages
+
+
+def write_files(tmpdir, ntables, nlines = 10):
+    template = os.path.join(tmpdir, 'template.tex')
+    tables   = os.path.join(tmpdir, 'tables.txt')
+    entries  = '\t'.join(['0.123456', '-12.5', '.', '3.2e-4', '1000']) + '\n'
+    with open(template, 'w') as fh, open(tables, 'w') as th:
+        for t in range(ntables):
+            fh.write('\\begin{table}\n\\label{tab:table_%d}\n' % t)
+            fh.write('### & #2# & #1# & #*# & #0,# \\\\\n' * nlines)
+            fh.write('\\end{table}\n')
+            th.write('<tab:table_%d>\n' % t)
+            th.write(entries * nlines)
+
+    return template, tables
+
+
+def noop(event, stage, info):
+    pass
+
+
+def benchmark(ntables = 2000, runs = 5, tolerance = 10):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        template, tables = write_files(tmpdir, ntables)
+        output = os.path.join(tmpdir, 'filled.tex')
+        cases  = [('disabled', []),
+                  ('unrelated', ['xml']),
+                  ('no-op', hook_stages)]
+        best   = dict((name, None) for (name, stages) in cases)
+        for r in range(runs):
+            for name, stages in cases:
+                for stage in stages:
+                    register_hook(stage, noop)
+
+                try:
+                    start = time()
+                    tablefill(template = template,
+                              input    = tables,
+                              output   = output,
+                              silent   = True)
+                    elapsed = time() - start
+                finally:
+                    for stage in stages:
+                        remove_hook(stage, noop)
+
+                if best[name] is None or elapsed < best[name]:
+                    best[name] = elapsed
+    finally:
+        shutil.rmtree(tmpdir)
+
+    overhead = dict((name, 100 * (best[name] / best['disabled'] - 1))
+                    for (name, stages) in cases)
+    for name, stages in cases:
+        print('%-10s %8.3fs (%+6.1f%% vs disabled)'
+              % (name, best[name], overhead[name]))
+
+    assert overhead['unrelated'] <= tolerance, \
+        'unrelated hook costs %.1f%% (tolerance %g%%)' \
+        % (overhead['unrelated'], tolerance)
+
+
+if __name__ == '__main__':
+    benchmark(*[float(a) if i == 2 else int(a)
+                for (i, a) in enumerate(sys.argv[1:])])
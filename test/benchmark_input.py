@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+# ---------------------------------------------------------------------
+# Input parsing throughput for tablefill
+#
+# Writes ~1M rows of tagged tables split across several files and
+# times the streaming readers, alone and with the files parsed in one
+# process per CPU, against the old concatenate-then-regex parser. The
+# streaming readers are timed with the garbage collector paused as
+# well (gc_paused). Run from the test folder:
+#
+#     python benchmark_input.py [rows] [files]
+
+from __future__ import division, print_function
+from time import time
+from multiprocessing import cpu_count
+import tempfile
+import shutil
+import os
+import re
+import sys
+sys.path.append('../tablefill/')
+from tablefill import parse_tables, gc_paused
+
+
+def legacy_parse(flist):
+    readlist = [open(fn, 'r', newline = None).readlines() for fn in flist]
+    tags     = '^<Tab:(.+)>[\r\n' + os.linesep + ']'
+    ctables  = {}
+    for row in sum(readlist, []):
+        if re.match(tags, row, flags = re.IGNORECASE):
+            tag = re.findall(tags, row, flags = re.IGNORECASE)
+            tag = tag[0].lower()
+            ctables[tag] = []
+        else:
+            clean_row_entries = [e.strip() for e in row.split('\t')]
+            ctables[tag] += [clean_row_entries]
+
+    return ctables
+
+
+def write_inputs(tmpdir, nrows, nfiles, rows_per_tag = 100):
+    flist = []
+    line  = '\t'.join(['0.123456', '-12.5', '.', '3.2e-4', '1000']) + '\n'
+    for f in range(nfiles):
+        fname = os.path.join(tmpdir, 'tables%d.txt' % f)
+        with open(fname, 'w') as fh:
+            for t in range(nrows // nfiles // rows_per_tag):
+                fh.write('<Tab:table_%d_%d>\n' % (f, t))
+                fh.write(line * rows_per_tag)
+
+        flist += [fname]
+
+    return flist
+
+
+def benchmark(nrows = 1000000, nfiles = 20):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        flist = write_inputs(tmpdir, nrows, nfiles)
+        parallel = lambda flist: parse_tables(flist, jobs = cpu_count())
+        for name, parse, paused in [('legacy', legacy_parse, False),
+                                    ('streaming', parse_tables, False),
+                                    ('gc paused', parse_tables, True),
+                                    ('parallel', parallel, False),
+                                    ('parallel, gc paused', parallel, True)]:
+            start = time()
+            if paused:
+                with gc_paused():
+                    ctables = parse(flist)
+            else:
+                ctables = parse(flist)
+
+            elapsed = time() - start
+            rows    = sum(len(v) for v in ctables.values())
+            print('%-20s %8d rows in %6.2fs (%10.0f rows/s)'
+                  % (name, rows, elapsed, rows / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    benchmark(*[int(a) for a in sys.argv[1:]])
@@ -3,13 +3,27 @@
 # Tests for tablefill
 # TODO(mauricio): Implement error codes in CLI version
 
-from subprocess import call
+from subprocess import call, check_output
+import threading
+import time
+import tempfile
+import logging
 import unittest
+import shutil
+import json
+import re
 import os
 import sys
 sys.path.append('../tablefill/')
 from nostderrout import nostderrout
-from tablefill import tablefill
+from tablefill import tablefill, tablefill_store, compile_outputs
+from tablefill import tablefill_missing, fill_plans, tablefill_many
+from tablefill import register_placeholder, tablefill_placeholders
+from tablefill import tablefill_project, tablefill_metrics
+from tablefill import register_hook, remove_hook, xml_grace
+if sys.version_info >= (3, 5):
+    from afill import afill, afill_many
+    import asyncio
 program = '../tablefill/tablefill.py --silent'
 
 
@@ -20,6 +34,8 @@ class testTableFillFunction(unittest.TestCase):
         self.input_nolabel  = 'input/tables_appendix.txt input/tables_nolabel.txt'
         self.input_fakeone  = 'input/fake_file.txt input/tables_appendix_two.txt'
         self.input_faketwo  = 'input/tables_appendix.txt input/fake_file.txt'
+        self.input_readers  = 'input/tables_appendix.csv input/tables_appendix_two.jsonl'
+        self.input_dta      = 'input/tables_appendix.dta input/tables_appendix_two.txt'
 
         self.texoutput      = './input/tablefill_template_filled.tex'
         self.lyxoutput      = './input/tablefill_template_filled.lyx'
@@ -230,6 +246,1239 @@ class testTableFillFunction(unittest.TestCase):
         self.assertEqual(texfilled_data_args1, texfilled_data_args2)
         self.assertEqual(lyxfilled_data_args1, lyxfilled_data_args2)
 
+    def testInputReaders(self):
+        self.getFileNames()
+
+        with nostderrout():
+            statustxt, msgtxt = tablefill(input    = self.input_appendix,
+                                          template = self.textemplate,
+                                          output   = self.texoutput,
+                                          nohead   = True)
+            filled_txt = open(self.texoutput, 'r').readlines()
+            statusmix, msgmix = tablefill(input    = self.input_readers,
+                                          template = self.textemplate,
+                                          output   = self.texoutput,
+                                          nohead   = True)
+            filled_mix = open(self.texoutput, 'r').readlines()
+
+            statusdta, msgdta = tablefill(input    = self.input_dta,
+                                          template = self.textemplate,
+                                          output   = self.texoutput,
+                                          nohead   = True)
+            filled_dta = open(self.texoutput, 'r').readlines()
+
+        self.assertEqual('SUCCESS', statustxt)
+        self.assertEqual('SUCCESS', statusmix)
+        self.assertEqual('SUCCESS', statusdta)
+        self.assertEqual(filled_txt, filled_mix)
+        self.assertEqual(filled_txt, filled_dta)
+
+        # Unknown forced formats are an error
+        with nostderrout():
+            errortex, msgtex = tablefill(input        = self.input_readers,
+                                         template     = self.textemplate,
+                                         output       = self.texoutput,
+                                         input_format = 'waffles')
+
+        self.assertEqual('ERROR', errortex)
+        self.assertIn('KeyError', msgtex)
+
+    def testTableStore(self):
+        self.getFileNames()
+        tmpdir = tempfile.mkdtemp()
+        dbfile = os.path.join(tmpdir, 'tables?#%.db')
+
+        with tablefill_store(dbfile) as store:
+            first  = store.ingest(self.input_appendix.split())
+            second = store.ingest(self.input_appendix.split())
+
+        self.assertEqual(2, len(first))
+        self.assertEqual([], second)
+
+        # Only the tags asked for, read-only from any path
+        with tablefill_store(dbfile, readonly = True) as store:
+            tables = store.get_tables(['diversity', 'panel_supply', 'nope'])
+
+        self.assertEqual(['diversity', 'panel_supply'], sorted(tables))
+        self.assertTrue(all(len(rows) > 1 for rows in tables.values()))
+
+        with nostderrout():
+            statustxt, msgtxt = tablefill(input    = self.input_appendix,
+                                          template = self.textemplate,
+                                          output   = self.texoutput,
+                                          nohead   = True)
+            filled_txt = open(self.texoutput, 'r').readlines()
+            statusdb, msgdb = tablefill(input    = '',
+                                        template = self.textemplate,
+                                        output   = self.texoutput,
+                                        store    = dbfile,
+                                        nohead   = True)
+            filled_db = open(self.texoutput, 'r').readlines()
+
+        self.assertEqual('SUCCESS', statustxt)
+        self.assertEqual('SUCCESS', statusdb)
+        self.assertEqual(filled_txt, filled_db)
+
+        # Addressed placeholders and names in custom XML tables are
+        # read from the store too, with or without a labelled table
+        tables   = os.path.join(tmpdir, 'extra.txt')
+        template = os.path.join(tmpdir, 'extra.tex')
+        empty    = os.path.join(tmpdir, 'empty.tex')
+        with open(tables, 'w') as fh:
+            fh.write('<tab:t>\n1\t2\n<tab:u>\n3\n')
+        with open(template, 'w') as fh:
+            fh.write("% <tablefill-python tag = 'v'>\n"
+                     "%     u[0]\n"
+                     "% </tablefill-python>\n"
+                     "Value: #tab:t[1,2]#, #tab:v[1,1]#.\n")
+        open(empty, 'w').close()
+        with tablefill_store(dbfile) as store:
+            store.ingest([tables])
+
+        statuses, filled = [], []
+        for xml_tables in [None, empty]:
+            with nostderrout():
+                status, msg = tablefill(input      = '',
+                                        template   = template,
+                                        output     = self.texoutput,
+                                        store      = dbfile,
+                                        xml_tables = xml_tables,
+                                        nohead     = True)
+            statuses.append(status)
+            filled.append(open(self.texoutput, 'r').read().split('\n')[3])
+
+        shutil.rmtree(tmpdir)
+        self.assertEqual(['SUCCESS', 'WARNING'], statuses)
+        self.assertEqual(['Value: 2, 3.', 'Value: 2, #tab:v[1,1]#.'], filled)
+
+    def testCompile(self):
+        tmpdir  = tempfile.mkdtemp()
+        outputs = [os.path.join(tmpdir, 'a.tex'), os.path.join(tmpdir, 'b.tex')]
+        for output in outputs:
+            open(output, 'w').write('\\cite{x}' + os.linesep)
+
+        # Stand-ins for LaTeX and bibtex that log each run
+        fakelatex = [sys.executable, '-c',
+                     'import sys; b = sys.argv[1][:-4];'
+                     'open(b + ".runs", "a").write("latex ");'
+                     'open(b + ".aux", "w").write("\\\\citation{x}\\n")']
+        fakebibtex = [sys.executable, '-c',
+                      'import sys; b = sys.argv[1];'
+                      'open(b + ".runs", "a").write("bibtex ");'
+                      'open(b + ".bbl", "w").write("x")']
+        sleeper = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+        compiled = compile_outputs(outputs, 'tex',
+                                   bibtex = True,
+                                   compiler = fakelatex,
+                                   bibtex_program = fakebibtex)
+        self.assertEqual(outputs, [c[0] for c in compiled])
+        self.assertEqual(['SUCCESS', 'SUCCESS'], [c[1] for c in compiled])
+        runs = open(os.path.join(tmpdir, 'a.runs')).read().split()
+        self.assertEqual(['latex', 'bibtex', 'latex'], runs)
+
+        # Nothing changed, so a single LaTeX run
+        compiled = compile_outputs(outputs[:1], 'tex',
+                                   bibtex = True,
+                                   compiler = fakelatex,
+                                   bibtex_program = fakebibtex)
+        runs = open(os.path.join(tmpdir, 'a.runs')).read().split()
+        self.assertEqual(['latex', 'bibtex', 'latex', 'latex'], runs)
+
+        # An .aux that never settles is a warning after maxruns
+        unsettled = [sys.executable, '-c',
+                     'import sys; b = sys.argv[1][:-4];'
+                     'open(b + ".aux", "a").write("x")']
+        compiled  = compile_outputs(outputs[:1], 'tex',
+                                    maxruns  = 2,
+                                    compiler = unsettled)
+        self.assertEqual('WARNING', compiled[0][1])
+        self.assertIn('2 run(s)', compiled[0][2])
+
+        compiled = compile_outputs(outputs, 'tex',
+                                   timeout = 0.5,
+                                   compiler = sleeper)
+        self.assertEqual(['TIMEOUT', 'TIMEOUT'], [c[1] for c in compiled])
+        shutil.rmtree(tmpdir)
+
+    def testMissingPolicy(self):
+        entries = ['1', '.', '.b', '.ab', 'NA', '-Inf', '+infinity', 'Info',
+                   'nan', '-NaN', 'nana', '---', '', '2']
+
+        missing = tablefill_missing()
+        self.assertEqual(['1', '.b', '.ab', '-Inf', '+infinity', 'Info',
+                          '-NaN', 'nana', '---', '2'],
+                         missing.filter(entries))
+
+        missing = tablefill_missing(['NA'],
+                                    regexes = ['-+'],
+                                    special = ['nan', 'inf', 'stata'])
+        self.assertEqual(['1', '.ab', 'Info', 'nana', '', '2'],
+                         missing.filter(entries))
+        self.assertTrue(missing.is_missing('.z'))
+        self.assertFalse(missing.is_missing('-0.5'))
+
+        self.getFileNames()
+        with nostderrout():
+            errortex, msgtex = tablefill(input     = self.input_appendix,
+                                         template  = self.textemplate,
+                                         output    = self.texoutput,
+                                         naspecial = ['waffles'])
+
+        self.assertEqual('ERROR', errortex)
+        self.assertIn('KeyError', msgtex)
+
+    def testFillPlan(self):
+        self.getFileNames()
+        tmpdir = tempfile.mkdtemp()
+        filled = []
+        for plan_cache in [None, tmpdir, tmpdir]:
+            fill_plans.clear()
+            with nostderrout():
+                statustex, msgtex = tablefill(input      = self.input_appendix,
+                                              template   = self.textemplate,
+                                              output     = self.texoutput,
+                                              plan_cache = plan_cache,
+                                              nohead     = True)
+                statuslyx, msglyx = tablefill(input      = self.input_appendix,
+                                              template   = self.lyxtemplate,
+                                              output     = self.lyxoutput,
+                                              plan_cache = plan_cache,
+                                              nohead     = True)
+
+            self.assertEqual('SUCCESS', statustex)
+            self.assertEqual('SUCCESS', statuslyx)
+            filled += [open(self.texoutput, 'r').read() +
+                       open(self.lyxoutput, 'r').read()]
+
+        plans = os.listdir(tmpdir)
+        self.assertEqual(2, len(plans))
+
+        # A corrupt plan is compiled again
+        fill_plans.clear()
+        open(os.path.join(tmpdir, plans[0]), 'w').write('{')
+        open(os.path.join(tmpdir, plans[1]), 'w').write('{')
+        with nostderrout():
+            statustex, msgtex = tablefill(input      = self.input_appendix,
+                                          template   = self.textemplate,
+                                          output     = self.texoutput,
+                                          plan_cache = tmpdir,
+                                          nohead     = True)
+
+        shutil.rmtree(tmpdir)
+        self.assertEqual('SUCCESS', statustex)
+        self.assertEqual(filled[0], filled[1])
+        self.assertEqual(filled[0], filled[2])
+
+    def testQuery(self):
+        self.getFileNames()
+        tmpdir = tempfile.mkdtemp()
+        report = os.path.join(tmpdir, 'report.json')
+        with nostderrout():
+            statustex, msgtex = tablefill(input      = self.input_appendix,
+                                          template   = self.textemplate,
+                                          output     = report,
+                                          query      = [],
+                                          query_json = True)
+            query = json.load(open(report, 'r'))
+            statuswrong, msgwrong = tablefill(input    = self.input_appendix,
+                                              template = self.textemplatewrong,
+                                              output   = report,
+                                              query    = [])
+            statustag, msgtag = tablefill(input    = self.input_appendix,
+                                          template = self.textemplatewrong,
+                                          output   = report,
+                                          query    = ['diversity'])
+
+        shutil.rmtree(tmpdir)
+        self.assertEqual('SUCCESS', statustex)
+        self.assertEqual(['panel_supply', 'unobservables', 'diversity'],
+                         [t['label'] for t in query['tables']])
+        self.assertEqual([29, 20, 15],
+                         [t['placeholders'] for t in query['tables']])
+        self.assertTrue(all([t['ok'] for t in query['tables']]))
+        self.assertEqual('WARNING', statuswrong)
+        self.assertIn('not in a table environment', msgwrong)
+        self.assertEqual('SUCCESS', statustag)
+
+    def testFillMany(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        outputs  = [os.path.join(tmpdir, 'filled%d.tex' % i) for i in range(3)]
+        inputs   = [self.input_appendix, self.input_readers, self.input_nolabel]
+        variants = list(zip(inputs, outputs))
+        with nostderrout():
+            status, msg = tablefill(input    = self.input_appendix,
+                                    template = self.textemplate,
+                                    output   = self.texoutput,
+                                    nohead   = True)
+            filled = open(self.texoutput, 'r').read()
+            serial = tablefill_many(self.textemplate, variants, nohead = True)
+            serial_filled = [open(output, 'r').read() for output in outputs]
+            for output in outputs:
+                os.remove(output)
+
+            parallel = tablefill_many(self.textemplate, variants,
+                                      jobs   = 2,
+                                      nohead = True)
+            parallel_filled = [open(output, 'r').read() for output in outputs]
+
+        shutil.rmtree(tmpdir)
+        self.assertEqual(outputs, [f[0] for f in serial])
+        self.assertEqual(['SUCCESS', 'SUCCESS', 'WARNING'],
+                         [f[1] for f in serial])
+        self.assertEqual([f[:2] for f in serial], [f[:2] for f in parallel])
+        self.assertEqual(serial_filled, parallel_filled)
+        self.assertEqual([filled, filled], serial_filled[:2])
+
+    def testThreads(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        stdout   = sys.stdout
+        results  = {}
+        template = [self.textemplate, self.lyxtemplate]
+
+        def fill(i):
+            output = os.path.join(tmpdir, 'filled%d' % i)
+            log    = os.path.join(tmpdir, 'filled%d.log' % i)
+            status, msg = tablefill(input    = self.input_appendix,
+                                    template = template[i % 2],
+                                    output   = output,
+                                    filetype = template[i % 2][-3:],
+                                    log_file = log,
+                                    log_only = True,
+                                    verbose  = True,
+                                    nohead   = True)
+            results[i] = status, open(output, 'r').read(), open(log, 'r').read()
+
+        threads = [threading.Thread(target = fill, args = (i,)) for i in range(16)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        shutil.rmtree(tmpdir)
+        self.assertIs(stdout, sys.stdout)
+        self.assertEqual(['SUCCESS'] * 16, [results[i][0] for i in range(16)])
+        for i in range(16):
+            self.assertEqual(results[i % 2][1], results[i][1])
+
+            # Each log has the messages of its own fill only
+            log = results[i][2]
+            self.assertEqual(1, log.count('Output can be found'))
+            self.assertIn("filled%d'" % i, log)
+            self.assertIn(template[i % 2], log)
+
+    def testLogging(self):
+        self.getFileNames()
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger('tablefill').addHandler(handler)
+        try:
+            for verbose, silent in [(True, False), (False, False), (True, True)]:
+                del records[:]
+                with nostderrout():
+                    status, msg = tablefill(input    = self.input_appendix,
+                                            template = self.textemplate,
+                                            output   = self.texoutput,
+                                            verbose  = verbose,
+                                            silent   = silent)
+
+                self.assertEqual('SUCCESS', status)
+                levels = set(r.levelno for r in records)
+                if silent:
+                    self.assertEqual(set(), levels)
+                elif verbose:
+                    self.assertIn(logging.DEBUG, levels)
+                    self.assertIn(logging.INFO, levels)
+                else:
+                    self.assertEqual(set([logging.INFO]), levels)
+        finally:
+            logging.getLogger('tablefill').removeHandler(handler)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio API needs python 3.5+")
+    def testAsync(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        outputs  = [os.path.join(tmpdir, 'filled%d.tex' % i) for i in range(4)]
+        inputs   = [self.input_appendix, self.input_readers,
+                    self.input_nolabel, self.input_appendix]
+        variants = list(zip(inputs, outputs))
+        loop     = asyncio.new_event_loop()
+        try:
+            with nostderrout():
+                single = loop.run_until_complete(afill(self.textemplate,
+                                                       self.input_appendix,
+                                                       self.texoutput,
+                                                       nohead = True))
+                filled  = open(self.texoutput, 'r').read()
+                results = loop.run_until_complete(afill_many(self.textemplate,
+                                                             variants,
+                                                             jobs   = 2,
+                                                             nohead = True))
+                async_filled = [open(output, 'r').read() for output in outputs]
+                for output in outputs:
+                    os.remove(output)
+
+                # Cancelled before it starts, nothing is filled
+                task = loop.create_task(afill_many(self.textemplate, variants))
+                task.cancel()
+                self.assertRaises(asyncio.CancelledError,
+                                  loop.run_until_complete, task)
+                self.assertFalse(any(os.path.exists(o) for o in outputs))
+        finally:
+            loop.close()
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual((self.texoutput, 'SUCCESS'), (single.output, single.exit))
+        self.assertEqual(outputs, [r.output for r in results])
+        self.assertEqual(['SUCCESS', 'SUCCESS', 'WARNING', 'SUCCESS'],
+                         [r.exit for r in results])
+        self.assertEqual([filled] * 2, async_filled[:2])
+        self.assertEqual(filled, async_filled[3])
+
+    def testStataDates(self):
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'dates.tex')
+        tables   = os.path.join(tmpdir, 'dates.txt')
+        output   = os.path.join(tmpdir, 'dates_filled.tex')
+        with open(template, 'w') as fh:
+            fh.write('\\begin{table}\n\\label{tab:dates}\n'
+                     '#{:\\%Y-\\%m-\\%d}date# & #{:\\%H:\\%M:\\%S.\\%f}tc# & '
+                     '#{:\\%Y-\\%m-\\%d}tw# & #{:\\%Y-\\%m}tm# & '
+                     '#{:\\%Y-\\%m}tq# & #{:\\%Y-\\%m}th# \\\\\n'
+                     '#{:\\%Y-\\%m-\\%d}td# & #{:\\%H:\\%M:\\%S}time# & '
+                     '#{:\\%Y-\\%m-\\%d}date# \\\\\n'
+                     '\\end{table}\n')
+
+        with open(tables, 'w') as fh:
+            fh.write('<tab:dates>\n' + '\t'.join(['21915', '1893456000123',
+                                                  '3121', '725', '241', '120',
+                                                  '0', '3661', '21915']) + '\n')
+
+        with nostderrout():
+            status, msg = tablefill(input    = tables,
+                                    template = template,
+                                    output   = output,
+                                    nohead   = True)
+
+        filled = open(output, 'r').read().split('\n')
+        shutil.rmtree(tmpdir)
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual('2020-01-01 & 00:00:00.123000 & 2020-01-08 & '
+                         '2020-06 & 2020-04 & 2020-01 \\\\', filled[2])
+        self.assertEqual('1960-01-01 & 01:01:01 & 2020-01-01 \\\\', filled[3])
+
+    def testCustomPlaceholder(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'custom.tex')
+        tables   = os.path.join(tmpdir, 'custom.txt')
+        output   = os.path.join(tmpdir, 'custom_filled.tex')
+        with open(template, 'w') as fh:
+            fh.write('\\begin{table}\n\\label{tab:custom}\n'
+                     '#@1# & #@0# & #2# & #*# \\\\\n'
+                     '#@1# & #@2# \\\\\n'
+                     '\\end{table}\n')
+
+        with open(tables, 'w') as fh:
+            fh.write('<tab:custom>\n1234.5\t98765\t0.123\n0.02\t-2500\t1\n')
+
+        calls = []
+
+        def thousands(digits):
+            calls.append(digits)
+            return lambda entry: '%.*fk' % (int(digits), float(entry) / 1000)
+
+        register_placeholder('thousands', r'#@(\d+)#', thousands)
+        try:
+            with nostderrout():
+                status, msg = tablefill(input    = tables,
+                                        template = template,
+                                        output   = output,
+                                        nohead   = True)
+        finally:
+            del tablefill_placeholders['thousands']
+
+        filled = open(output, 'r').read().split('\n')
+        shutil.rmtree(tmpdir)
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual('1.2k & 99k & 0.12 & ** \\\\', filled[2])
+        self.assertEqual('-2.5k & 0.00k \\\\', filled[3])
+
+        # Each distinct placeholder is compiled once
+        self.assertEqual(['1', '0', '2'], calls)
+
+    def testIncremental(self):
+        self.getFileNames()
+        tmpdir = tempfile.mkdtemp()
+        tables = [os.path.join(tmpdir, 'tables_appendix.txt'),
+                  os.path.join(tmpdir, 'tables_appendix_two.txt')]
+        for fname in tables:
+            shutil.copy(os.path.join('input', os.path.basename(fname)), fname)
+
+        def fill(template, output, incremental = True):
+            log = os.path.join(tmpdir, 'fill.log')
+            status, msg = tablefill(input       = ' '.join(tables),
+                                    template    = template,
+                                    output      = output,
+                                    incremental = incremental,
+                                    log_file    = log,
+                                    log_only    = True,
+                                    verbose     = True)
+            self.assertEqual('SUCCESS', status)
+            return open(output, 'r').read(), open(log, 'r').read()
+
+        for template in [self.textemplate, self.lyxtemplate]:
+            output = os.path.join(tmpdir, 'filled' + template[-4:])
+            full   = os.path.join(tmpdir, 'full' + template[-4:])
+            fill(template, output)
+            self.assertTrue(os.path.isfile(output + '.tablefill'))
+
+            # Nothing changed
+            filled, log = fill(template, output)
+            self.assertIn('is up to date', log)
+
+            # One tag changed: only its tables are refilled
+            text = open(tables[0], 'r').read()
+            open(tables[0], 'w').write(text.replace('2000.1355', '3000.1355', 1))
+            filled, log = fill(template, output)
+            self.assertIn('Patching tables for tags panel_supply', log)
+            self.assertEqual(fill(template, full, False)[0], filled)
+            self.assertIn('3,000', filled)
+
+            # An edited output is filled again
+            open(output, 'w').write(filled.replace('3,000', 'edited'))
+            filled, log = fill(template, output)
+            self.assertNotIn('Patching', log)
+            self.assertEqual(fill(template, full, False)[0], filled)
+            open(tables[0], 'w').write(text)
+
+        # Other missing values are a full fill
+        template = os.path.join(tmpdir, 'missing.tex')
+        output   = os.path.join(tmpdir, 'missing_filled.tex')
+        tables   = [os.path.join(tmpdir, 'missing.txt')]
+        open(tables[0], 'w').write('<tab:t>\n1\t2\n')
+        with open(template, 'w') as fh:
+            fh.write('\\begin{table}\n\\label{tab:t}\n### & ### \\\\\n\\end{table}\n')
+
+        def fill_missing(nafilters):
+            with nostderrout():
+                tablefill(input       = tables[0],
+                          template    = template,
+                          output      = output,
+                          incremental = True,
+                          nohead      = True,
+                          nafilters   = nafilters)
+
+            return open(output, 'r').read()
+
+        self.assertIn('1 & 2 \\\\', fill_missing(['.']))
+        self.assertIn('2 & ### \\\\', fill_missing(['1']))
+        shutil.rmtree(tmpdir)
+
+    def testProject(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        project  = os.path.join(tmpdir, 'paper')
+        filled   = os.path.join(tmpdir, 'filled')
+        os.makedirs(os.path.join(project, 'sections'))
+        template = open(self.textemplate, 'r').read()
+        with open(os.path.join(project, 'master.tex'), 'w') as fh:
+            fh.write('\\input{sections/tables}\n'
+                     '% \\input{sections/commented}\n'
+                     '\\include{appendix.tex}\n'
+                     '\\input{sections/missing}\n'
+                     '\\input{figure.pgf}\n')
+
+        for name in ['sections/tables.tex', 'sections/commented.tex', 'figure.pgf']:
+            open(os.path.join(project, name), 'w').write(template)
+
+        with open(os.path.join(project, 'appendix.tex'), 'w') as fh:
+            fh.write('\\input{sections/tables}\n' + template)
+
+        with nostderrout():
+            status, msg = tablefill(input    = self.input_appendix,
+                                    template = self.textemplate,
+                                    output   = self.texoutput,
+                                    nohead   = True)
+            serial   = tablefill_project(os.path.join(project, 'master.tex'),
+                                         self.input_appendix,
+                                         filled,
+                                         nohead = True)
+            contents = [open(f[0], 'r').read() for f in serial]
+            parallel = tablefill_project(os.path.join(project, 'master.tex'),
+                                         self.input_appendix.split(),
+                                         filled,
+                                         jobs   = 2,
+                                         nohead = True)
+
+            # Inputs can be a folder of shards
+            shards = os.path.join(tmpdir, 'shards')
+            os.makedirs(shards)
+            for fname in self.input_appendix.split():
+                shutil.copy(fname, shards)
+
+            sharded = tablefill_project(os.path.join(project, 'master.tex'),
+                                        shards,
+                                        os.path.join(tmpdir, 'sharded'),
+                                        input_jobs = 2,
+                                        nohead     = True)
+            sharded = [open(f[0], 'r').read() for f in sharded]
+
+        expected = [os.path.join(filled, name) for name in
+                    ['master.tex', 'sections/tables.tex', 'appendix.tex']]
+        self.assertEqual(expected, [os.path.normpath(f[0]) for f in serial])
+        self.assertEqual(['SUCCESS'] * 3, [f[1] for f in serial])
+        self.assertEqual([f[:2] for f in serial], [f[:2] for f in parallel])
+        self.assertEqual(open(self.texoutput, 'r').read(), contents[1])
+        self.assertTrue(contents[2].endswith(contents[1]))
+        self.assertEqual(contents, sharded)
+
+        # Errors reading the tree are returned for the master
+        with open(os.path.join(project, 'outside.tex'), 'w') as fh:
+            fh.write('\\input{../elsewhere}\n')
+
+        open(os.path.join(tmpdir, 'elsewhere.tex'), 'w').write(template)
+        with nostderrout():
+            missing = tablefill_project(os.path.join(project, 'master.tex'),
+                                        os.path.join(tmpdir, 'missing.txt'),
+                                        filled)
+            outside = tablefill_project(os.path.join(project, 'outside.tex'),
+                                        self.input_appendix,
+                                        filled)
+
+        self.assertEqual([(os.path.join(filled, 'master.tex'), 'ERROR')],
+                         [f[:2] for f in missing])
+        self.assertEqual([(os.path.join(filled, 'outside.tex'), 'ERROR')],
+                         [f[:2] for f in outside])
+        self.assertIn('outside', outside[0][2])
+        shutil.rmtree(tmpdir)
+
+    def testBinary(self):
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'binary.tex')
+        tables   = os.path.join(tmpdir, 'binary.txt')
+        output   = os.path.join(tmpdir, 'binary_filled.tex')
+        with open(template, 'wb') as fh:
+            fh.write(b'% Caf\xe9\r\n\\begin{table}\r\n\\label{tab:binary}\r\n'
+                     b'\xe9t\xe9 & ### & #2# \\\\\r\n\\end{table}\r\n')
+
+        with open(tables, 'wb') as fh:
+            fh.write(b'<tab:binary>\n\xc3\xa9l\xc3\xa8ve\t3.14159\n')
+
+        with nostderrout():
+            status, msg = tablefill(input    = tables,
+                                    template = template,
+                                    output   = output,
+                                    binary   = True,
+                                    nohead   = True)
+
+        filled = open(output, 'rb').read()
+        shutil.rmtree(tmpdir)
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual(b'% Caf\xe9\r\n\\begin{table}\r\n\\label{tab:binary}\r\n'
+                         b'\xe9t\xe9 & \xc3\xa9l\xc3\xa8ve & 3.14 \\\\\r\n'
+                         b'\\end{table}\r\n', filled)
+
+    def testBinaryHeader(self):
+        tmpdir   = tempfile.mkdtemp()
+        folder   = os.path.join(tmpdir, b'd\xc3\xa9\xe2\x82\xac'.decode('utf-8'))
+        template = os.path.join(folder, 'binary.tex')
+        tables   = os.path.join(folder, 'binary.txt')
+        output   = os.path.join(folder, 'binary_filled.tex')
+        os.mkdir(folder)
+        with open(template, 'wb') as fh:
+            fh.write(b'% Caf\xe9\n\\begin{table}\n\\label{tab:binary}\n'
+                     b'### \\\\\n\\end{table}\n')
+
+        with open(tables, 'wb') as fh:
+            fh.write(b'<tab:binary>\n1\n')
+
+        # File names in the header are written with the file system's
+        # encoding; the template's bytes pass through as they are
+        with nostderrout():
+            status, msg = tablefill(input    = tables,
+                                    template = template,
+                                    output   = output,
+                                    binary   = True)
+
+        filled = open(output, 'rb').read()
+        shutil.rmtree(tmpdir)
+        encoding = sys.getfilesystemencoding()
+        self.assertEqual('SUCCESS', status)
+        self.assertIn(b'Template file: ' + template.encode(encoding), filled)
+        self.assertIn(b'% Caf\xe9\n', filled)
+
+    @unittest.skipIf(os.name == 'nt', "no POSIX permissions")
+    def testFilePermissions(self):
+        self.getFileNames()
+        tmpdir  = tempfile.mkdtemp()
+        output  = os.path.join(tmpdir, 'filled.tex')
+        metrics = os.path.join(tmpdir, 'tablefill.prom')
+        plans   = os.path.join(tmpdir, 'plans')
+
+        # Files written via a temporary file get the same permissions
+        # as the output, not mkstemp's 0600
+        fill_plans.clear()
+        mask = os.umask(0o027)
+        try:
+            with nostderrout():
+                status, msg = tablefill(input       = self.input_appendix,
+                                        template    = self.textemplate,
+                                        output      = output,
+                                        plan_cache  = plans,
+                                        metrics     = metrics,
+                                        incremental = True)
+        finally:
+            os.umask(mask)
+
+        files = [output, metrics, output + '.tablefill']
+        files += [os.path.join(plans, plan) for plan in os.listdir(plans)]
+        modes = [os.stat(f).st_mode & 0o777 for f in files]
+        shutil.rmtree(tmpdir)
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual(4 * [0o640], modes)
+
+    def testMetrics(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        metrics  = os.path.join(tmpdir, 'tablefill.prom')
+        outputs  = [os.path.join(tmpdir, 'filled%d.tex' % i) for i in range(3)]
+        variants = list(zip([self.input_appendix, self.input_nolabel, self.input_appendix],
+                            outputs))
+
+        def samples(text):
+            return dict(line.rsplit(' ', 1) for line in text.split('\n')
+                        if line != '' and not line.startswith('#'))
+
+        with nostderrout():
+            status, msg = tablefill(input    = self.input_appendix,
+                                    template = self.textemplate,
+                                    output   = self.texoutput,
+                                    metrics  = metrics)
+            single = samples(open(metrics, 'r').read())
+            tablefill_many(self.textemplate, variants, jobs = 2, metrics = metrics)
+            batch  = samples(open(metrics, 'r').read())
+
+            batch_metrics = tablefill_metrics()
+            tablefill_many(self.textemplate, variants, metrics = batch_metrics)
+            tablefill(input    = self.input_appendix,
+                      template = self.textemplate,
+                      output   = self.texoutput,
+                      metrics  = batch_metrics)
+
+        shutil.rmtree(tmpdir)
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual('1', single['tablefill_templates_total{status="SUCCESS"}'])
+        self.assertEqual('0', single['tablefill_templates_total{status="WARNING"}'])
+        self.assertEqual('0', single['tablefill_warnings_total{category="nomatch"}'])
+        self.assertTrue(int(single['tablefill_placeholders_total']) > 0)
+        self.assertEqual(sum(os.path.getsize(f) for f in
+                             [self.textemplate] + self.input_appendix.split()),
+                         int(single['tablefill_input_file_bytes_total']))
+        self.assertEqual(os.path.getsize(self.texoutput),
+                         int(single['tablefill_written_bytes_total']))
+        self.assertEqual('1', single['tablefill_phase_seconds_count{phase="total"}'])
+        self.assertEqual('1', single['tablefill_phase_seconds_bucket{phase="total",le="+Inf"}'])
+
+        self.assertEqual('2', batch['tablefill_templates_total{status="SUCCESS"}'])
+        self.assertEqual('1', batch['tablefill_templates_total{status="WARNING"}'])
+        self.assertEqual('1', batch['tablefill_warnings_total{category="nomatch"}'])
+        self.assertEqual('3', batch['tablefill_phase_seconds_count{phase="fill"}'])
+        self.assertEqual(int(batch['tablefill_placeholders_total']) +
+                         int(single['tablefill_placeholders_total']),
+                         batch_metrics.placeholders)
+        self.assertEqual(3, batch_metrics.templates['SUCCESS'])
+
+    def testHooks(self):
+        self.getFileNames()
+        tmpdir = tempfile.mkdtemp()
+        output = os.path.join(tmpdir, 'hooks_filled.tex')
+        events = []
+
+        def trace(event, stage, info):
+            events.append((event, stage, info.get('tag')))
+            if event == 'end' and stage in ['template', 'write']:
+                events.append(info.get('exit', info.get('bytes')))
+
+        for stage in ['template', 'parse', 'region', 'lines', 'write']:
+            register_hook(stage, trace)
+
+        try:
+            with nostderrout():
+                status, msg = tablefill(input    = self.input_appendix,
+                                        template = 'input/tablefill_template.tex',
+                                        output   = output)
+        finally:
+            for stage in ['template', 'parse', 'region', 'lines', 'write']:
+                remove_hook(stage, trace)
+
+        size = os.path.getsize(output)
+        shutil.rmtree(tmpdir)
+        self.assertEqual('SUCCESS', status)
+        self.assertEqual(('start', 'template', None), events[0])
+        self.assertEqual(('start', 'parse', None), events[1])
+        self.assertEqual(('end', 'parse', None), events[2])
+        self.assertEqual([('start', 'write', None), ('end', 'write', None), size,
+                          ('end', 'template', None), 'SUCCESS'], events[-5:])
+
+        # Every region and line span is closed, lines inside regions
+        regions = [e for e in events if isinstance(e, tuple) and e[1] == 'region']
+        lines   = [e for e in events if isinstance(e, tuple) and e[1] == 'lines']
+        self.assertTrue(len(regions) > 0 and len(lines) > len(regions))
+        self.assertEqual(regions[0::2], [('start',) + e[1:] for e in regions[1::2]])
+        self.assertEqual(lines[0::2], [('start',) + e[1:] for e in lines[1::2]])
+        self.assertRaises(KeyError, register_hook, 'nostage', trace)
+
+        # A table with no end is closed at the end of the template
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'open.tex')
+        output   = os.path.join(tmpdir, 'open_filled.tex')
+        closed   = []
+        with open(template, 'w') as fh:
+            fh.write('\\begin{table}\n\\label{tab:diversity}\n### & ### \\\\\n')
+
+        def region(event, stage, info):
+            closed.append((event, info.get('end', 'open'), info.get('entries')))
+
+        register_hook('region', region)
+        try:
+            with nostderrout():
+                status, msg = tablefill(input    = self.input_appendix,
+                                        template = template,
+                                        output   = output)
+        finally:
+            remove_hook('region', region)
+
+        shutil.rmtree(tmpdir)
+        self.assertEqual([('start', 'open', None), ('end', None, 2)], closed)
+
+    def testXmlSandbox(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'custom.tex')
+        tables   = os.path.join(tmpdir, 'custom.txt')
+        output   = os.path.join(tmpdir, 'custom_filled.tex')
+        with open(template, 'w') as fh:
+            fh.write("% <tablefill-python tag = 'ratio' type = 'float'>\n"
+                     "%     base[0][0] / base[1][0], base[1]\n"
+                     "% </tablefill-python>\n"
+                     "% <tablefill-python tag = 'again' type = 'float'>\n"
+                     "%     ratio[1][::-1]\n"
+                     "% </tablefill-python>\n"
+                     "% <tablefill-python tag = 'forever'>\n"
+                     "%     max(iter(lambda: 0, 1))\n"
+                     "% </tablefill-python>\n"
+                     "% <tablefill-python tag = 'huge'>\n"
+                     "%     [0.5] * 10 ** 10\n"
+                     "% </tablefill-python>\n")
+            for tag in ['ratio', 'again', 'forever', 'huge']:
+                fh.write('\\begin{table}\n\\label{tab:%s}\n'
+                         '#2# & #2# & #2# \\\\\n\\end{table}\n' % tag)
+
+        with open(tables, 'w') as fh:
+            fh.write('<tab:base>\n1\t2\t3\n4\t5\t6\n')
+
+        with nostderrout():
+            status, msg = tablefill(input       = tables,
+                                    template    = template,
+                                    output      = output,
+                                    nohead      = True,
+                                    xml_jobs    = 2,
+                                    xml_timeout = 1,
+                                    xml_memory  = 256)
+
+        filled = open(output, 'r').read().split('\n')
+        shutil.rmtree(tmpdir)
+        self.assertEqual('WARNING', status)
+        self.assertEqual('0.25 & 4.00 & 5.00 \\\\', filled[14])
+        self.assertEqual('6.00 & 5.00 & 4.00 \\\\', filled[18])
+
+        # The tables that ran out of time or memory are not filled
+        self.assertEqual('#2# & #2# & #2# \\\\', filled[22])
+        self.assertEqual('#2# & #2# & #2# \\\\', filled[26])
+
+    def testDeterministic(self):
+        self.getFileNames()
+        filled = []
+        for k in range(3):
+            tmpdir = tempfile.mkdtemp()
+            os.makedirs(os.path.join(tmpdir, 'tables'))
+            template = os.path.join(tmpdir, 'template.tex')
+            tables   = os.path.join(tmpdir, 'tables', 'tables.txt')
+            output   = os.path.join(tmpdir, 'filled.tex')
+            shutil.copy('input/tablefill_template.tex', template)
+            with open(tables, 'w') as fh:
+                text = open('input/tables_appendix.txt').read()
+                fh.write(text.replace('0.', '1.', 1) if k == 2 else text)
+
+            with nostderrout():
+                status, msg = tablefill(input         = tables,
+                                        template      = template,
+                                        output        = output,
+                                        deterministic = True)
+
+            filled += [open(output, 'r').read()]
+            shutil.rmtree(tmpdir)
+
+        # Same bytes from two folders; paths are relative to the template
+        self.assertEqual(filled[0], filled[1])
+        self.assertIn("Input file(s): ['tables/tables.txt']", filled[0])
+        self.assertNotIn(tempfile.gettempdir(), filled[0])
+
+        # Different tables, different fingerprint
+        fingerprint = [f.split('Fingerprint: ')[1].split()[0] for f in filled]
+        self.assertEqual(fingerprint[0], fingerprint[1])
+        self.assertNotEqual(fingerprint[0], fingerprint[2])
+
+    def testShards(self):
+        self.getFileNames()
+        tmpdir = tempfile.mkdtemp()
+        shards = os.path.join(tmpdir, 'shards')
+        output = os.path.join(tmpdir, 'shards_filled.tex')
+        os.makedirs(shards)
+        for fname in self.input_appendix.split():
+            shutil.copy(fname, shards)
+
+        # Shards are read by name: the last one wins a repeated tag
+        with open(os.path.join(shards, 'zz_override.txt'), 'w') as fh:
+            fh.write(open('input/tables_appendix_two.txt').read().replace('-0.', '-9.'))
+
+        filled = []
+        for input, jobs in [(self.input_appendix, None),
+                            (shards, None),
+                            (os.path.join(shards, 'tables_*.txt'), 2),
+                            (shards, 2)]:
+            with nostderrout():
+                status, msg = tablefill(input      = input,
+                                        template   = 'input/tablefill_template.tex',
+                                        output     = output,
+                                        nohead     = True,
+                                        input_jobs = jobs)
+
+            self.assertEqual('SUCCESS', status)
+            filled += [open(output, 'r').read()]
+
+        self.assertEqual(filled[0], filled[2])
+        self.assertEqual(filled[1], filled[3])
+        self.assertNotEqual(filled[0], filled[1])
+        self.assertNotIn('-9.', filled[0])
+        self.assertIn('-9.', filled[1])
+
+        with nostderrout():
+            status, msg = tablefill(input    = os.path.join(tmpdir, '*.csv'),
+                                    template = 'input/tablefill_template.tex',
+                                    output   = output)
+
+        shutil.rmtree(tmpdir)
+        self.assertEqual('ERROR', status)
+        self.assertIn('No input files', msg)
+
+    def testMatrix(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        tables   = os.path.join(tmpdir, 'matrix.txt')
+        with open(tables, 'w') as fh:
+            fh.write('<tab:matrix>\n1.234\t12345.6\tx\n2.5\t.\ty\t0.5\n')
+
+        filled = {}
+        for ext, directive in [('tex', '  % tablefill:matrix fmt=#1#,#0,#,###'),
+                               ('md', '<!-- tablefill:matrix fmt=#1#,### -->')]:
+            template = os.path.join(tmpdir, 'matrix.' + ext)
+            output   = os.path.join(tmpdir, 'matrix_filled.' + ext)
+            with open(template, 'w') as fh:
+                fh.write('<!-- tablefill:start tab:matrix -->\n' if ext == 'md'
+                         else '\\begin{table}\n\\label{tab:matrix}\n')
+                fh.write(directive + '\n')
+                fh.write('<!-- tablefill:end -->\n' if ext == 'md'
+                         else '\\end{table}\n')
+
+            with nostderrout():
+                status, msg = tablefill(input    = tables,
+                                        template = template,
+                                        output   = output,
+                                        nohead   = True)
+
+            self.assertEqual('SUCCESS', status)
+            filled[ext] = open(output, 'r').read().split('\n')
+
+        shutil.rmtree(tmpdir)
+
+        # One row per input row; missing entries are left blank
+        self.assertEqual('  % tablefill:matrix fmt=#1#,#0,#,###', filled['tex'][2])
+        self.assertEqual('  1.2 & 12,346 & x \\\\', filled['tex'][3])
+        self.assertEqual('  2.5 &  & y & 0.5 \\\\', filled['tex'][4])
+        self.assertEqual('\\end{table}', filled['tex'][5])
+        self.assertEqual('| 1.2 | 12345.6 | x |', filled['md'][2])
+        self.assertEqual('| 2.5 |  | y | 0.5 |', filled['md'][3])
+
+    def testAddressed(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        tables   = os.path.join(tmpdir, 'addressed.txt')
+        template = os.path.join(tmpdir, 'addressed.tex')
+        output   = os.path.join(tmpdir, 'addressed_filled.tex')
+        with open(tables, 'w') as fh:
+            fh.write('<tab:coef>\n1.2345\t.\t0.04\n3.14159\t12345.6\n')
+            fh.write('<tab:other>\n7\t8\n')
+
+        with open(template, 'w') as fh:
+            fh.write('We find #tab:coef[2,1]|2# (p = #tab:coef[1,3]#).\n')
+            fh.write('\\begin{table}\n\\label{tab:other}\n')
+            fh.write('### & #tab:coef[2,2]|0,# & ### & #tab:coef[1,2]|1# \\\\\n')
+            fh.write('\\end{table}\n')
+            fh.write('#tab:coef[3,1]# #tab:nope[1,1]# #tab:coef[1,3]|*#\n')
+
+        with nostderrout():
+            status, msg = tablefill(input    = tables,
+                                    template = template,
+                                    output   = output,
+                                    nohead   = True)
+
+        filled = open(output, 'r').read().split('\n')
+        shutil.rmtree(tmpdir)
+
+        # Addressed cells do not use up the entries of the table they
+        # are in and are filled outside of tables
+        self.assertEqual('WARNING', status)
+        self.assertEqual('We find 3.14 (p = 0.04).', filled[0])
+        self.assertEqual('7 & 12,346 & 8 &  \\\\', filled[3])
+        self.assertEqual('#tab:coef[3,1]# #tab:nope[1,1]# **', filled[5])
+        self.assertIn('nope', msg)
+
+    def testDeterministicAddressed(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'template.tex')
+        tables   = os.path.join(tmpdir, 'tables.txt')
+        output   = os.path.join(tmpdir, 'filled.tex')
+        with open(template, 'w') as fh:
+            fh.write('We find #tab:coef[1,1]|2#.\n')
+
+        filled = []
+        for value in ['1.5', '2.5']:
+            with open(tables, 'w') as fh:
+                fh.write('<tab:coef>\n%s\n' % value)
+
+            with nostderrout():
+                status, msg = tablefill(input         = tables,
+                                        template      = template,
+                                        output        = output,
+                                        deterministic = True)
+
+            self.assertEqual('SUCCESS', status)
+            filled += [open(output, 'r').read()]
+
+        shutil.rmtree(tmpdir)
+
+        # A tag quoted only by addressed placeholders is in the fingerprint
+        self.assertIn('We find 1.50.', filled[0])
+        self.assertIn('We find 2.50.', filled[1])
+        fingerprint = [f.split('Fingerprint: ')[1].split()[0] for f in filled]
+        self.assertNotEqual(fingerprint[0], fingerprint[1])
+
+    def testMatrixLyx(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        tables   = os.path.join(tmpdir, 'matrix.txt')
+        template = os.path.join(tmpdir, 'matrix.lyx')
+        output   = os.path.join(tmpdir, 'matrix_filled.lyx')
+        report   = os.path.join(tmpdir, 'report.json')
+        with open(tables, 'w') as fh:
+            fh.write('<tab:matrix>\n1.234\tx\textra\n2.5\t.\n')
+
+        def cell(text):
+            return ('<cell alignment="center" valignment="top">\n'
+                    '\\begin_inset Text\n\n\\begin_layout Plain Layout\n'
+                    '%s\n\\end_layout\n\n\\end_inset\n</cell>\n' % text)
+
+        with open(template, 'w') as fh:
+            fh.write('\\begin_body\n\\begin_inset Float table\n')
+            fh.write('\\begin_inset CommandInset label\nname "tab:matrix"\n')
+            fh.write('\\end_inset\n\\begin_inset Tabular\n')
+            fh.write('<lyxtabular version="3" rows="2" columns="2">\n')
+            fh.write('<row>\n' + cell('a') + cell('b') + '</row>\n')
+            fh.write('<row>\n' + cell('tablefill:matrix fmt=#1#,###') + cell('')
+                     + '</row>\n')
+            fh.write('</lyxtabular>\n\\end_inset\n\\end_body\n')
+
+        with nostderrout():
+            status, msg = tablefill(input    = tables,
+                                    template = template,
+                                    output   = output,
+                                    nohead   = True)
+            filled = open(output, 'r').read()
+            tablefill(input      = tables,
+                      template   = template,
+                      output     = report,
+                      query      = [],
+                      query_json = True)
+            query = json.load(open(report, 'r'))
+
+        shutil.rmtree(tmpdir)
+
+        # The row is copied once per input row, cut to its two cells
+        self.assertEqual('SUCCESS', status)
+        self.assertIn('<lyxtabular version="3" rows="3" columns="2">', filled)
+        self.assertEqual(3, filled.count('<row>'))
+        self.assertNotIn('tablefill:matrix', filled)
+        self.assertNotIn('extra', filled)
+        texts = re.findall(r'Plain Layout\n(.*)\n', filled)
+        self.assertEqual(['a', 'b', '1.2', 'x', '2.5', ''], texts)
+
+        # The matrix cells are the table's placeholders
+        self.assertEqual([3], [t['placeholders'] for t in query['tables']])
+        self.assertTrue(query['tables'][0]['ok'])
+
+    def testDeterministicShape(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'template.tex')
+        tables   = os.path.join(tmpdir, 'tables.txt')
+        output   = os.path.join(tmpdir, 'filled.tex')
+        with open(template, 'w') as fh:
+            fh.write('\\begin{table}\n\\label{tab:m}\n')
+            fh.write('% tablefill:matrix\n\\end{table}\n')
+
+        filled = []
+        for text in ['1\t2\n3\n', '1\n2\t3\n', '1\t.\t2\n3\n']:
+            with open(tables, 'w') as fh:
+                fh.write('<tab:m>\n' + text)
+
+            with nostderrout():
+                tablefill(input         = tables,
+                          template      = template,
+                          output        = output,
+                          deterministic = True)
+
+            filled += [open(output, 'r').read()]
+
+        shutil.rmtree(tmpdir)
+
+        # Same entries in different rows, or with a missing entry, fill
+        # differently and have a different fingerprint
+        fingerprint = [f.split('Fingerprint: ')[1].split()[0] for f in filled]
+        self.assertNotEqual(filled[0], filled[1])
+        self.assertEqual(3, len(set(fingerprint)))
+
+    def testXmlShape(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'custom.tex')
+        tables   = os.path.join(tmpdir, 'custom.txt')
+        output   = os.path.join(tmpdir, 'custom_filled.tex')
+        with open(template, 'w') as fh:
+            fh.write("% <tablefill-python tag = 'm' type = 'float'>\n"
+                     "%     [[base[0][0], base[0][1]], [base[1][0], base[1][1]]]\n"
+                     "% </tablefill-python>\n"
+                     "Cell #tab:m[2,1]|1#.\n"
+                     "\\begin{table}\n\\label{tab:m}\n"
+                     "% tablefill:matrix fmt=#1#\n\\end{table}\n")
+
+        with open(tables, 'w') as fh:
+            fh.write('<tab:base>\n1\t2\n3\t4\n')
+
+        # Custom tables keep their rows in and out of the sandbox
+        for jobs in [None, 2]:
+            with nostderrout():
+                status, msg = tablefill(input    = tables,
+                                        template = template,
+                                        output   = output,
+                                        nohead   = True,
+                                        xml_jobs = jobs)
+
+            filled = open(output, 'r').read().split('\n')
+            self.assertEqual('SUCCESS', status)
+            self.assertEqual('Cell 3.0.', filled[3])
+            self.assertEqual('1.0 & 2.0 \\\\', filled[7])
+            self.assertEqual('3.0 & 4.0 \\\\', filled[8])
+
+        shutil.rmtree(tmpdir)
+
+    def testXmlSandboxHung(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'custom.tex')
+        tables   = os.path.join(tmpdir, 'custom.txt')
+        output   = os.path.join(tmpdir, 'custom_filled.tex')
+        with open(tables, 'w') as fh:
+            fh.write('<tab:base>\n1\n')
+
+        # A loop in C is not interrupted by the timer, only by
+        # restarting the pool. 'fine' is queued behind the hung tables.
+        custom = {'hung': 'sum(iter(int, 1))',
+                  'stuck': 'sum(iter(int, 1))',
+                  'fine': 'base[0]'}
+
+        def fill(tags, jobs):
+            with open(template, 'w') as fh:
+                for tag in tags:
+                    fh.write("% <tablefill-python tag = '" + tag + "'>\n"
+                             "%     " + custom[tag] + "\n"
+                             "% </tablefill-python>\n")
+
+                for tag in tags:
+                    fh.write('\\begin{table}\n\\label{tab:%s}\n'
+                             '### \\\\\n\\end{table}\n' % tag)
+
+            start = time.time()
+            with nostderrout():
+                status, msg = tablefill(input       = tables,
+                                        template    = template,
+                                        output      = output,
+                                        nohead      = True,
+                                        xml_jobs    = jobs,
+                                        xml_timeout = 1)
+
+            filled = open(output, 'r').read().split('\n')
+            return status, filled, time.time() - start
+
+        # Both hung tables fail after a single wait (timeout + grace)
+        # for the pool; the queued table is filled in the new pool
+        status, filled, elapsed = fill(['hung', 'stuck', 'fine'], 2)
+        self.assertEqual('WARNING', status)
+        self.assertLess(elapsed, 2 * (1 + xml_grace))
+        self.assertEqual(['### \\\\', '### \\\\', '1 \\\\'], filled[11::4])
+
+        status, filled, elapsed = fill(['hung', 'fine'], 1)
+        self.assertEqual('WARNING', status)
+        self.assertEqual(['### \\\\', '1 \\\\'], filled[8::4])
+        shutil.rmtree(tmpdir)
+
+    def testDeterministicOptions(self):
+        self.getFileNames()
+        tmpdir   = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'template.tex')
+        tables   = os.path.join(tmpdir, 'tables.txt')
+        output   = os.path.join(tmpdir, 'filled.tex')
+        with open(template, 'w') as fh:
+            fh.write('\\begin{table}\n\\label{tab:t}\n### & ### \\\\\n\\end{table}\n')
+
+        with open(tables, 'w') as fh:
+            fh.write('<tab:t>\n1\t2\n')
+
+        filled = []
+        for options in [{}, {'nafilters': ['1']}, {'use_floats': True}]:
+            with nostderrout():
+                tablefill(input         = tables,
+                          template      = template,
+                          output        = output,
+                          deterministic = True,
+                          **options)
+
+            filled += [open(output, 'r').read()]
+
+        shutil.rmtree(tmpdir)
+
+        # Options that can change the output change the fingerprint
+        fingerprint = [f.split('Fingerprint: ')[1].split()[0] for f in filled]
+        self.assertIn('1 & 2 \\\\', filled[0])
+        self.assertIn('2 & ### \\\\', filled[1])
+        self.assertEqual(3, len(set(fingerprint)))
+
     # ------------------------------------------------------------------
     # The following test uses three files that are WRONG but the
     # original tablefill ignores the issues. This gives a warning.
@@ -423,6 +1672,108 @@ class testTableFillCLI(unittest.TestCase):
         self.assertEqual(texfilled_data_args1, texfilled_data_args2)
         self.assertEqual(lyxfilled_data_args1, lyxfilled_data_args2)
 
+    def testStdinStdout(self):
+        self.getFileNames()
+
+        texinout = (program, self.textemplate, self.input_appendix, self.texoutput)
+        texinout_status = tfcall('%s %s --no-header --input %s --output %s' % texinout)
+        self.assertEqual(0, texinout_status)
+        texfilled_file = open(self.texoutput, 'r').read()
+
+        # Template from stdin, filled template to stdout
+        texpipe = (self.textemplate, program, self.input_appendix)
+        texpipe_output = check_output('cat %s | %s - --type tex --no-header'
+                                      ' --input %s --output -' % texpipe,
+                                      shell = True, universal_newlines = True)
+        self.assertEqual(texfilled_file, texpipe_output)
+
+        # One input from stdin
+        texinputs = self.input_appendix.split()
+        texpipe   = (texinputs[1], program, self.textemplate, texinputs[0])
+        texpipe_output = check_output('cat %s | %s %s --no-header'
+                                      ' --input %s - --output -' % texpipe,
+                                      shell = True, universal_newlines = True)
+        self.assertEqual(texfilled_file, texpipe_output)
+
+        # Type cannot be detected from stdin
+        texpipe = (self.textemplate, program, self.input_appendix)
+        texpipe_status = tfcall('cat %s | %s - --input %s --output -' % texpipe)
+        self.assertEqual(1, texpipe_status)
+
+    def testQuery(self):
+        self.getFileNames()
+
+        # The report goes to stdout; nothing is filled
+        texquery = (program, self.textemplate, self.input_appendix)
+        texquery_output = check_output('%s %s --input %s --query --json'
+                                       % texquery,
+                                       shell = True, universal_newlines = True)
+        query = json.loads(texquery_output)
+        self.assertEqual(3, len(query['tables']))
+        self.assertTrue(all([t['ok'] for t in query['tables']]))
+
+        texquery = (program, self.textemplatewrong, self.input_appendix)
+        texquery_status = tfcall('%s %s --input %s --query' % texquery)
+        self.assertEqual(255, texquery_status)
+
+        texquery = (program, self.textemplatewrong, self.input_appendix)
+        texquery_status = tfcall('%s %s --input %s --query diversity'
+                                 % texquery)
+        self.assertEqual(0, texquery_status)
+
+    def testEach(self):
+        self.getFileNames()
+        tmpdir = tempfile.mkdtemp()
+        for each in ['a', 'b']:
+            shutil.copy('input/tables_appendix.txt',
+                        os.path.join(tmpdir, 'tables_%s.txt' % each))
+
+        texeach = (program, self.textemplate, tmpdir,
+                   'input/tables_appendix_two.txt', tmpdir)
+        texeach_status = tfcall('%s %s --no-header'
+                                ' --input %s/tables_{}.txt %s'
+                                ' --output %s/filled_{}.tex'
+                                ' --each a b --jobs 2' % texeach)
+        filled_a = open(os.path.join(tmpdir, 'filled_a.tex'), 'r').read()
+        filled_b = open(os.path.join(tmpdir, 'filled_b.tex'), 'r').read()
+        shutil.rmtree(tmpdir)
+
+        texinout = (program, self.textemplate, self.input_appendix, self.texoutput)
+        texinout_status = tfcall('%s %s --no-header --input %s --output %s' % texinout)
+        filled = open(self.texoutput, 'r').read()
+
+        self.assertEqual(0, texeach_status)
+        self.assertEqual(0, texinout_status)
+        self.assertEqual(filled, filled_a)
+        self.assertEqual(filled, filled_b)
+
+    def testProject(self):
+        self.getFileNames()
+        tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmpdir, 'paper', 'sections'))
+        shutil.copy(self.textemplate,
+                    os.path.join(tmpdir, 'paper', 'sections', 'tables.tex'))
+        with open(os.path.join(tmpdir, 'paper', 'master.tex'), 'w') as fh:
+            fh.write('\\input{sections/tables}\n')
+
+        texproject = (program, tmpdir, self.input_appendix, tmpdir)
+        texproject_status = tfcall('%s %s/paper/master.tex --no-header'
+                                   ' --input %s --output %s/filled'
+                                   ' --project --jobs 2' % texproject)
+        filled_sections = os.listdir(os.path.join(tmpdir, 'filled', 'sections'))
+        filled_tables   = os.path.join(tmpdir, 'filled', 'sections', 'tables.tex')
+        filled_tables   = open(filled_tables, 'r').read()
+        shutil.rmtree(tmpdir)
+
+        texinout = (program, self.textemplate, self.input_appendix, self.texoutput)
+        texinout_status = tfcall('%s %s --no-header --input %s --output %s' % texinout)
+        filled = open(self.texoutput, 'r').read()
+
+        self.assertEqual(0, texproject_status)
+        self.assertEqual(0, texinout_status)
+        self.assertEqual(['tables.tex'], filled_sections)
+        self.assertEqual(filled, filled_tables)
+
     # ------------------------------------------------------------------
     # The following test uses three files that are WRONG but the
     # original tablefill ignores the issues. This gives a warning.